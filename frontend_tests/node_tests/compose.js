@@ -320,6 +320,31 @@ test_ui("send_message_success", ({override}) => {
     assert.ok(reify_message_id_checked);
 });
 
+test_ui("send_message_failed", ({override}) => {
+    let echo_error_msg_checked = false;
+    override(echo, "message_send_error", (message_id, error_response) => {
+        assert.equal(message_id, 123.04);
+        assert.equal(error_response, "Not allowed");
+        echo_error_msg_checked = true;
+    });
+    override(sent_messages, "get_message_state", (local_id) => {
+        if (local_id === "123.04") {
+            return {locally_echoed: true};
+        }
+        return {locally_echoed: false};
+    });
+
+    compose.send_message_failed("123.04", "Not allowed");
+    assert.ok(echo_error_msg_checked);
+
+    echo_error_msg_checked = false;
+    $("#compose-send-status").hide();
+    compose.send_message_failed("loc-1", "Not allowed");
+    assert.ok(!echo_error_msg_checked);
+    assert.ok($("#compose-send-status").visible());
+    assert.equal($("#compose-error-msg").html(), "Not allowed");
+});
+
 test_ui("send_message", ({override}) => {
     MockDate.set(new Date(fake_now * 1000));
 
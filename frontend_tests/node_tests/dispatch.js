@@ -64,7 +64,7 @@ const ui = mock_esm("../../static/js/ui");
 const unread_ops = mock_esm("../../static/js/unread_ops");
 const user_events = mock_esm("../../static/js/user_events");
 const user_groups = mock_esm("../../static/js/user_groups");
-mock_esm("../../static/js/compose");
+const compose = mock_esm("../../static/js/compose");
 mock_esm("../../static/js/giphy");
 
 const electron_bridge = set_global("electron_bridge", {});
@@ -231,6 +231,18 @@ run_test("invites_changed", ({override}) => {
     assert.equal(stub.num_calls, 1);
 });
 
+run_test("message_send_failed", ({override}) => {
+    const event = event_fixtures.message_send_failed;
+
+    const stub = make_stub();
+    override(compose, "send_message_failed", stub.f);
+    dispatch(event);
+    assert.equal(stub.num_calls, 1);
+    const args = stub.get_args("local_id", "error");
+    assert.equal(args.local_id, event.local_id);
+    assert.equal(args.error, event.msg);
+});
+
 run_test("muted_topics", ({override}) => {
     const event = event_fixtures.muted_topics;
 
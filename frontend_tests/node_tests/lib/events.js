@@ -159,6 +159,13 @@ exports.fixtures = {
         type: "invites_changed",
     },
 
+    message_send_failed: {
+        type: "message_send_failed",
+        local_id: "1001.01",
+        msg: "Only organization administrators can send to this stream.",
+        code: "BAD_REQUEST",
+    },
+
     muted_topics: {
         type: "muted_topics",
         muted_topics: [
@@ -74,7 +74,16 @@ class zulip::app_frontend_base {
   # RAM; we just auto-detect based on available system RAM.
   $queues_multiprocess_default = $zulip::common::total_memory_mb > 3500
   $queues_multiprocess = Boolean(zulipconf('application_server', 'queue_workers_multiprocess', $queues_multiprocess_default))
+  $pipelined_message_send_shards = Integer(zulipconf('application_server', 'pipelined_message_send_shards', 1))
+  if $pipelined_message_send_shards > 1 {
+    $pipelined_message_send_queues = Integer[0, $pipelined_message_send_shards - 1].map |$shard| {
+      "pipelined_message_send_shard_${shard}"
+    }
+  } else {
+    $pipelined_message_send_queues = ['pipelined_message_send']
+  }
   $queues = [
+    'deferred_user_messages',
     'deferred_work',
     'digest_emails',
     'email_mirror',
@@ -86,10 +95,11 @@ class zulip::app_frontend_base {
     'missedmessage_emails',
     'missedmessage_mobile_notifications',
     'outgoing_webhooks',
+    'rerender_messages',
     'user_activity',
     'user_activity_interval',
     'user_presence',
-  ]
+  ] + $pipelined_message_send_queues
   if $queues_multiprocess {
     $uwsgi_default_processes = 6
   } else {
@@ -9,6 +9,7 @@ from typing import Any, DefaultDict, Dict, List
 ZULIP_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 normal_queues = [
+    "deferred_user_messages",
     "deferred_work",
     "digest_emails",
     "email_mirror",
@@ -20,11 +21,18 @@ normal_queues = [
     "missedmessage_emails",
     "missedmessage_mobile_notifications",
     "outgoing_webhooks",
+    "pipelined_message_send",
+    "rerender_messages",
     "user_activity",
     "user_activity_interval",
     "user_presence",
 ]
 
+
+def is_normal_queue(queue_name: str) -> bool:
+    return queue_name in normal_queues or queue_name.startswith("pipelined_message_send_shard_")
+
+
 OK = 0
 WARNING = 1
 CRITICAL = 2
@@ -114,7 +122,7 @@ def check_other_queues(queue_counts_dict: Dict[str, int]) -> List[Dict[str, Any]
 
     results = []
     for queue, count in queue_counts_dict.items():
-        if queue in normal_queues:
+        if is_normal_queue(queue):
             continue
 
         if count > CRITICAL_COUNT_THRESHOLD_DEFAULT:
@@ -154,7 +162,7 @@ def check_rabbitmq_queues() -> None:
         universal_newlines=True,
     ).strip()
     queue_stats: Dict[str, Dict[str, Any]] = {}
-    queues_to_check = set(normal_queues).intersection(set(queues_with_consumers))
+    queues_to_check = {queue for queue in queues_with_consumers if is_normal_queue(queue)}
     for queue in queues_to_check:
         fn = queue + ".stats"
         file_path = os.path.join(queue_stats_dir, fn)
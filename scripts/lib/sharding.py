@@ -5,7 +5,7 @@ import json
 import os
 import subprocess
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, List, Union
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(BASE_DIR)
@@ -24,13 +24,26 @@ def write_realm_nginx_config_line(f: Any, host: str, port: str) -> None:
     )
 
 
+def write_user_sharded_realm_nginx_config_line(f: Any, host: str) -> None:
+    # Requests for a realm sharded by user are routed by the port in
+    # their queue_id; see tornado-upstreams.conf.template.erb.
+    f.write(
+        f"""if ($host = '{host}') {{
+    set $tornado_server $tornado_queue_server;
+}}\n"""
+    )
+
+
 # Basic system to do Tornado sharding.  Writes two output .tmp files that need
 # to be renamed to the following files to finalize the changes:
 # * /etc/zulip/nginx_sharding.conf; nginx needs to be reloaded after changing.
 # * /etc/zulip/sharding.json; supervisor Django process needs to be reloaded
 # after changing.  TODO: We can probably make this live-reload by statting the file.
 #
-# TODO: Restructure this to automatically generate a sharding layout.
+# Realms not listed in the [tornado_sharding] section are assigned a
+# port by consistent hashing of their hostname; see
+# zerver/tornado/sharding.py.  A realm listed under several ports is
+# sharded by user ID between them.
 def write_updated_configs() -> None:
     config_file = get_config_file()
     ports = get_tornado_ports(config_file)
@@ -49,8 +62,8 @@ def write_updated_configs() -> None:
             sharding_json_f.write("{}\n")
             return
 
-        nginx_sharding_conf_f.write("set $tornado_server http://tornado9800;\n")
-        shard_map: Dict[str, int] = {}
+        nginx_sharding_conf_f.write("set $tornado_server http://tornado;\n")
+        host_ports: Dict[str, List[int]] = {}
         external_host = subprocess.check_output(
             [os.path.join(BASE_DIR, "scripts/get-django-setting"), "EXTERNAL_HOST"],
             universal_newlines=True,
@@ -64,10 +77,19 @@ def write_updated_configs() -> None:
                         host = shard
                     else:
                         host = f"{shard}.{external_host}"
-                    assert host not in shard_map, f"host {host} duplicated"
-                    shard_map[host] = int(port)
-                    write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
-            nginx_sharding_conf_f.write("\n")
+                    assert int(port) not in host_ports.get(
+                        host, []
+                    ), f"host {host} duplicated for port {port}"
+                    host_ports.setdefault(host, []).append(int(port))
+
+        shard_map: Dict[str, Union[int, List[int]]] = {}
+        for host, realm_ports in host_ports.items():
+            if len(realm_ports) == 1:
+                shard_map[host] = realm_ports[0]
+                write_realm_nginx_config_line(nginx_sharding_conf_f, host, str(realm_ports[0]))
+            else:
+                shard_map[host] = sorted(realm_ports)
+                write_user_sharded_realm_nginx_config_line(nginx_sharding_conf_f, host)
 
         sharding_json_f.write(json.dumps(shard_map) + "\n")
 
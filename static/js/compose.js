@@ -193,7 +193,32 @@ export function send_message_success(local_id, message_id, locally_echoed) {
         clear_compose_box();
     }
 
-    echo.reify_message_id(local_id, message_id);
+    // With the server's pipelined send mode, the response doesn't
+    // include the message ID; we'll reify the message when we receive
+    // its message event instead.
+    if (message_id !== undefined) {
+        echo.reify_message_id(local_id, message_id);
+    }
+}
+
+export function send_message_failed(local_id, error) {
+    // The server accepted this message for pipelined sending, but
+    // then failed to send it; show the error as if the send request
+    // itself had failed.
+    if (local_id === null) {
+        return;
+    }
+    const state = sent_messages.get_message_state(local_id);
+    if (!state) {
+        return;
+    }
+
+    if (!state.locally_echoed) {
+        compose_error.show(_.escape(error), $("#compose-textarea"));
+        return;
+    }
+
+    echo.message_send_error(Number.parseFloat(local_id), error);
 }
 
 export function send_message(request = create_message_object()) {
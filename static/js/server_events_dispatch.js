@@ -138,6 +138,10 @@ export function dispatch_normal_event(event) {
             muted_topics_ui.handle_topic_updates(event.muted_topics);
             break;
 
+        case "message_send_failed":
+            compose.send_message_failed(event.local_id, event.msg);
+            break;
+
         case "muted_users":
             muted_users_ui.handle_user_updates(event.muted_users);
             break;
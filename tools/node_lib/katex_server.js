@@ -0,0 +1,27 @@
+"use strict";
+
+// A long-lived KaTeX rendering process, used by zerver/lib/tex.py so
+// that rendering a formula doesn't require starting a new Node
+// process.  It reads one JSON request per line on stdin, of the form
+// {"tex": ..., "display_mode": ...}, and writes one JSON response per
+// line on stdout, in the same order: {"html": ...} if rendering
+// succeeded, or {"error": ...} if the TeX is invalid.
+
+const readline = require("readline");
+
+const katex = require("katex");
+
+const lines = readline.createInterface({input: process.stdin, terminal: false});
+
+lines.on("line", (line) => {
+    const request = JSON.parse(line);
+    let response;
+    try {
+        response = {
+            html: katex.renderToString(request.tex, {displayMode: request.display_mode}),
+        };
+    } catch (error) {
+        response = {error: error.message};
+    }
+    process.stdout.write(JSON.stringify(response) + "\n");
+});
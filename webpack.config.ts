@@ -271,7 +271,7 @@ export default (env: {minimize?: boolean} = {}, argv: {mode?: string}): webpack.
         target: "node",
         context: __dirname,
         entry: {
-            "katex-cli": "shebang-loader!katex/cli",
+            "katex-server": "./tools/node_lib/katex_server.js",
         },
         output: {
             path: path.resolve(__dirname, "static/webpack-bundles"),
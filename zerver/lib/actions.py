@@ -1,5 +1,6 @@
 import datetime
 import hashlib
+import io
 import itertools
 import logging
 import os
@@ -37,7 +38,7 @@ from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
 from django.utils.translation import override as override_language
 from psycopg2.extras import execute_values
-from psycopg2.sql import SQL
+from psycopg2.sql import SQL, Literal
 from typing_extensions import TypedDict
 
 from analytics.lib.counts import COUNT_STATS, RealmCount, do_increment_logging_stat
@@ -69,12 +70,18 @@ from zerver.lib.cache import (
     cache_with_key,
     delete_user_profile_caches,
     display_recipient_cache_key,
+    flush_stream_recipient_info,
     flush_user_profile,
     to_dict_cache_key_id,
     user_profile_by_api_key_cache_key,
     user_profile_delivery_email_cache_key,
 )
 from zerver.lib.create_user import create_user, get_display_email_address
+from zerver.lib.deferred_user_messages import (
+    backfill_deferred_user_messages,
+    materialize_deferred_user_messages,
+    should_defer_fan_out,
+)
 from zerver.lib.email_mirror_helpers import encode_email_address, encode_email_address_helper
 from zerver.lib.email_notifications import enqueue_welcome_emails
 from zerver.lib.email_validation import (
@@ -98,7 +105,7 @@ from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.i18n import get_language_name
 from zerver.lib.markdown import MessageRenderingResult, topic_links
 from zerver.lib.markdown import version as markdown_version
-from zerver.lib.mention import MentionData
+from zerver.lib.mention import MentionData, get_rendered_mentions
 from zerver.lib.message import (
     MessageDict,
     SendMessageRequest,
@@ -126,6 +133,11 @@ from zerver.lib.send_email import (
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.sessions import delete_user_sessions
 from zerver.lib.storage import static_path
+from zerver.lib.stream_recipient_info import (
+    get_stream_recipient_rows,
+    get_subscription_rows_for_send_message,
+    get_user_rows_for_send_message,
+)
 from zerver.lib.stream_subscription import (
     SubInfo,
     bulk_get_private_peers,
@@ -169,6 +181,14 @@ from zerver.lib.topic import (
 )
 from zerver.lib.topic_mutes import add_topic_mute, get_topic_mutes, remove_topic_mute
 from zerver.lib.types import ProfileFieldData
+from zerver.lib.unread_summary import (
+    add_unread_messages,
+    clear_unread_messages,
+    get_add_unread_messages_query,
+    get_lock_users_query,
+    refresh_unread_messages,
+    remove_unread_messages,
+)
 from zerver.lib.upload import (
     claim_attachment,
     delete_avatar_image,
@@ -196,6 +216,7 @@ from zerver.models import (
     CustomProfileFieldValue,
     DefaultStream,
     DefaultStreamGroup,
+    DeferredUserMessages,
     EmailChangeStatus,
     Message,
     MultiuseInvite,
@@ -246,7 +267,6 @@ from zerver.models import (
     get_user_profile_by_id,
     is_cross_realm_bot_email,
     linkifiers_for_realm,
-    query_for_ids,
     realm_filters_for_realm,
     validate_attachment_request,
 )
@@ -1265,6 +1285,7 @@ def do_deactivate_stream(
     get_active_subscriptions_for_stream_id(stream.id, include_deactivated_users=True).update(
         active=False
     )
+    flush_stream_recipient_info([stream.recipient_id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -1470,6 +1491,7 @@ def get_recipient_info(
     stream_email_user_ids: Set[int] = set()
     wildcard_mention_user_ids: Set[int] = set()
     muted_sender_user_ids: Set[int] = get_muting_users(sender_id)
+    cached_user_rows: List[Dict[str, Any]] = []
 
     if recipient.type == Recipient.PERSONAL:
         # The sender and recipient may be the same id, so
@@ -1484,32 +1506,24 @@ def get_recipient_info(
         assert stream_topic is not None
         user_ids_muting_topic = stream_topic.user_ids_muting_topic()
 
-        subscription_rows = (
-            get_subscriptions_for_send_message(
+        if possible_wildcard_mention:
+            subscription_rows = get_subscription_rows_for_send_message(
+                get_subscriptions_for_send_message(
+                    realm_id=realm_id,
+                    stream_id=stream_topic.stream_id,
+                    possible_wildcard_mention=possible_wildcard_mention,
+                    possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+                )
+            )
+        else:
+            # Messages that can't contain a wildcard mention only need
+            # the recipient info that we cache for each stream.
+            subscription_rows, cached_user_rows = get_stream_recipient_rows(
                 realm_id=realm_id,
+                recipient_id=recipient.id,
                 stream_id=stream_topic.stream_id,
-                possible_wildcard_mention=possible_wildcard_mention,
                 possibly_mentioned_user_ids=possibly_mentioned_user_ids,
             )
-            .annotate(
-                user_profile_email_notifications=F(
-                    "user_profile__enable_stream_email_notifications"
-                ),
-                user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
-                user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
-            )
-            .values(
-                "user_profile_id",
-                "push_notifications",
-                "email_notifications",
-                "wildcard_mentions_notify",
-                "user_profile_email_notifications",
-                "user_profile_push_notifications",
-                "user_profile_wildcard_mentions_notify",
-                "is_muted",
-            )
-            .order_by("user_profile_id")
-        )
 
         message_to_user_ids = [row["user_profile_id"] for row in subscription_rows]
 
@@ -1573,39 +1587,23 @@ def get_recipient_info(
     # for our data structures not related to bots
     user_ids |= possibly_mentioned_user_ids
 
-    if user_ids:
-        query = UserProfile.objects.filter(is_active=True).values(
-            "id",
-            "enable_online_push_notifications",
-            "is_bot",
-            "bot_type",
-            "long_term_idle",
-        )
-
-        # query_for_ids is fast highly optimized for large queries, and we
-        # need this codepath to be fast (it's part of sending messages)
-        query = query_for_ids(
-            query=query,
-            user_ids=sorted(user_ids),
-            field="id",
-        )
-        rows = list(query)
-    else:
-        # TODO: We should always have at least one user_id as a recipient
-        #       of any message we send.  Right now the exception to this
-        #       rule is `notify_new_user`, which, at least in a possibly
-        #       contrived test scenario, can attempt to send messages
-        #       to an inactive bot.  When we plug that hole, we can avoid
-        #       this `else` clause and just `assert(user_ids)`.
-        #
-        # UPDATE: It's February 2020 (and a couple years after the above
-        #         comment was written).  We have simplified notify_new_user
-        #         so that it should be a little easier to reason about.
-        #         There is currently some cleanup to how we handle cross
-        #         realm bots that is still under development.  Once that
-        #         effort is complete, we should be able to address this
-        #         to-do.
-        rows = []
+    rows = list(cached_user_rows)
+    # TODO: We should always have at least one user_id as a recipient
+    #       of any message we send.  Right now the exception to this
+    #       rule is `notify_new_user`, which, at least in a possibly
+    #       contrived test scenario, can attempt to send messages
+    #       to an inactive bot.  When we plug that hole, we can avoid
+    #       the empty check in get_user_rows_for_send_message and just
+    #       `assert(user_ids)`.
+    #
+    # UPDATE: It's February 2020 (and a couple years after the above
+    #         comment was written).  We have simplified notify_new_user
+    #         so that it should be a little easier to reason about.
+    #         There is currently some cleanup to how we handle cross
+    #         realm bots that is still under development.  Once that
+    #         effort is complete, we should be able to address this
+    #         to-do.
+    rows += get_user_rows_for_send_message(user_ids - {row["id"] for row in rows})
 
     def get_ids_for(f: Callable[[Dict[str, Any]], bool]) -> Set[int]:
         """Only includes users on the explicit message to line"""
@@ -1761,6 +1759,7 @@ def build_message_send_dict(
     realm: Optional[Realm] = None,
     widget_content_dict: Optional[Dict[str, Any]] = None,
     email_gateway: bool = False,
+    mention_data: Optional[MentionData] = None,
 ) -> SendMessageRequest:
     """Returns a dictionary that can be passed into do_send_messages.  In
     production, this is always called by check_message, but some
@@ -1769,10 +1768,11 @@ def build_message_send_dict(
     if realm is None:
         realm = message.sender.realm
 
-    mention_data = MentionData(
-        realm_id=realm.id,
-        content=message.content,
-    )
+    if mention_data is None:
+        mention_data = MentionData(
+            realm_id=realm.id,
+            content=message.content,
+        )
 
     if message.is_stream_message():
         stream_id = message.recipient.type_id
@@ -1896,6 +1896,7 @@ def do_send_messages(
                 send_request.message.save(update_fields=["has_attachment"])
 
         ums: List[UserMessageLite] = []
+        deferred_user_messages: List[DeferredUserMessages] = []
         for send_request in send_message_requests:
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
             # they will be processed later.
@@ -1905,7 +1906,7 @@ def do_send_messages(
             mark_as_read_for_users = send_request.muted_sender_user_ids
             mark_as_read_for_users.update(mark_as_read)
 
-            user_messages = create_user_messages(
+            user_messages, deferred_user_ids = create_user_messages(
                 message=send_request.message,
                 rendering_result=send_request.rendering_result,
                 um_eligible_user_ids=send_request.um_eligible_user_ids,
@@ -1914,12 +1915,21 @@ def do_send_messages(
                 stream_email_user_ids=send_request.stream_email_user_ids,
                 mentioned_user_ids=mentioned_user_ids,
                 mark_as_read_for_users=mark_as_read_for_users,
+                defer_fan_out=should_defer_fan_out(
+                    send_request.realm, send_request.stream, send_request.um_eligible_user_ids
+                ),
             )
 
             for um in user_messages:
                 user_message_flags[send_request.message.id][um.user_profile_id] = um.flags_list()
 
             ums.extend(user_messages)
+            if deferred_user_ids:
+                deferred_user_messages.append(
+                    DeferredUserMessages(
+                        message=send_request.message, user_profile_ids=deferred_user_ids
+                    )
+                )
 
             send_request.message.service_queue_events = get_service_bot_events(
                 sender=send_request.message.sender,
@@ -1930,10 +1940,20 @@ def do_send_messages(
             )
 
         bulk_insert_ums(ums)
+        DeferredUserMessages.objects.bulk_create(deferred_user_messages)
 
         for send_request in send_message_requests:
             do_widget_post_save_actions(send_request)
 
+    for deferred in deferred_user_messages:
+        # The worker can only see the DeferredUserMessages row once
+        # the transaction containing it has committed.
+        transaction.on_commit(
+            lambda message_id=deferred.message_id: queue_json_publish(
+                "deferred_user_messages", {"message_id": message_id}
+            )
+        )
+
     # This next loop is responsible for notifying other parts of the
     # Zulip system about the messages we just committed to the database:
     # * Notifying clients via send_event
@@ -2107,7 +2127,8 @@ def create_user_messages(
     stream_email_user_ids: AbstractSet[int],
     mentioned_user_ids: AbstractSet[int],
     mark_as_read_for_users: Set[int],
-) -> List[UserMessageLite]:
+    defer_fan_out: bool = False,
+) -> Tuple[List[UserMessageLite], List[int]]:
     # These properties on the Message are set via
     # render_markdown by code in the Markdown inline patterns
     ids_with_alert_words = rendering_result.user_ids_with_alert_words
@@ -2139,7 +2160,13 @@ def create_user_messages(
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
+    #
+    # With defer_fan_out, we treat all the recipients of the message
+    # that way, except that we return the IDs of the non-idle users
+    # whose rows we skipped, so that they can be created shortly
+    # afterwards; see zerver/lib/deferred_user_messages.py.
     user_messages = []
+    deferred_user_ids = []
     for user_profile_id in um_eligible_user_ids:
         flags = base_flags
         if (
@@ -2152,12 +2179,14 @@ def create_user_messages(
             flags |= UserMessage.flags.has_alert_word
 
         if (
-            user_profile_id in long_term_idle_user_ids
+            (defer_fan_out or user_profile_id in long_term_idle_user_ids)
             and user_profile_id not in stream_push_user_ids
             and user_profile_id not in stream_email_user_ids
             and is_stream_message
             and int(flags) == 0
         ):
+            if user_profile_id not in long_term_idle_user_ids:
+                deferred_user_ids.append(user_profile_id)
             continue
 
         um = UserMessageLite(
@@ -2167,7 +2196,12 @@ def create_user_messages(
         )
         user_messages.append(um)
 
-    return user_messages
+    return user_messages, deferred_user_ids
+
+
+# Above this many rows, bulk_insert_ums streams the rows to PostgreSQL
+# using COPY, rather than building an INSERT statement.
+BULK_INSERT_UMS_COPY_THRESHOLD = 1000
 
 
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
@@ -2176,23 +2210,78 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    The unread messages are also added to the users' unread
+    summaries (see zerver/lib/unread_summary.py), in the same
+    statement, which is preceded by one locking the users.
     """
     if not ums:
         return
 
+    if len(ums) > BULK_INSERT_UMS_COPY_THRESHOLD:
+        bulk_copy_ums(ums)
+        return
+
     vals = [(um.user_profile_id, um.message_id, um.flags) for um in ums]
     query = SQL(
         """
-        INSERT into
-            zerver_usermessage (user_profile_id, message_id, flags)
-        VALUES %s
+        {lock_users};
+        WITH new_usermessages AS (
+            INSERT into
+                zerver_usermessage (user_profile_id, message_id, flags)
+            VALUES %s
+            RETURNING user_profile_id, message_id, flags
+        )
+        {add_unread_messages}
     """
+    ).format(
+        lock_users=get_lock_users_query(
+            SQL("unnest({user_profile_ids}::integer[]) AS source(user_profile_id)").format(
+                user_profile_ids=Literal(
+                    sorted(
+                        {um.user_profile_id for um in ums if not um.flags & UserMessage.flags.read}
+                    )
+                )
+            )
+        ),
+        add_unread_messages=get_add_unread_messages_query(
+            SQL(
+                """
+                (
+                    SELECT user_profile_id, message_id
+                    FROM new_usermessages
+                    WHERE (flags & 1) = 0
+                ) AS source
+            """
+            )
+        ),
     )
 
     with connection.cursor() as cursor:
         execute_values(cursor.cursor, query, vals)
 
 
+def bulk_copy_ums(ums: List[UserMessageLite]) -> None:
+    """For messages with many recipients (e.g. to a stream with
+    thousands of subscribers), most of the time spent in
+    bulk_insert_ums is building and parsing the huge INSERT statement.
+    COPY lets us instead stream the rows to PostgreSQL in its simple
+    tab-separated text format, which for integer columns needs no
+    escaping."""
+    data = io.StringIO(
+        "".join(f"{um.user_profile_id}\t{um.message_id}\t{um.flags}\n" for um in ums)
+    )
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(
+            "COPY zerver_usermessage (user_profile_id, message_id, flags) FROM STDIN", data
+        )
+
+    unread_ums = [um for um in ums if not um.flags & UserMessage.flags.read]
+    add_unread_messages(
+        [um.user_profile_id for um in unread_ums], [um.message_id for um in unread_ums]
+    )
+
+
 def verify_submessage_sender(
     *,
     message_id: int,
@@ -2774,6 +2863,209 @@ def check_send_message(
     return do_send_messages([message])[0]
 
 
+def check_send_messages(
+    sender: UserProfile,
+    client: Client,
+    messages: Sequence[Dict[str, Any]],
+    sender_queue_id: Optional[str] = None,
+) -> List[Union[int, JsonableError, None]]:
+    """Sends a batch of messages from the same sender, each a dictionary
+    with keys type, to, content, and optionally topic and local_id, as
+    for send_message_backend.  Each message is checked separately,
+    but the messages share the database queries for their possible
+    mentions, and all those that pass are sent together, in a single
+    transaction.
+
+    Returns, for each message, either the ID of the sent message or
+    the error that prevented sending it; or, in the pipelined send
+    mode, None for each message that was queued (see
+    check_enqueue_message).
+    """
+
+    def get_message_to(message: Dict[str, Any]) -> Union[Sequence[int], Sequence[str]]:
+        message_to = message["to"]
+        if message["type"] == "private" and isinstance(message_to, str):
+            # As in send_message_backend, this may be a
+            # comma-separated list of email addresses.
+            return extract_private_recipients(message_to)
+        elif not isinstance(message_to, list):
+            return [message_to]
+        return message_to
+
+    results: List[Union[int, JsonableError, None]] = []
+    if settings.PIPELINED_MESSAGE_SEND:
+        for message in messages:
+            try:
+                check_enqueue_message(
+                    sender,
+                    client,
+                    message["type"],
+                    get_message_to(message),
+                    message.get("topic"),
+                    message["content"],
+                    local_id=message.get("local_id"),
+                    sender_queue_id=sender_queue_id,
+                )
+            except JsonableError as e:
+                results.append(e)
+                continue
+            results.append(None)
+        return results
+
+    mention_data = MentionData(
+        realm_id=sender.realm_id,
+        content="\n".join(message["content"] for message in messages),
+    )
+
+    send_requests: List[SendMessageRequest] = []
+    for message in messages:
+        try:
+            addressee = Addressee.legacy_build(
+                sender,
+                message["type"],
+                get_message_to(message),
+                message.get("topic"),
+            )
+            send_request = check_message(
+                sender,
+                client,
+                addressee,
+                message["content"],
+                forwarder_user_profile=sender,
+                local_id=message.get("local_id"),
+                sender_queue_id=sender_queue_id,
+                mention_data=mention_data.for_content(message["content"]),
+            )
+        except JsonableError as e:
+            results.append(e)
+            continue
+        except ZephyrMessageAlreadySentException as e:
+            results.append(e.message_id)
+            continue
+        send_requests.append(send_request)
+        results.append(None)
+
+    message_ids = iter(do_send_messages(send_requests))
+    return [next(message_ids) if result is None else result for result in results]
+
+
+def pipelined_message_send_queue_name(shard: int) -> str:
+    if settings.PIPELINED_MESSAGE_SEND_SHARDS == 1:
+        return "pipelined_message_send"
+    return f"pipelined_message_send_shard_{shard}"
+
+
+def check_enqueue_message(
+    sender: UserProfile,
+    client: Client,
+    message_type_name: str,
+    message_to: Union[Sequence[int], Sequence[str]],
+    topic_name: Optional[str],
+    message_content: str,
+    *,
+    forged_timestamp: Optional[float] = None,
+    local_id: Optional[str] = None,
+    sender_queue_id: Optional[str] = None,
+    widget_content: Optional[str] = None,
+) -> None:
+    """Used instead of check_send_message in the pipelined send mode
+    (settings.PIPELINED_MESSAGE_SEND).  Does the checks for whether
+    the sender can send to this recipient, and if they pass, queues
+    the message for the sender's shard of the pipelined_message_send
+    queue worker, which renders and sends it.  The sender learns the message's ID from
+    the message event, which includes local_id; or, if it can't be
+    sent after all, from a message_send_failed event (see
+    notify_pipelined_send_failed).
+
+    Every message from a sender must be sent this way, since the
+    queue is what keeps their messages in order.
+    """
+    realm = sender.realm
+    normalize_body(message_content)
+    addressee = Addressee.legacy_build(sender, message_type_name, message_to, topic_name)
+    stream, recipient = check_message_recipient(
+        sender, client, addressee, realm, forwarder_user_profile=sender
+    )
+    check_widget_content_json(widget_content)
+
+    event: Dict[str, Any] = dict(
+        sender_id=sender.id,
+        client=client.name,
+        content=message_content,
+        local_id=local_id,
+        sender_queue_id=sender_queue_id,
+        widget_content=widget_content,
+        time=float(forged_timestamp) if forged_timestamp is not None else time.time(),
+    )
+    if stream is not None:
+        event["stream_id"] = stream.id
+        event["topic"] = addressee.topic()
+    else:
+        event["user_ids"] = sorted(user.id for user in addressee.user_profiles())
+
+    # Each shard has a single consumer, and all of a sender's messages
+    # go to the same shard, so they're sent in the order they were
+    # queued.
+    shard = sender.id % settings.PIPELINED_MESSAGE_SEND_SHARDS
+    queue_json_publish(pipelined_message_send_queue_name(shard), event)
+
+
+def notify_pipelined_send_failed(event: Dict[str, Any], error: JsonableError) -> None:
+    """Tells the sender of a message queued by check_enqueue_message
+    that it couldn't be sent.  A client that passed a queue_id gets a
+    message_send_failed event, so it can mark its locally echoed copy
+    of the message as failed; any other client has no way to learn
+    that, so the sender is told by the Notification Bot instead."""
+    sender = get_user_profile_by_id(event["sender_id"])
+    if event["sender_queue_id"] is not None:
+        send_event(
+            sender.realm,
+            dict(
+                type="message_send_failed",
+                queue_id=event["sender_queue_id"],
+                local_id=event["local_id"],
+                msg=error.msg,
+                code=error.code.name,
+            ),
+            [sender.id],
+        )
+        return
+
+    with override_language(sender.default_language):
+        content = _("Your message could not be sent: {error}").format(error=error.msg)
+    internal_send_private_message(get_system_bot(settings.NOTIFICATION_BOT), sender, content)
+
+
+def check_queued_message(event: Dict[str, Any]) -> Optional[SendMessageRequest]:
+    """Prepares a message queued by check_enqueue_message to be sent.
+    Since the message's recipients may have changed since it was
+    queued, we check it again; if it can no longer be sent (or it
+    fails a check that needs it to be rendered, like that for
+    wildcard mentions), we tell the sender why, and return None."""
+    sender = get_user_profile_by_id(event["sender_id"])
+    try:
+        if "stream_id" in event:
+            addressee = Addressee.for_stream_id(event["stream_id"], event["topic"])
+        else:
+            addressee = Addressee.for_user_ids(event["user_ids"], sender.realm)
+        send_request = check_message(
+            sender,
+            get_client(event["client"]),
+            addressee,
+            event["content"],
+            forwarder_user_profile=sender,
+            local_id=event["local_id"],
+            sender_queue_id=event["sender_queue_id"],
+            widget_content=event["widget_content"],
+        )
+    except JsonableError as e:
+        notify_pipelined_send_failed(event, e)
+        return None
+
+    send_request.message.date_sent = timestamp_to_datetime(event["time"])
+    return send_request
+
+
 def check_schedule_message(
     sender: UserProfile,
     client: Client,
@@ -3159,37 +3451,21 @@ def check_private_message_policy(
 
 # check_message:
 # Returns message ready for sending with do_send_message on success or the error message (string) on error.
-def check_message(
+def check_message_recipient(
     sender: UserProfile,
     client: Client,
     addressee: Addressee,
-    message_content_raw: str,
-    realm: Optional[Realm] = None,
+    realm: Realm,
     forged: bool = False,
-    forged_timestamp: Optional[float] = None,
     forwarder_user_profile: Optional[UserProfile] = None,
-    local_id: Optional[str] = None,
-    sender_queue_id: Optional[str] = None,
-    widget_content: Optional[str] = None,
-    email_gateway: bool = False,
     *,
     skip_stream_access_check: bool = False,
-) -> SendMessageRequest:
-    """See
-    https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
-    for high-level documentation on this subsystem.
-    """
+) -> Tuple[Optional[Stream], Recipient]:
+    """Checks that the sender can send a message to the addressee,
+    returning the stream (for stream messages) and recipient."""
     stream = None
 
-    message_content = normalize_body(message_content_raw)
-
-    if realm is None:
-        realm = sender.realm
-
     if addressee.is_stream():
-        topic_name = addressee.topic()
-        topic_name = truncate_topic(topic_name)
-
         stream_name = addressee.stream_name()
         stream_id = addressee.stream_id()
 
@@ -3254,12 +3530,71 @@ def check_message(
         # the message type.
         raise AssertionError("Invalid message type")
 
+    return stream, recipient
+
+
+def check_widget_content_json(widget_content: Optional[str]) -> Optional[Dict[str, Any]]:
+    if widget_content is None:
+        return None
+
+    try:
+        widget_content_dict = orjson.loads(widget_content)
+    except orjson.JSONDecodeError:
+        raise JsonableError(_("Widgets: API programmer sent invalid JSON content"))
+
+    try:
+        check_widget_content(widget_content_dict)
+    except ValidationError as error:
+        raise JsonableError(
+            _("Widgets: {error_msg}").format(
+                error_msg=error.message,
+            )
+        )
+    return widget_content_dict
+
+
+def check_message(
+    sender: UserProfile,
+    client: Client,
+    addressee: Addressee,
+    message_content_raw: str,
+    realm: Optional[Realm] = None,
+    forged: bool = False,
+    forged_timestamp: Optional[float] = None,
+    forwarder_user_profile: Optional[UserProfile] = None,
+    local_id: Optional[str] = None,
+    sender_queue_id: Optional[str] = None,
+    widget_content: Optional[str] = None,
+    email_gateway: bool = False,
+    *,
+    skip_stream_access_check: bool = False,
+    mention_data: Optional[MentionData] = None,
+) -> SendMessageRequest:
+    """See
+    https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html
+    for high-level documentation on this subsystem.
+    """
+    message_content = normalize_body(message_content_raw)
+
+    if realm is None:
+        realm = sender.realm
+
+    stream, recipient = check_message_recipient(
+        sender,
+        client,
+        addressee,
+        realm,
+        forged,
+        forwarder_user_profile,
+        skip_stream_access_check=skip_stream_access_check,
+    )
+
     message = Message()
     message.sender = sender
     message.content = message_content
     message.recipient = recipient
     if addressee.is_stream():
-        message.set_topic_name(topic_name)
+        message.set_topic_name(truncate_topic(addressee.topic()))
     if forged and forged_timestamp is not None:
         # Forged messages come with a timestamp
         message.date_sent = timestamp_to_datetime(forged_timestamp)
@@ -3275,21 +3610,7 @@ def check_message(
         if id is not None:
             raise ZephyrMessageAlreadySentException(id)
 
-    widget_content_dict = None
-    if widget_content is not None:
-        try:
-            widget_content_dict = orjson.loads(widget_content)
-        except orjson.JSONDecodeError:
-            raise JsonableError(_("Widgets: API programmer sent invalid JSON content"))
-
-        try:
-            check_widget_content(widget_content_dict)
-        except ValidationError as error:
-            raise JsonableError(
-                _("Widgets: {error_msg}").format(
-                    error_msg=error.message,
-                )
-            )
+    widget_content_dict = check_widget_content_json(widget_content)
 
     message_send_dict = build_message_send_dict(
         message=message,
@@ -3299,6 +3620,7 @@ def check_message(
         realm=realm,
         widget_content_dict=widget_content_dict,
         email_gateway=email_gateway,
+        mention_data=mention_data,
     )
 
     if stream is not None and message_send_dict.rendering_result.mentions_wildcard:
@@ -3830,6 +4152,10 @@ def bulk_add_subs_to_db_with_logging(
     Subscription.objects.bulk_create(info.sub for info in subs_to_add)
     sub_ids = [info.sub.id for info in subs_to_activate]
     Subscription.objects.filter(id__in=sub_ids).update(active=True)
+    # Django bulk operations don't flush caches, so we need to do this ourselves.
+    flush_stream_recipient_info(
+        {info.stream.recipient_id for info in subs_to_add + subs_to_activate}
+    )
 
     # Log subscription activities in RealmAuditLog
     event_time = timezone_now()
@@ -4066,6 +4392,9 @@ def bulk_remove_subscriptions(
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ).update(active=False)
+        flush_stream_recipient_info(
+            {sub_info.stream.recipient_id for sub_info in subs_to_deactivate}
+        )
         occupied_streams_after = list(get_occupied_streams(our_realm))
 
         # Log subscription activities in RealmAuditLog
@@ -5430,6 +5759,7 @@ class ReadMessagesEvent:
 
 def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     log_statsd_event("bankruptcy")
+    materialize_deferred_user_messages(user_profile)
 
     # First, we clear mobile push notifications.  This is safer in the
     # event that the below logic times out and we're killed.
@@ -5451,6 +5781,7 @@ def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     count = msgs.update(
         flags=F("flags").bitor(UserMessage.flags.read),
     )
+    clear_unread_messages(user_profile)
 
     event = asdict(
         ReadMessagesEvent(
@@ -5480,6 +5811,7 @@ def do_mark_stream_messages_as_read(
     user_profile: UserProfile, stream_recipient_id: int, topic_name: Optional[str] = None
 ) -> int:
     log_statsd_event("mark_stream_as_read")
+    materialize_deferred_user_messages(user_profile)
 
     msgs = UserMessage.objects.filter(
         user_profile=user_profile,
@@ -5502,6 +5834,7 @@ def do_mark_stream_messages_as_read(
     count = msgs.update(
         flags=F("flags").bitor(UserMessage.flags.read),
     )
+    remove_unread_messages(message_ids, user_profile)
 
     event = asdict(
         ReadMessagesEvent(
@@ -5531,6 +5864,7 @@ def do_mark_muted_user_messages_as_read(
     user_profile: UserProfile,
     muted_user: UserProfile,
 ) -> int:
+    materialize_deferred_user_messages(user_profile)
     messages = UserMessage.objects.filter(
         user_profile=user_profile, message__sender=muted_user
     ).extra(where=[UserMessage.where_unread()])
@@ -5540,6 +5874,7 @@ def do_mark_muted_user_messages_as_read(
     count = messages.update(
         flags=F("flags").bitor(UserMessage.flags.read),
     )
+    remove_unread_messages(message_ids, user_profile)
 
     event = asdict(
         ReadMessagesEvent(
@@ -5634,6 +5969,7 @@ def do_update_message_flags(
         raise JsonableError(_("Invalid message flag operation: '{}'").format(operation))
     flagattr = getattr(UserMessage.flags, flag)
 
+    materialize_deferred_user_messages(user_profile)
     msgs = UserMessage.objects.filter(user_profile=user_profile, message_id__in=messages)
     # This next block allows you to star any message, even those you
     # didn't receive (e.g. because you're looking at a public stream
@@ -5666,6 +6002,12 @@ def do_update_message_flags(
     elif operation == "remove":
         count = msgs.update(flags=F("flags").bitand(~flagattr))
 
+    if flag == "read":
+        if operation == "add":
+            remove_unread_messages(messages, user_profile)
+        else:
+            refresh_unread_messages(messages, user_profile)
+
     event = {
         "type": "update_message_flags",
         "op": operation,
@@ -5904,6 +6246,114 @@ def do_update_embedded_data(
     send_event(user_profile.realm, event, list(map(user_info, ums)))
 
 
+def queue_rerender_messages(
+    realm: Realm, *, linkifier_patterns: List[str], emoji_names: List[str]
+) -> None:
+    """Queues re-rendering the realm's existing messages that might use
+    the given linkifiers or custom emoji; see
+    zerver/lib/rerender_messages.py."""
+
+    def queue_event() -> None:
+        event = dict(
+            realm_id=realm.id,
+            linkifier_patterns=linkifier_patterns,
+            emoji_names=emoji_names,
+            # Messages sent after this point are rendered with the
+            # new settings already.
+            before_message_id=get_last_message_id() + 1,
+        )
+        queue_json_publish("rerender_messages", event)
+
+    transaction.on_commit(queue_event)
+
+
+def do_rerender_messages(realm: Realm, messages: List[Message]) -> None:
+    """Renders the messages again, and updates those whose rendered
+    content changed, notifying clients like do_update_embedded_data
+    does.  Flags are unchanged, since this is only used when the
+    realm's linkifiers or custom emoji change, which doesn't affect
+    mentions or alert words.
+
+    Messages are rendered without holding any locks, so a message
+    edited (or given link previews) in the meantime is skipped, since
+    it already has a newer rendering."""
+    changed_messages = []
+    old_rendered_contents: Dict[int, Optional[str]] = {}
+    for message in messages:
+        # The message may mention users who have been deactivated
+        # since it was sent.
+        mention_data = MentionData(realm.id, message.content, include_deactivated_users=True)
+        try:
+            rendering_result = render_markdown(
+                message, message.content, realm=realm, mention_data=mention_data
+            )
+        except MarkdownRenderingException:
+            # The exception has already been logged; keep the old
+            # rendering.
+            continue
+
+        if rendering_result.rendered_content == message.rendered_content:
+            continue
+        if message.rendered_content is not None and get_rendered_mentions(
+            rendering_result.rendered_content
+        ) != get_rendered_mentions(message.rendered_content):
+            # A user, user group, or stream that the message mentions
+            # was renamed since it was sent; rather than change who or
+            # what the message mentions, we keep the old rendering.
+            continue
+        old_rendered_contents[message.id] = message.rendered_content
+        message.rendered_content = rendering_result.rendered_content
+        message.rendered_content_version = markdown_version
+        changed_messages.append(message)
+
+    if not changed_messages:
+        return
+
+    with transaction.atomic():
+        # Edits lock the message (see access_message), so once we hold
+        # these locks, no edit can change a message before we update it.
+        current_rows = {
+            row["id"]: row
+            for row in Message.objects.select_for_update()
+            .filter(id__in=[message.id for message in changed_messages])
+            .values("id", "content", "rendered_content")
+        }
+        changed_messages = [
+            message
+            for message in changed_messages
+            if message.id in current_rows
+            and current_rows[message.id]["content"] == message.content
+            and current_rows[message.id]["rendered_content"] == old_rendered_contents[message.id]
+        ]
+        if not changed_messages:
+            return
+        Message.objects.bulk_update(
+            changed_messages, ["rendered_content", "rendered_content_version"]
+        )
+    update_to_dict_cache(changed_messages, realm.id)
+
+    users_by_message_id: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+    for row in UserMessage.objects.filter(
+        message_id__in=[message.id for message in changed_messages]
+    ).values("message_id", "user_profile_id", "flags"):
+        users_by_message_id[row["message_id"]].append(
+            {
+                "id": row["user_profile_id"],
+                "flags": UserMessage.flags_list_for_flags(row["flags"]),
+            }
+        )
+
+    for message in changed_messages:
+        event = {
+            "type": "update_message",
+            "message_id": message.id,
+            "message_ids": [message.id],
+            "content": message.content,
+            "rendered_content": message.rendered_content,
+        }
+        send_event(realm, event, users_by_message_id[message.id])
+
+
 class DeleteMessagesEvent(TypedDict, total=False):
     type: str
     message_ids: List[int]
@@ -5976,6 +6426,17 @@ def do_update_message(
             members = mention_data.get_group_members(group_id)
             rendering_result.mentions_user_ids.update(members)
 
+        if realm.lazy_fan_out_threshold is not None and stream_being_edited is not None:
+            # Recipients whose UserMessage rows are still deferred
+            # would otherwise get them later without the flags set
+            # below, so we create the rows of those it flags now.
+            backfill_deferred_user_messages(
+                target_message.id,
+                None
+                if rendering_result.mentions_wildcard
+                else rendering_result.mentions_user_ids
+                | rendering_result.user_ids_with_alert_words,
+            )
         update_user_message_flags(rendering_result, ums)
 
         # One could imagine checking realm.allow_edit_history here and
@@ -6195,6 +6656,11 @@ def do_update_message(
     # This does message.save(update_fields=[...])
     save_message_for_edit_use_case(message=target_message)
 
+    if topic_name is not None or new_stream is not None:
+        # Moving messages changes which conversation they're in, and
+        # can change which users have UserMessage rows for them.
+        refresh_unread_messages([message.id for message in changed_messages])
+
     realm_id: Optional[int] = None
     if stream_being_edited is not None:
         realm_id = stream_being_edited.realm_id
@@ -7065,6 +7531,7 @@ def check_add_realm_emoji(
             realm_emoji.file_name = emoji_file_name
             realm_emoji.save(update_fields=["file_name"])
             notify_realm_emoji(realm_emoji.realm)
+            queue_rerender_messages(realm, linkifier_patterns=[], emoji_names=[name])
     return realm_emoji
 
 
@@ -7178,6 +7645,7 @@ def do_add_linkifier(realm: Realm, pattern: str, url_format_string: str) -> int:
     linkifier.full_clean()
     linkifier.save()
     notify_linkifiers(realm)
+    queue_rerender_messages(realm, linkifier_patterns=[pattern], emoji_names=[])
 
     return linkifier.id
 
@@ -7196,11 +7664,15 @@ def do_update_linkifier(realm: Realm, id: int, pattern: str, url_format_string:
     pattern = pattern.strip()
     url_format_string = url_format_string.strip()
     linkifier = RealmFilter.objects.get(realm=realm, id=id)
+    old_pattern = linkifier.pattern
     linkifier.pattern = pattern
     linkifier.url_format_string = url_format_string
     linkifier.full_clean()
     linkifier.save(update_fields=["pattern", "url_format_string"])
     notify_linkifiers(realm)
+    queue_rerender_messages(
+        realm, linkifier_patterns=sorted({old_pattern, pattern}), emoji_names=[]
+    )
 
 
 def get_emails_from_user_ids(user_ids: Sequence[int]) -> Dict[int, str]:
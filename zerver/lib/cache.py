@@ -26,6 +26,7 @@ from django.conf import settings
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 
@@ -539,6 +540,58 @@ def get_muting_users_cache_key(muted_user_id: int) -> str:
     return f"muting_users_list:{muted_user_id}"
 
 
+def stream_recipient_info_cache_key(recipient_id: int) -> str:
+    return f"stream_recipient_info:{recipient_id}"
+
+
+def stream_recipient_info_version_cache_key(recipient_id: int) -> str:
+    return f"stream_recipient_info_version:{recipient_id}"
+
+
+def realm_recipient_info_version_cache_key(realm_id: int) -> str:
+    return f"realm_recipient_info_version:{realm_id}"
+
+
+def bump_recipient_info_versions(keys: List[str]) -> None:
+    """Invalidates cached stream recipient info (see
+    zerver/lib/stream_recipient_info.py) by giving the versions it
+    was computed with new random values.
+
+    We do this both immediately and once the current transaction
+    commits, since another process could otherwise read the new
+    version, but then the old data from the database, before it
+    sees our transaction."""
+
+    def bump() -> None:
+        cache_set_many({key: secrets.token_hex(8) for key in keys})
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def flush_stream_recipient_info(recipient_ids: Iterable[int]) -> None:
+    bump_recipient_info_versions(
+        [stream_recipient_info_version_cache_key(recipient_id) for recipient_id in recipient_ids]
+    )
+
+
+def flush_realm_recipient_info(realm_id: int) -> None:
+    bump_recipient_info_versions([realm_recipient_info_version_cache_key(realm_id)])
+
+
+# The UserProfile fields that stream recipient info depends on.
+recipient_info_user_fields: List[str] = [
+    "bot_type",
+    "enable_online_push_notifications",
+    "enable_stream_email_notifications",
+    "enable_stream_push_notifications",
+    "is_active",
+    "is_bot",
+    "long_term_idle",
+    "wildcard_mentions_notify",
+]
+
+
 def get_realm_used_upload_space_cache_key(realm: "Realm") -> str:
     return f"realm_used_upload_space:{realm.id}"
 
@@ -641,12 +694,20 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(kwargs, ["email", "full_name", "id", "is_mirror_dummy"]):
         delete_display_recipient_cache(user_profile)
 
+    if changed(kwargs, recipient_info_user_fields):
+        flush_realm_recipient_info(user_profile.realm_id)
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(kwargs, bot_dict_fields):
         cache_delete(bot_dicts_in_realm_cache_key(user_profile.realm))
 
 
+def flush_subscription(sender: Any, **kwargs: Any) -> None:
+    subscription = kwargs["instance"]
+    flush_stream_recipient_info([subscription.recipient_id])
+
+
 def flush_muting_users_cache(sender: Any, **kwargs: Any) -> None:
     mute_object = kwargs["instance"]
     cache_delete(get_muting_users_cache_key(mute_object.muted_user_id))
@@ -0,0 +1,123 @@
+# Lazy fan-out of messages to large public streams.
+#
+# Sending a message to a stream normally creates a UserMessage row for
+# every subscriber, in the same transaction as the message itself; for
+# announcement-style streams with tens of thousands of subscribers,
+# this dominates the cost of sending the message.  In realms with
+# lazy_fan_out_threshold set, messages to public streams with more
+# subscribers than that only get UserMessage rows immediately for
+# users with nonzero flags (e.g. mentions) or who will be notified
+# about the message, similar to how we treat soft-deactivated users.
+# The IDs of the remaining recipients are stored in a
+# DeferredUserMessages row, and their UserMessage rows are created
+# shortly afterwards by the deferred_user_messages queue worker.
+#
+# Until then, code that reads a user's UserMessage rows must call
+# materialize_deferred_user_messages first, to create any of that
+# user's rows that are still pending.
+from typing import AbstractSet, Collection, Optional
+
+from django.db import connection, transaction
+from psycopg2.sql import SQL
+
+from zerver.lib.unread_summary import add_unread_messages
+from zerver.models import DeferredUserMessages, Realm, Stream, UserProfile
+
+
+def should_defer_fan_out(
+    realm: Realm, stream: Optional[Stream], um_eligible_user_ids: AbstractSet[int]
+) -> bool:
+    # We only do this for public streams, since for private streams,
+    # access_message requires the user to have a UserMessage row.
+    return (
+        realm.lazy_fan_out_threshold is not None
+        and stream is not None
+        and not stream.invite_only
+        and len(um_eligible_user_ids) > realm.lazy_fan_out_threshold
+    )
+
+
+def insert_deferred_user_messages(message_id: int, user_profile_ids: Collection[int]) -> None:
+    query = SQL(
+        """
+        INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+        SELECT zerver_subscription.user_profile_id, zerver_message.id, 0
+        FROM zerver_message
+        JOIN zerver_subscription
+            ON zerver_subscription.recipient_id = zerver_message.recipient_id
+        WHERE zerver_message.id = %(message_id)s
+            AND zerver_subscription.active
+            AND zerver_subscription.user_profile_id = ANY(%(user_profile_ids)s)
+        ON CONFLICT (user_profile_id, message_id) DO NOTHING
+        RETURNING user_profile_id
+    """
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(query, dict(message_id=message_id, user_profile_ids=list(user_profile_ids)))
+        inserted_ids = [row[0] for row in cursor.fetchall()]
+    add_unread_messages(inserted_ids, [message_id] * len(inserted_ids))
+
+
+def backfill_deferred_user_messages(
+    message_id: int, user_profile_ids: Optional[AbstractSet[int]] = None
+) -> None:
+    """Creates the deferred UserMessage rows for a message, or only
+    those of the given users (e.g. so that an edit can set their
+    flags).  Recipients who have since unsubscribed (or who can no
+    longer access the message, because it was moved to another
+    stream) are skipped."""
+    with transaction.atomic():
+        deferred = (
+            DeferredUserMessages.objects.select_for_update().filter(message_id=message_id).first()
+        )
+        if deferred is None:
+            return
+
+        if user_profile_ids is None:
+            insert_deferred_user_messages(message_id, deferred.user_profile_ids)
+            deferred.delete()
+            return
+
+        to_insert = user_profile_ids.intersection(deferred.user_profile_ids)
+        if not to_insert:
+            return
+        insert_deferred_user_messages(message_id, to_insert)
+        deferred.user_profile_ids = [
+            user_profile_id
+            for user_profile_id in deferred.user_profile_ids
+            if user_profile_id not in to_insert
+        ]
+        if deferred.user_profile_ids:
+            deferred.save(update_fields=["user_profile_ids"])
+        else:
+            deferred.delete()
+
+
+def materialize_deferred_user_messages(user_profile: UserProfile) -> None:
+    """Creates any of this user's UserMessage rows that are still
+    pending; the queue worker may still create them again later,
+    which is a no-op."""
+    if user_profile.realm.lazy_fan_out_threshold is None:
+        return
+
+    query = SQL(
+        """
+        INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+        SELECT %(user_profile_id)s, zerver_message.id, 0
+        FROM zerver_deferredusermessages
+        JOIN zerver_message
+            ON zerver_message.id = zerver_deferredusermessages.message_id
+        JOIN zerver_subscription
+            ON zerver_subscription.recipient_id = zerver_message.recipient_id
+            AND zerver_subscription.user_profile_id = %(user_profile_id)s
+        WHERE zerver_deferredusermessages.user_profile_ids @> ARRAY[%(user_profile_id)s]
+            AND zerver_subscription.active
+        ON CONFLICT (user_profile_id, message_id) DO NOTHING
+        RETURNING message_id
+    """
+    )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(query, dict(user_profile_id=user_profile.id))
+            message_ids = [row[0] for row in cursor.fetchall()]
+        add_unread_messages([user_profile.id] * len(message_ids), message_ids)
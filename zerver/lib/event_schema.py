@@ -405,6 +405,16 @@ message_event = event_dict_type(
 )
 check_message = make_checker(message_event)
 
+message_send_failed_event = event_dict_type(
+    required_keys=[
+        ("type", Equals("message_send_failed")),
+        ("local_id", OptionalType(str)),
+        ("msg", str),
+        ("code", str),
+    ]
+)
+check_message_send_failed = make_checker(message_send_failed_event)
+
 # This legacy presence structure is intended to be replaced by a more
 # sensible data structure.
 presence_type = DictType(
@@ -125,6 +125,7 @@ ALL_ZULIP_TABLES = {
     "zerver_defaultstream",
     "zerver_defaultstreamgroup",
     "zerver_defaultstreamgroup_streams",
+    "zerver_deferredusermessages",
     "zerver_draft",
     "zerver_emailchangestatus",
     "zerver_huddle",
@@ -150,8 +151,12 @@ ALL_ZULIP_TABLES = {
     "zerver_scheduledmessagenotificationemail",
     "zerver_service",
     "zerver_stream",
+    "zerver_streamtopic",
+    "zerver_streamtopiclog",
     "zerver_submessage",
     "zerver_subscription",
+    "zerver_unreadmessage",
+    "zerver_unreadsummary",
     "zerver_useractivity",
     "zerver_useractivityinterval",
     "zerver_usergroup",
@@ -237,6 +242,16 @@ NON_EXPORTED_TABLES = {
     "zerver_userstatus",
     # Drafts don't need to be exported as they are supposed to be more ephemeral.
     "zerver_draft",
+    # Deferred UserMessage rows are created within seconds of the
+    # message being sent.
+    "zerver_deferredusermessages",
+    # Unread summaries are built again from UserMessage rows when needed.
+    "zerver_unreadmessage",
+    "zerver_unreadsummary",
+    # Stream topics are maintained by database triggers as the
+    # messages are imported.
+    "zerver_streamtopic",
+    "zerver_streamtopiclog",
     # For any tables listed below here, it's a bug that they are not present in the export.
 }
 
@@ -3,7 +3,7 @@ import time
 from typing import Callable, List, TypeVar
 
 from psycopg2.extensions import cursor
-from psycopg2.sql import SQL
+from psycopg2.sql import SQL, Identifier
 
 CursorObj = TypeVar("CursorObj", bound=cursor)
 
@@ -64,6 +64,22 @@ def update_unread_flags(cursor: CursorObj, user_message_ids: List[int]) -> None:
     cursor.execute(query, {"user_message_ids": tuple(user_message_ids)})
 
 
+def invalidate_unread_summary(cursor: CursorObj, user_profile: UserProfile) -> None:
+    """
+    This is like invalidate_unread_summaries in
+    zerver/lib/unread_summary.py, but it works without the ORM, and
+    does nothing if the migrations that create those tables haven't
+    run yet.
+    """
+    if "zerver_unreadsummary" not in connection.introspection.table_names():
+        return
+    for table_name in ["zerver_unreadsummary", "zerver_unreadmessage"]:
+        query = SQL("DELETE FROM {} WHERE user_profile_id = %(user_profile_id)s").format(
+            Identifier(table_name)
+        )
+        cursor.execute(query, {"user_profile_id": user_profile.id})
+
+
 def get_timing(message: str, f: Callable[[], None]) -> None:
     start = time.time()
     logger.info(message)
@@ -149,6 +165,7 @@ def fix_unsubscribed(cursor: CursorObj, user_profile: UserProfile) -> None:
 
     def fix() -> None:
         update_unread_flags(cursor, user_message_ids)
+        invalidate_unread_summary(cursor, user_profile)
 
     get_timing(
         "fixing unread messages for non-active streams",
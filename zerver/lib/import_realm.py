@@ -25,8 +25,8 @@ from zerver.lib.actions import (
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_create_users, bulk_set_users_or_streams_recipient_fields
 from zerver.lib.export import DATE_FIELDS, Field, Path, Record, TableData, TableName
-from zerver.lib.markdown import markdown_convert
 from zerver.lib.markdown import version as markdown_version
+from zerver.lib.markdown.pool import MarkdownRenderingPool
 from zerver.lib.message import get_last_message_id
 from zerver.lib.server_initialization import create_internal_realm, server_initialized
 from zerver.lib.streams import render_stream_description
@@ -274,12 +274,13 @@ def fix_customprofilefield(data: TableData) -> None:
 
 
 def fix_message_rendered_content(
-    realm: Realm, sender_map: Dict[int, Record], messages: List[Record]
+    sender_map: Dict[int, Record], messages: List[Record], pool: MarkdownRenderingPool
 ) -> None:
     """
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
     """
+    messages_to_render = []
     for message in messages:
         if message["rendered_content"] is not None:
             # For Zulip->Zulip imports, we use the original rendered
@@ -328,38 +329,27 @@ def fix_message_rendered_content(
                 message["rendered_content"] = str(soup)
             continue
 
-        try:
-            content = message["content"]
-
-            sender_id = message["sender_id"]
-            sender = sender_map[sender_id]
-            sent_by_bot = sender["is_bot"]
-            translate_emoticons = sender["translate_emoticons"]
-
-            # We don't handle alert words on import from third-party
-            # platforms, since they generally don't have an "alert
-            # words" type feature, and notifications aren't important anyway.
-            realm_alert_words_automaton = None
-
-            rendered_content = markdown_convert(
-                content=content,
-                realm_alert_words_automaton=realm_alert_words_automaton,
-                message_realm=realm,
-                sent_by_bot=sent_by_bot,
-                translate_emoticons=translate_emoticons,
-            ).rendered_content
-
-            message["rendered_content"] = rendered_content
-            message["rendered_content_version"] = markdown_version
-        except Exception:
-            # This generally happens with two possible causes:
-            # * rendering Markdown throwing an uncaught exception
-            # * rendering Markdown failing with the exception being
-            #   caught in Markdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
+        messages_to_render.append(message)
+
+    # We don't handle alert words on import from third-party
+    # platforms, since they generally don't have an "alert
+    # words" type feature, and notifications aren't important anyway.
+    requests = []
+    for message in messages_to_render:
+        sender = sender_map[message["sender_id"]]
+        requests.append((message["content"], sender["is_bot"], sender["translate_emoticons"]))
+
+    for message, rendered_content in zip(messages_to_render, pool.render(requests)):
+        if rendered_content is None:
+            # The Markdown processor raised an exception, which
+            # has already been logged.
             logging.warning(
                 "Error in Markdown rendering for message ID %s; continuing", message["id"]
             )
+            continue
+
+        message["rendered_content"] = rendered_content
+        message["rendered_content_version"] = markdown_version
 
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
@@ -1183,7 +1173,9 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int = 1) -> Rea
     sender_map = {user["id"]: user for user in data["zerver_userprofile"]}
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    import_message_data(
+        realm=realm, sender_map=sender_map, import_dir=import_dir, processes=processes
+    )
 
     re_map_foreign_keys(data, "zerver_reaction", "message", related_table="message")
     re_map_foreign_keys(data, "zerver_reaction", "user_profile", related_table="user_profile")
@@ -1331,7 +1323,16 @@ def get_incoming_message_ids(import_dir: Path, sort_by_date: bool) -> List[int]:
     return message_ids
 
 
-def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir: Path) -> None:
+def import_message_data(
+    realm: Realm, sender_map: Dict[int, Record], import_dir: Path, processes: int
+) -> None:
+    with MarkdownRenderingPool(realm, processes) as pool:
+        import_message_dumps(sender_map, import_dir, pool)
+
+
+def import_message_dumps(
+    sender_map: Dict[int, Record], import_dir: Path, pool: MarkdownRenderingPool
+) -> None:
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, f"messages-{dump_file_id:06}.json")
@@ -1360,9 +1361,9 @@ def import_message_data(realm: Realm, sender_map: Dict[int, Record], import_dir:
             assert row["message"] in message_id_map
 
         fix_message_rendered_content(
-            realm=realm,
             sender_map=sender_map,
             messages=data["zerver_message"],
+            pool=pool,
         )
         logging.info("Successfully rendered Markdown for message batch")
 
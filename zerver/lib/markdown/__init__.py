@@ -1,6 +1,7 @@
 # Zulip's main Markdown implementation.  See docs/subsystems/markdown.md for
 # detailed documentation on our Markdown syntax.
 import datetime
+import hashlib
 import html
 import logging
 import re
@@ -36,6 +37,7 @@ import markdown.inlinepatterns
 import markdown.postprocessors
 import markdown.treeprocessors
 import markdown.util
+import orjson
 import requests
 from django.conf import settings
 from markdown.blockparser import BlockParser
@@ -44,7 +46,7 @@ from tlds import tld_set
 from typing_extensions import TypedDict
 
 from zerver.lib import mention as mention
-from zerver.lib.cache import NotFoundInCache, cache_with_key
+from zerver.lib.cache import NotFoundInCache, cache_get, cache_set, cache_with_key
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import EMOTICON_RE, codepoint_to_name, name_to_codepoint, translate_emoticons
 from zerver.lib.exceptions import MarkdownRenderingException
@@ -59,6 +61,7 @@ from zerver.lib.timezone import common_timezones
 from zerver.lib.types import LinkifierDict
 from zerver.lib.url_encoding import encode_stream, hash_util_encode
 from zerver.lib.url_preview import preview as link_preview
+from zerver.lib.utils import statsd
 from zerver.models import Message, Realm, linkifiers_for_realm
 
 ReturnT = TypeVar("ReturnT")
@@ -794,6 +797,10 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             ):
                 return None
 
+            # Renderings that depend on data fetched from a third-party
+            # site can change over time, so we can't cache them.
+            self.md.zulip_rendering_cacheable = False
+
             # Try to retrieve open graph protocol info for a preview
             # This might be redundant right now for shared links for images.
             # However, we might want to make use of title and description
@@ -1016,6 +1023,8 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
         if tweet_id is None:
             return None
 
+        self.md.zulip_rendering_cacheable = False
+
         try:
             res = fetch_tweet_data(tweet_id)
             if res is None:
@@ -1330,6 +1339,9 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             if not self.md.url_embed_preview_enabled:
                 continue
 
+            # The preview data is fetched asynchronously, after which
+            # the message is rendered again, with the preview.
+            self.md.zulip_rendering_cacheable = False
             try:
                 extracted_data = link_preview.link_embed_data_from_cache(url)
             except NotFoundInCache:
@@ -1786,8 +1798,91 @@ def prepare_linkifier_pattern(source: str) -> str:
     return fr"""(?<![^\s'"\(,:<])(?P<{OUTER_CAPTURE_GROUP}>{source})(?!\w)"""
 
 
+LINKIFIER_GROUP_NAME_RE = re.compile(r"\(\?P<(\w+)>")
+# Syntax that refers to other groups, or sets global flags, and so
+# whose meaning would change if we combined the pattern with others.
+UNCOMBINABLE_LINKIFIER_RE = re.compile(r"\\[1-9]|\(\?\(|\(\?P=|\(\?[aiLmsux]+\)")
+
+
+class LinkifierMatcher:
+    """Matches all of a set of linkifiers at once, by combining them
+    into a single regex, so that the cost of scanning text for
+    linkifiers doesn't grow with the number of linkifiers.
+
+    Each linkifier becomes one alternative of the combined regex,
+    with its named groups renamed to be unique.  Where matches of
+    different linkifiers overlap, the leftmost one wins, with ties
+    going to the linkifier listed first.  If a linkifier can't be
+    combined with the others, `regex` is None, and callers must apply
+    the linkifiers one at a time, using `patterns`."""
+
+    def __init__(self, linkifiers: List[LinkifierDict]) -> None:
+        self.linkifiers = linkifiers
+        self.patterns = [
+            re.compile(prepare_linkifier_pattern(linkifier["pattern"])) for linkifier in linkifiers
+        ]
+        # Maps the name of each alternative's group to the linkifier's
+        # index and the names of its own groups.
+        self.alternatives: Dict[str, Tuple[int, List[str]]] = {}
+        self.regex = self.combine()
+
+    def combine(self) -> Optional[Pattern[str]]:
+        alternatives = []
+        for i, (linkifier, pattern) in enumerate(zip(self.linkifiers, self.patterns)):
+            if UNCOMBINABLE_LINKIFIER_RE.search(linkifier["pattern"]):
+                return None
+
+            name = f"linkifier{i}"
+            group_names = list(pattern.groupindex)
+            renamed, renamed_count = LINKIFIER_GROUP_NAME_RE.subn(
+                lambda m: f"(?P<{name}_{m.group(1)}>", pattern.pattern
+            )
+            # If we renamed something that isn't a group, like text in
+            # a character class that looks like one, give up.
+            if renamed_count != len(group_names):
+                return None
+
+            self.alternatives[name] = (i, group_names)
+            alternatives.append(f"(?P<{name}>{renamed})")
+
+        if not alternatives:
+            return None
+        return re.compile("|".join(alternatives), re.DOTALL | re.UNICODE)
+
+    def might_match(self, text: str) -> bool:
+        if not self.linkifiers:
+            return False
+        if self.regex is None:
+            return True
+        return self.regex.search(text) is not None
+
+    def get_url_and_text(self, m: Match[str]) -> Tuple[str, str]:
+        """Returns the URL and linked text for a match of `regex`."""
+        assert m.lastgroup is not None
+        i, group_names = self.alternatives[m.lastgroup]
+        groups = {group: m.group(f"{m.lastgroup}_{group}") for group in group_names}
+        return self.linkifiers[i]["url_format"] % groups, groups[OUTER_CAPTURE_GROUP]
+
+
+class LinkifierProcessor(CompiledInlineProcessor):
+    """Applies all of the realm's linkifiers, using a LinkifierMatcher."""
+
+    def __init__(self, matcher: LinkifierMatcher, md: markdown.Markdown) -> None:
+        assert matcher.regex is not None
+        self.matcher = matcher
+        super().__init__(matcher.regex, md)
+
+    def handleMatch(  # type: ignore[override] # supertype incompatible with supersupertype
+        self, m: Match[str], data: str
+    ) -> Tuple[Union[Element, str], int, int]:
+        db_data = self.md.zulip_db_data
+        url, text = self.matcher.get_url_and_text(m)
+        return url_to_a(db_data, url, markdown.util.AtomicString(text)), m.start(), m.end()
+
+
 # Given a regular expression pattern, linkifies groups that match it
-# using the provided format string to construct the URL.
+# using the provided format string to construct the URL.  Used when
+# the linkifiers can't be combined into a LinkifierMatcher.
 class LinkifierPattern(markdown.inlinepatterns.Pattern):
     """Applied a given linkifier to the input"""
 
@@ -1988,13 +2083,15 @@ class AlertWordNotificationProcessor(markdown.preprocessors.Preprocessor):
         "`",
     }
 
-    def check_valid_start_position(self, content: str, index: int) -> bool:
-        if index <= 0 or content[index] in self.allowed_before_punctuation:
+    @classmethod
+    def check_valid_start_position(cls, content: str, index: int) -> bool:
+        if index <= 0 or content[index] in cls.allowed_before_punctuation:
             return True
         return False
 
-    def check_valid_end_position(self, content: str, index: int) -> bool:
-        if index >= len(content) or content[index] in self.allowed_after_punctuation:
+    @classmethod
+    def check_valid_end_position(cls, content: str, index: int) -> bool:
+        if index >= len(content) or content[index] in cls.allowed_after_punctuation:
             return True
         return False
 
@@ -2007,20 +2104,31 @@ class AlertWordNotificationProcessor(markdown.preprocessors.Preprocessor):
             # Our caller passes in the list of possible_words.  We
             # don't do any special rendering; we just append the alert words
             # we find to the set self.md.zulip_rendering_result.user_ids_with_alert_words.
+            content = "\n".join(lines).lower()
+            # Saved for the rendered Markdown cache, so that we can
+            # find alert words without rendering the content again.
+            self.md.zulip_alert_word_content = content
 
             realm_alert_words_automaton = db_data["realm_alert_words_automaton"]
 
             if realm_alert_words_automaton is not None:
-                content = "\n".join(lines).lower()
-                for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(
-                    content
-                ):
-                    if self.check_valid_start_position(
-                        content, end_index - len(original_value)
-                    ) and self.check_valid_end_position(content, end_index + 1):
-                        self.md.zulip_rendering_result.user_ids_with_alert_words.update(user_ids)
+                self.md.zulip_rendering_result.user_ids_with_alert_words.update(
+                    self.find_alert_word_user_ids(realm_alert_words_automaton, content)
+                )
         return lines
 
+    @classmethod
+    def find_alert_word_user_ids(
+        cls, realm_alert_words_automaton: ahocorasick.Automaton, content: str
+    ) -> Set[int]:
+        user_ids_with_alert_words: Set[int] = set()
+        for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(content):
+            if cls.check_valid_start_position(
+                content, end_index - len(original_value)
+            ) and cls.check_valid_end_position(content, end_index + 1):
+                user_ids_with_alert_words.update(user_ids)
+        return user_ids_with_alert_words
+
 
 class LinkInlineProcessor(markdown.inlinepatterns.LinkInlineProcessor):
     def zulip_specific_link_changes(self, el: Element) -> Union[None, Element]:
@@ -2083,6 +2191,8 @@ class Markdown(markdown.Markdown):
     zulip_realm: Optional[Realm]
     zulip_db_data: Optional[DbData]
     zulip_rendering_result: Optional[MessageRenderingResult]
+    zulip_rendering_cacheable: bool
+    zulip_alert_word_content: Optional[str]
     image_preview_enabled: bool
     url_embed_preview_enabled: bool
 
@@ -2242,6 +2352,14 @@ class Markdown(markdown.Markdown):
         return reg
 
     def register_linkifiers(self, inlinePatterns: markdown.util.Registry) -> markdown.util.Registry:
+        if not self.linkifiers:
+            return inlinePatterns
+
+        matcher = LinkifierMatcher(self.linkifiers)
+        if matcher.regex is not None:
+            inlinePatterns.register(LinkifierProcessor(matcher, self), "linkifiers", 45)
+            return inlinePatterns
+
         for linkifier in self.linkifiers:
             pattern = linkifier["pattern"]
             inlinePatterns.register(
@@ -2316,19 +2434,33 @@ def make_md_engine(linkifiers_key: int, email_gateway: bool) -> None:
 # our common single link matching regex on it.
 basic_link_splitter = re.compile(r"[ !;\?\),\'\"]")
 
+linkifier_matchers: Dict[int, LinkifierMatcher] = {}
+
+
+def get_linkifier_matcher(linkifiers_key: int) -> LinkifierMatcher:
+    linkifiers = linkifiers_for_realm(linkifiers_key)
+    matcher = linkifier_matchers.get(linkifiers_key)
+    if matcher is None or matcher.linkifiers != linkifiers:
+        matcher = LinkifierMatcher(linkifiers)
+        linkifier_matchers[linkifiers_key] = matcher
+    return matcher
+
+
 # Security note: We don't do any HTML escaping in this
 # function on the URLs; they are expected to be HTML-escaped when
 # rendered by clients (just as links rendered into message bodies
 # are validated and escaped inside `url_to_a`).
 def topic_links(linkifiers_key: int, topic_name: str) -> List[Dict[str, str]]:
     matches: List[Dict[str, Union[str, int]]] = []
-    linkifiers = linkifiers_for_realm(linkifiers_key)
+    matcher = get_linkifier_matcher(linkifiers_key)
 
-    for linkifier in linkifiers:
-        raw_pattern = linkifier["pattern"]
+    # Unlike in message content, every match of every linkifier is
+    # linked in topics, even if they overlap; so we only use the
+    # combined regex to skip the linkifiers when none can match.
+    linkifiers = matcher.linkifiers if matcher.might_match(topic_name) else []
+    for linkifier, pattern in zip(linkifiers, matcher.patterns):
         url_format_string = linkifier["url_format"]
-        pattern = prepare_linkifier_pattern(raw_pattern)
-        for m in re.finditer(pattern, topic_name):
+        for m in pattern.finditer(topic_name):
             match_details = m.groupdict()
             match_text = match_details[OUTER_CAPTURE_GROUP]
             # We format the linkifier's url string using the matched text.
@@ -2396,6 +2528,91 @@ def privacy_clean_markdown(content: str) -> str:
     return repr(_privacy_re.sub("x", content))
 
 
+# Bots and integrations often send the same content repeatedly, so we
+# cache the results of rendering message content.  The cache key covers
+# everything that rendering depends on: the content, the engine's
+# linkifiers, and the data we fetch from the database for mentions,
+# stream links, and custom emoji.  Renderings that depend on data from
+# third-party sites (e.g. URL previews) are never cached.
+#
+# Since the set of alert words a message matches isn't stored in the
+# rendered HTML, we store the text the AlertWordNotificationProcessor
+# scanned and search it for the current alert words on a cache hit.
+RENDERED_MARKDOWN_CACHE_TIMEOUT = 3600 * 24
+
+
+def rendered_markdown_cache_key(
+    content: str,
+    md_engine_key: Tuple[int, bool],
+    db_data: DbData,
+    image_preview: bool,
+    url_embed_preview: bool,
+    default_code_block_language: Optional[str],
+) -> str:
+    signature = orjson.dumps(
+        [
+            version,
+            content,
+            md_engine_key,
+            linkifier_data[md_engine_key[0]],
+            db_data["realm_uri"],
+            db_data["active_realm_emoji"],
+            db_data["mention_data"].signature(),
+            db_data["stream_names"],
+            db_data["sent_by_bot"],
+            db_data["translate_emoticons"],
+            image_preview,
+            url_embed_preview,
+            default_code_block_language,
+        ],
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return f"rendered_markdown:{hashlib.sha256(signature).hexdigest()}"
+
+
+def rendering_result_cache_value(
+    rendering_result: MessageRenderingResult, message: Message, alert_word_content: str
+) -> Dict[str, Any]:
+    return dict(
+        rendered_content=rendering_result.rendered_content,
+        mentions_wildcard=rendering_result.mentions_wildcard,
+        mentions_user_ids=rendering_result.mentions_user_ids,
+        mentions_user_group_ids=rendering_result.mentions_user_group_ids,
+        alert_words=rendering_result.alert_words,
+        links_for_preview=rendering_result.links_for_preview,
+        potential_attachment_path_ids=rendering_result.potential_attachment_path_ids,
+        has_link=message.has_link,
+        has_image=message.has_image,
+        alert_word_content=alert_word_content,
+    )
+
+
+def rendering_result_from_cache(
+    cached: Dict[str, Any],
+    message: Message,
+    realm_alert_words_automaton: Optional[ahocorasick.Automaton],
+) -> MessageRenderingResult:
+    message.has_link = cached["has_link"]
+    message.has_image = cached["has_image"]
+
+    user_ids_with_alert_words: Set[int] = set()
+    if realm_alert_words_automaton is not None:
+        user_ids_with_alert_words = AlertWordNotificationProcessor.find_alert_word_user_ids(
+            realm_alert_words_automaton, cached["alert_word_content"]
+        )
+
+    return MessageRenderingResult(
+        rendered_content=cached["rendered_content"],
+        mentions_wildcard=cached["mentions_wildcard"],
+        mentions_user_ids=set(cached["mentions_user_ids"]),
+        mentions_user_group_ids=set(cached["mentions_user_group_ids"]),
+        alert_words=set(cached["alert_words"]),
+        links_for_preview=set(cached["links_for_preview"]),
+        user_ids_with_alert_words=user_ids_with_alert_words,
+        potential_attachment_path_ids=list(cached["potential_attachment_path_ids"]),
+    )
+
+
 def do_convert(
     content: str,
     realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
@@ -2450,16 +2667,11 @@ def do_convert(
         potential_attachment_path_ids=[],
     )
 
-    _md_engine.zulip_message = message
-    _md_engine.zulip_rendering_result = rendering_result
-    _md_engine.zulip_realm = message_realm
-    _md_engine.zulip_db_data = None  # for now
-    _md_engine.image_preview_enabled = image_preview_enabled(message, message_realm, no_previews)
-    _md_engine.url_embed_preview_enabled = url_embed_preview_enabled(
-        message, message_realm, no_previews
-    )
+    image_preview = image_preview_enabled(message, message_realm, no_previews)
+    url_embed_preview = url_embed_preview_enabled(message, message_realm, no_previews)
 
     # Pre-fetch data from the DB that is used in the Markdown thread
+    db_data: Optional[DbData] = None
     if message_realm is not None:
 
         # Here we fetch the data structures needed to render
@@ -2479,7 +2691,7 @@ def do_convert(
         else:
             active_realm_emoji = {}
 
-        _md_engine.zulip_db_data = {
+        db_data = {
             "realm_alert_words_automaton": realm_alert_words_automaton,
             "mention_data": mention_data,
             "active_realm_emoji": active_realm_emoji,
@@ -2489,6 +2701,32 @@ def do_convert(
             "translate_emoticons": translate_emoticons,
         }
 
+    cache_key = None
+    if settings.RENDERED_MARKDOWN_CACHE and message is not None and db_data is not None:
+        assert message_realm is not None
+        cache_key = rendered_markdown_cache_key(
+            content,
+            md_engine_key,
+            db_data,
+            image_preview,
+            url_embed_preview,
+            message_realm.default_code_block_language,
+        )
+        cached = cache_get(cache_key)
+        if cached is not None:
+            statsd.incr("markdown.render_cache.hit")
+            return rendering_result_from_cache(cached[0], message, realm_alert_words_automaton)
+        statsd.incr("markdown.render_cache.miss")
+
+    _md_engine.zulip_message = message
+    _md_engine.zulip_rendering_result = rendering_result
+    _md_engine.zulip_realm = message_realm
+    _md_engine.zulip_db_data = db_data
+    _md_engine.image_preview_enabled = image_preview
+    _md_engine.url_embed_preview_enabled = url_embed_preview
+    _md_engine.zulip_rendering_cacheable = True
+    _md_engine.zulip_alert_word_content = None
+
     try:
         # Spend at most 5 seconds rendering; this protects the backend
         # from being overloaded by bugs (e.g. Markdown logic that is
@@ -2505,6 +2743,20 @@ def do_convert(
             raise MarkdownRenderingException(
                 f"Rendered content exceeds {MAX_MESSAGE_LENGTH * 100} characters (message {logging_message_id})"
             )
+
+        if (
+            cache_key is not None
+            and _md_engine.zulip_rendering_cacheable
+            and _md_engine.zulip_alert_word_content is not None
+        ):
+            assert message is not None
+            cache_set(
+                cache_key,
+                rendering_result_cache_value(
+                    rendering_result, message, _md_engine.zulip_alert_word_content
+                ),
+                timeout=RENDERED_MARKDOWN_CACHE_TIMEOUT,
+            )
         return rendering_result
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -2525,6 +2777,7 @@ def do_convert(
         _md_engine.zulip_message = None
         _md_engine.zulip_realm = None
         _md_engine.zulip_db_data = None
+        _md_engine.zulip_alert_word_content = None
 
 
 markdown_time_start = 0.0
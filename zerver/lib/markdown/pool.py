@@ -0,0 +1,95 @@
+# Rendering Markdown for many messages at once, using a pool of worker
+# processes.
+#
+# Markdown rendering is CPU-bound pure Python, so bulk operations (like
+# importing a realm) that render messages one at a time only use a
+# single core.  MarkdownRenderingPool forks a set of worker processes
+# once, up front, and then distributes batches of messages among them.
+# Each worker keeps its own md_engines, so rendering reuses a warm
+# Markdown engine for the realm's linkifiers, just like a long-lived
+# server process does.
+import multiprocessing
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.core.cache import cache
+from django.db import connection
+
+from zerver.lib.markdown import markdown_convert, maybe_update_markdown_engines
+from zerver.models import Realm
+
+# (content, sent_by_bot, translate_emoticons)
+MarkdownRenderingRequest = Tuple[str, bool, bool]
+
+# The realm that a worker process renders messages for; set by
+# init_worker when the worker process starts.
+worker_realm: Optional[Realm] = None
+
+
+def render_markdown_for_realm(realm: Realm, request: MarkdownRenderingRequest) -> Optional[str]:
+    content, sent_by_bot, translate_emoticons = request
+    try:
+        return markdown_convert(
+            content=content,
+            message_realm=realm,
+            sent_by_bot=sent_by_bot,
+            translate_emoticons=translate_emoticons,
+        ).rendered_content
+    except Exception:
+        # markdown_convert has already logged the exception.
+        return None
+
+
+def init_worker(realm_id: int) -> None:
+    global worker_realm
+    worker_realm = Realm.objects.get(id=realm_id)
+    # Build the Markdown engine before the first batch arrives.
+    maybe_update_markdown_engines(realm_id, False)
+
+
+def render_in_worker(request: MarkdownRenderingRequest) -> Optional[str]:
+    assert worker_realm is not None
+    return render_markdown_for_realm(worker_realm, request)
+
+
+class MarkdownRenderingPool:
+    """Renders the Markdown content of messages from a single realm,
+    without alert words, in `processes` worker processes.  Use it as a
+    context manager:
+
+        with MarkdownRenderingPool(realm, processes) as pool:
+            rendered = pool.render(requests)
+
+    render returns the rendered content for each request, in order, or
+    None where rendering failed.  With processes=1, messages are
+    rendered in this process, with no pool."""
+
+    # Large enough to amortize the IPC cost of each batch, while
+    # still spreading small batches across the workers.
+    chunksize = 50
+
+    def __init__(self, realm: Realm, processes: int) -> None:
+        self.realm = realm
+        self.processes = processes
+        self.pool: Optional[Any] = None
+
+    def __enter__(self) -> "MarkdownRenderingPool":
+        if self.processes > 1:
+            # The workers must not share our database and memcached
+            # connections; they'll each open their own.
+            connection.close()
+            cache._cache.disconnect_all()
+            self.pool = multiprocessing.Pool(
+                self.processes, initializer=init_worker, initargs=(self.realm.id,)
+            )
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def render(self, requests: Sequence[MarkdownRenderingRequest]) -> List[Optional[str]]:
+        if self.pool is None:
+            return [render_markdown_for_realm(self.realm, request) for request in requests]
+        return list(self.pool.imap(render_in_worker, requests, chunksize=self.chunksize))
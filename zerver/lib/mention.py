@@ -1,8 +1,10 @@
+import copy
 import functools
 import re
 from collections import defaultdict
-from typing import Dict, List, Match, Optional, Set, Tuple
+from typing import Any, Dict, List, Match, Optional, Set, Tuple
 
+import lxml.html
 from django.db.models import Q
 
 from zerver.lib.types import FullNameInfo
@@ -44,7 +46,9 @@ def possible_user_group_mentions(content: str) -> Set[str]:
     return {m.group("match") for m in USER_GROUP_MENTIONS_RE.finditer(content)}
 
 
-def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[FullNameInfo]:
+def get_possible_mentions_info(
+    realm_id: int, mention_texts: Set[str], include_deactivated_users: bool = False
+) -> List[FullNameInfo]:
     if not mention_texts:
         return []
 
@@ -67,19 +71,13 @@ def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[F
             # For **name** syntax.
             q_list.add(Q(full_name__iexact=mention_text))
 
-    rows = (
-        UserProfile.objects.filter(
-            realm_id=realm_id,
-            is_active=True,
-        )
-        .filter(
-            functools.reduce(lambda a, b: a | b, q_list),
-        )
-        .values(
-            "id",
-            "full_name",
-            "email",
-        )
+    users = UserProfile.objects.filter(realm_id=realm_id)
+    if not include_deactivated_users:
+        users = users.filter(is_active=True)
+    rows = users.filter(functools.reduce(lambda a, b: a | b, q_list),).values(
+        "id",
+        "full_name",
+        "email",
     )
     return list(rows)
 
@@ -94,14 +92,31 @@ def get_user_group_name_info(realm_id: int, user_group_names: Set[str]) -> Dict[
 
 
 class MentionData:
-    def __init__(self, realm_id: int, content: str) -> None:
+    def __init__(
+        self, realm_id: int, content: str, include_deactivated_users: bool = False
+    ) -> None:
+        """New messages can only mention active users; pass
+        include_deactivated_users when rendering existing messages
+        again, which may mention users deactivated since."""
         mention_texts, has_wildcards = possible_mentions(content)
-        possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
+        possible_mentions_info = get_possible_mentions_info(
+            realm_id, mention_texts, include_deactivated_users
+        )
         self.full_name_info = {row["full_name"].lower(): row for row in possible_mentions_info}
         self.user_id_info = {row["id"]: row for row in possible_mentions_info}
         self.init_user_group_data(realm_id=realm_id, content=content)
         self.has_wildcards = has_wildcards
 
+    def for_content(self, content: str) -> "MentionData":
+        """Returns a MentionData for one of the messages whose combined
+        content this MentionData was created for; this lets a batch of
+        messages share the database queries.  The result's
+        get_user_ids will include users possibly mentioned in any of
+        the messages, which is fine since it's an overestimate anyway."""
+        mention_data = copy.copy(self)
+        mention_data.has_wildcards = possible_mentions(content)[1]
+        return mention_data
+
     def message_has_wildcards(self) -> bool:
         return self.has_wildcards
 
@@ -146,6 +161,17 @@ class MentionData:
     def get_group_members(self, user_group_id: int) -> List[int]:
         return self.user_group_members.get(user_group_id, [])
 
+    def signature(self) -> List[Any]:
+        """Returns a JSON-serializable summary of the data that
+        rendering mentions depends on, for use in cache keys."""
+        return [
+            sorted(
+                (row["id"], row["full_name"], row["email"]) for row in self.user_id_info.values()
+            ),
+            sorted((group.id, group.name) for group in self.user_group_name_info.values()),
+            self.has_wildcards,
+        ]
+
 
 def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, FullNameInfo]:
     if not stream_names:
@@ -168,3 +194,19 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
 
     dct = {row["name"]: row for row in rows}
     return dct
+
+
+RENDERED_MENTION_CLASSES = ["user-mention", "user-group-mention", "stream", "stream-topic"]
+
+
+def get_rendered_mentions(rendered_content: str) -> List[str]:
+    """Returns the HTML of the user and user group mentions, and the
+    stream and topic links, in the rendered content."""
+    if not rendered_content:
+        return []
+    tree = lxml.html.fromstring(f"<div>{rendered_content}</div>")
+    return [
+        lxml.html.tostring(element, encoding=str, with_tail=False)
+        for element in tree.xpath("//*[@class]")
+        if set(element.get("class").split()) & set(RENDERED_MENTION_CLASSES)
+    ]
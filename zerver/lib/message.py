@@ -39,6 +39,7 @@ from zerver.lib.stream_subscription import (
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.topic import DB_TOPIC_NAME, MESSAGE__TOPIC, TOPIC_LINKS, TOPIC_NAME
 from zerver.lib.topic_mutes import build_topic_mute_checker, topic_is_muted
+from zerver.lib.unread_summary import get_unread_message_rows
 from zerver.models import (
     MAX_TOPIC_NAME_LENGTH,
     Message,
@@ -979,34 +980,20 @@ def get_starred_message_ids(user_profile: UserProfile) -> List[int]:
 
 def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
-
-    user_msgs = (
-        UserMessage.objects.filter(
-            user_profile=user_profile,
-        )
-        .exclude(
-            message__recipient_id__in=excluded_recipient_ids,
-        )
-        .extra(
-            where=[UserMessage.where_unread()],
-        )
-        .values(
-            "message_id",
-            "message__sender_id",
-            MESSAGE__TOPIC,
-            "message__recipient_id",
-            "message__recipient__type",
-            "message__recipient__type_id",
-            "flags",
-        )
-        .order_by("-message_id")
-    )
+    # We fetch one more than we return, to tell whether any unread
+    # messages are missing.
+    rows = get_unread_message_rows(user_profile, excluded_recipient_ids, MAX_UNREAD_MESSAGES + 1)
 
     # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    raw_unread_messages = extract_unread_data_from_um_rows(
+        rows[-MAX_UNREAD_MESSAGES:], user_profile
+    )
 
-    rows = list(reversed(user_msgs))
-    return extract_unread_data_from_um_rows(rows, user_profile)
+    # Record whether the user had more than MAX_UNREAD_MESSAGES total
+    # unreads -- that's a state where Zulip's behavior will start to
+    # be erroneous, and clients should display a warning.
+    raw_unread_messages["old_unreads_missing"] = len(rows) > MAX_UNREAD_MESSAGES
+    return raw_unread_messages
 
 
 def extract_unread_data_from_um_rows(
@@ -1018,7 +1005,6 @@ def extract_unread_data_from_um_rows(
     unmuted_stream_msgs: Set[int] = set()
     huddle_dict: Dict[int, RawUnreadHuddleDict] = {}
     mentions: Set[int] = set()
-    total_unreads = 0
 
     raw_unread_messages: RawUnreadMessagesResult = dict(
         pm_dict=pm_dict,
@@ -1061,7 +1047,6 @@ def extract_unread_data_from_um_rows(
         return user_ids_string
 
     for row in rows:
-        total_unreads += 1
         message_id = row["message_id"]
         msg_type = row["message__recipient__type"]
         recipient_id = row["message__recipient_id"]
@@ -1114,11 +1099,6 @@ def extract_unread_data_from_um_rows(
             else:  # nocoverage # TODO: Test wildcard mentions in PMs.
                 mentions.add(message_id)
 
-    # Record whether the user had more than MAX_UNREAD_MESSAGES total
-    # unreads -- that's a state where Zulip's behavior will start to
-    # be erroneous, and clients should display a warning.
-    raw_unread_messages["old_unreads_missing"] = total_unreads == MAX_UNREAD_MESSAGES
-
     return raw_unread_messages
 
 
@@ -1,5 +1,16 @@
 import os
-from typing import Any, Callable, Collection, Dict, Iterable, List, Mapping, Optional, Sequence
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from django.conf import settings
 from django.utils.translation import gettext as _
@@ -103,3 +114,28 @@ def build_narrow_filter(narrow: Collection[Sequence[str]]) -> Callable[[Mapping[
         return True
 
     return narrow_filter
+
+
+def get_narrow_index_term(narrow: Collection[Sequence[str]]) -> Optional[Tuple[str, str]]:
+    """Returns an (operator, lowercased operand) term that every stream
+    message matched by build_narrow_filter(narrow) must match, or
+    None if there is no such term.  The Tornado event queue code
+    uses this to index narrowed event queues, so that delivering a
+    stream message need not check the narrows of every queue.
+
+    Changes to build_narrow_filter may require changes here."""
+    operands = {
+        element[0]: element[1].lower()
+        for element in narrow
+        if element[0] in ["stream", "sender", "topic"]
+    }
+    # Prefer the terms most likely to be selective.
+    for operator in ["stream", "sender", "topic"]:
+        if operator in operands:
+            return (operator, operands[operator])
+
+    if any(element[0] == "is" and element[1] == "private" for element in narrow):
+        # Stream messages never match these narrows; they're indexed
+        # under a term that no stream message will look up.
+        return ("is", "private")
+    return None
@@ -145,7 +145,7 @@ class SimpleQueueClient:
         queue_name: str,
         callback: Callable[[List[Dict[str, Any]]], None],
         batch_size: int = 1,
-        timeout: Optional[int] = None,
+        timeout: Optional[float] = None,
     ) -> None:
         if batch_size == 1:
             timeout = None
@@ -318,7 +318,7 @@ class TornadoQueueClient(SimpleQueueClient):
         queue_name: str,
         callback: Callable[[List[Dict[str, Any]]], None],
         batch_size: int = 1,
-        timeout: Optional[int] = None,
+        timeout: Optional[float] = None,
     ) -> None:
         def wrapped_consumer(
             ch: BlockingChannel,
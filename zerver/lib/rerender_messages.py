@@ -0,0 +1,80 @@
+# Re-rendering a realm's existing messages after its linkifiers or
+# custom emoji change.
+#
+# Adding or editing a linkifier, or adding a custom emoji, only affects
+# the rendering of messages whose content could use it, which is
+# typically a tiny fraction of the realm's messages.  So rather than
+# rendering every message again, the rerender_messages queue worker
+# scans the realm's messages (newest first, so that the messages users
+# are most likely to look at are updated first) in batches of
+# RERENDER_SCAN_BATCH_SIZE, using a cheap filter on the raw content --
+# the linkifiers' regular expressions, and an Aho-Corasick automaton
+# for the emoji syntax -- to find the messages that might render
+# differently.  Only those are rendered again, and only those whose
+# rendered content actually changed are updated, by
+# do_rerender_messages.
+#
+# Each queue event processes one batch, and then queues an event for
+# the next; the worker sleeps between batches, so that re-rendering a
+# large realm doesn't compete with live traffic for the database.
+#
+# We don't re-render when a linkifier or custom emoji is removed, so
+# existing messages keep the links and (deactivated) emoji they were
+# sent with, as they did before.
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+import ahocorasick
+
+from zerver.lib.actions import do_rerender_messages
+from zerver.models import Message, Realm
+
+RERENDER_SCAN_BATCH_SIZE = 1000
+
+
+def get_rerender_filter(
+    linkifier_patterns: List[str], emoji_names: List[str]
+) -> Callable[[str], bool]:
+    """Returns a function which returns whether a message with the given
+    content might use any of the linkifiers or emoji.  False positives
+    are fine; they just cost a rendering."""
+    linkifier_regexes = [re.compile(pattern) for pattern in linkifier_patterns]
+
+    emoji_automaton: Optional[ahocorasick.Automaton] = None
+    if emoji_names:
+        emoji_automaton = ahocorasick.Automaton()
+        for name in emoji_names:
+            emoji_automaton.add_word(f":{name}:", name)
+        emoji_automaton.make_automaton()
+
+    def might_change(content: str) -> bool:
+        if emoji_automaton is not None and next(emoji_automaton.iter(content), None):
+            return True
+        return any(regex.search(content) for regex in linkifier_regexes)
+
+    return might_change
+
+
+def rerender_messages_batch(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Re-renders the affected messages in the next batch of the realm's
+    messages, and returns the event for the following batch, or None
+    if this was the last one."""
+    realm = Realm.objects.get(id=event["realm_id"])
+    might_change = get_rerender_filter(event["linkifier_patterns"], event["emoji_names"])
+
+    rows = list(
+        Message.objects.filter(sender__realm=realm, id__lt=event["before_message_id"])
+        .order_by("-id")
+        .values_list("id", "content")[:RERENDER_SCAN_BATCH_SIZE]
+    )
+
+    message_ids = [message_id for message_id, content in rows if might_change(content)]
+    if message_ids:
+        messages = Message.objects.select_related("sender", "sending_client").filter(
+            id__in=message_ids
+        )
+        do_rerender_messages(realm, list(messages.order_by("id")))
+
+    if len(rows) < RERENDER_SCAN_BATCH_SIZE:
+        return None
+    return dict(event, before_message_id=rows[-1][0])
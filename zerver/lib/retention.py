@@ -39,6 +39,7 @@ from psycopg2.sql import SQL, Composable, Identifier, Literal
 
 from zerver.lib.logging_util import log_to_file
 from zerver.lib.request import RequestVariableConversionError
+from zerver.lib.unread_summary import refresh_unread_messages
 from zerver.models import (
     ArchivedAttachment,
     ArchivedReaction,
@@ -612,6 +613,7 @@ def restore_data_from_archive(archive_transaction: ArchiveTransaction) -> int:
         restore_models_with_message_key_from_archive(archive_transaction.id)
         restore_attachments_from_archive(archive_transaction.id)
         restore_attachment_messages_from_archive(archive_transaction.id)
+        refresh_unread_messages(msg_ids)
 
         archive_transaction.restored = True
         archive_transaction.save()
@@ -10,6 +10,7 @@ from django.utils.timezone import now as timezone_now
 from sentry_sdk import capture_exception
 
 from zerver.lib.logging_util import log_to_file
+from zerver.lib.unread_summary import invalidate_unread_summaries
 from zerver.models import (
     Message,
     Realm,
@@ -242,6 +243,10 @@ def do_soft_deactivate_user(user_profile: UserProfile) -> None:
         user_profile.last_active_message_id = Message.objects.last().id
     user_profile.long_term_idle = True
     user_profile.save(update_fields=["long_term_idle", "last_active_message_id"])
+    # There's no point maintaining the unread messages of users who
+    # aren't around, and users are soft-reactivated before theirs are
+    # built again, so add_missing_messages doesn't need to update them.
+    invalidate_unread_summaries([user_profile.id])
     logger.info("Soft deactivated user %s", user_profile.id)
 
 
@@ -0,0 +1,158 @@
+# Cache of the per-stream data that get_recipient_info needs to send
+# a message to a stream: the subscription rows for the subscribers
+# who may need to be processed (see get_subscriptions_for_send_message),
+# together with the UserProfile rows for those subscribers.
+#
+# For busy streams, this lets the send path do a single cache lookup
+# rather than several database queries.  Entries are tagged with two
+# versions, which are bumped to invalidate them:
+#
+# * A per-stream version, bumped whenever a subscription to the stream
+#   is added, removed, or changed.
+# * A per-realm version, bumped whenever a user changes one of the
+#   settings in recipient_info_user_fields, or adds or removes an
+#   alert word.
+#
+# Django's bulk operations don't send the signals we use for the
+# common cases, so code that adds or changes subscriptions in bulk
+# must call flush_stream_recipient_info itself.
+import secrets
+from typing import AbstractSet, Any, Dict, List, Tuple
+
+from django.db.models import F, QuerySet
+
+from zerver.lib.cache import (
+    cache_get_many,
+    cache_set_many,
+    realm_recipient_info_version_cache_key,
+    stream_recipient_info_cache_key,
+    stream_recipient_info_version_cache_key,
+)
+from zerver.lib.stream_subscription import (
+    get_active_subscriptions_for_stream_id,
+    get_subscriptions_for_send_message,
+)
+from zerver.models import UserProfile, query_for_ids
+
+# We don't cache recipient info for streams with more than this many
+# subscribers requiring processing; memcached can't store the result.
+STREAM_RECIPIENT_INFO_CACHE_MAX_ROWS = 5000
+
+
+def get_subscription_rows_for_send_message(query: QuerySet) -> List[Dict[str, Any]]:
+    return list(
+        query.annotate(
+            user_profile_email_notifications=F("user_profile__enable_stream_email_notifications"),
+            user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
+            user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
+        )
+        .values(
+            "user_profile_id",
+            "push_notifications",
+            "email_notifications",
+            "wildcard_mentions_notify",
+            "user_profile_email_notifications",
+            "user_profile_push_notifications",
+            "user_profile_wildcard_mentions_notify",
+            "is_muted",
+        )
+        .order_by("user_profile_id")
+    )
+
+
+def get_user_rows_for_send_message(user_ids: AbstractSet[int]) -> List[Dict[str, Any]]:
+    if not user_ids:
+        return []
+
+    query = UserProfile.objects.filter(is_active=True).values(
+        "id",
+        "enable_online_push_notifications",
+        "is_bot",
+        "bot_type",
+        "long_term_idle",
+    )
+
+    # query_for_ids is fast highly optimized for large queries, and we
+    # need this codepath to be fast (it's part of sending messages)
+    query = query_for_ids(
+        query=query,
+        user_ids=sorted(user_ids),
+        field="id",
+    )
+    return list(query)
+
+
+def get_stream_recipient_rows(
+    *,
+    realm_id: int,
+    recipient_id: int,
+    stream_id: int,
+    possibly_mentioned_user_ids: AbstractSet[int],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Returns the subscription rows and UserProfile rows that
+    get_recipient_info needs for a stream message without a possible
+    wildcard mention, reading them from the cache when possible.
+
+    Subscribers who are possibly mentioned but not included in the
+    cached rows (i.e. long_term_idle users who otherwise wouldn't be
+    processed) are fetched from the database separately."""
+    key = stream_recipient_info_cache_key(recipient_id)
+    realm_version_key = realm_recipient_info_version_cache_key(realm_id)
+    stream_version_key = stream_recipient_info_version_cache_key(recipient_id)
+    cached = cache_get_many([key, realm_version_key, stream_version_key])
+    versions = (cached.get(realm_version_key), cached.get(stream_version_key))
+
+    if key in cached and None not in versions and cached[key]["versions"] == versions:
+        subscription_rows = cached[key]["subscription_rows"]
+        user_rows = cached[key]["user_rows"]
+    else:
+        # We must read the versions before querying the database, so
+        # that a concurrent change will leave the versions we store
+        # out of date.
+        subscription_rows = get_subscription_rows_for_send_message(
+            get_subscriptions_for_send_message(
+                realm_id=realm_id,
+                stream_id=stream_id,
+                possible_wildcard_mention=False,
+                possibly_mentioned_user_ids=set(),
+            )
+        )
+        user_rows = get_user_rows_for_send_message(
+            {row["user_profile_id"] for row in subscription_rows}
+        )
+
+        if None in versions:
+            # A version doesn't exist yet (or was evicted); create it,
+            # but don't cache what we just fetched, since we can't know
+            # whether it's current relative to the new version.
+            items: Dict[str, Any] = {}
+            if versions[0] is None:
+                items[realm_version_key] = secrets.token_hex(8)
+            if versions[1] is None:
+                items[stream_version_key] = secrets.token_hex(8)
+            cache_set_many(items)
+        elif len(subscription_rows) <= STREAM_RECIPIENT_INFO_CACHE_MAX_ROWS:
+            cache_set_many(
+                {
+                    key: dict(
+                        versions=versions,
+                        subscription_rows=subscription_rows,
+                        user_rows=user_rows,
+                    )
+                }
+            )
+
+    cached_user_ids = {row["user_profile_id"] for row in subscription_rows}
+    missing_user_ids = possibly_mentioned_user_ids - cached_user_ids
+    if missing_user_ids:
+        extra_rows = get_subscription_rows_for_send_message(
+            get_active_subscriptions_for_stream_id(
+                stream_id, include_deactivated_users=False
+            ).filter(user_profile_id__in=missing_user_ids)
+        )
+        if extra_rows:
+            subscription_rows = sorted(
+                subscription_rows + extra_rows, key=lambda row: row["user_profile_id"]
+            )
+
+    return subscription_rows, user_rows
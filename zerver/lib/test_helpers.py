@@ -457,6 +457,8 @@ def write_instrumentation_reports(full_suite: bool, include_webhooks: bool) -> N
             "api/v1/events",
             "api/v1/events/internal",
             "api/v1/register",
+            "rebalance_tornado_event_queues",
+            "import_tornado_event_queues",
             # We also exempt some development environment debugging
             # static content URLs, since the content they point to may
             # or may not exist.
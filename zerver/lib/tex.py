@@ -1,12 +1,97 @@
 import logging
 import os
 import subprocess
-from typing import Optional
+import threading
+from functools import lru_cache
+from typing import List, Optional
 
+import orjson
 from django.conf import settings
 
 from zerver.lib.storage import static_path
 
+# Rendered TeX is a pure function of its input, so we keep recently
+# rendered formulas in memory; this mostly helps messages that are
+# rendered repeatedly (e.g. edits and previews).
+TEX_CACHE_SIZE = 512
+
+# The number of idle KaTeX processes we keep around for reuse.
+MAX_IDLE_KATEX_SERVERS = 2
+
+
+class KatexServerError(Exception):
+    pass
+
+
+class KatexServer:
+    """A long-lived Node process that renders TeX using KaTeX; see
+    tools/node_lib/katex_server.js for the protocol.  Not thread-safe;
+    get one from the pool with get_katex_server."""
+
+    def __init__(self, katex_path: str) -> None:
+        self.katex_path = katex_path
+        # A forked child process mustn't use its parent's pipes.
+        self.pid = os.getpid()
+        self.process = subprocess.Popen(
+            ["node", katex_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def render(self, tex: str, is_inline: bool) -> Optional[str]:
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        self.process.stdin.write(orjson.dumps({"tex": tex, "display_mode": not is_inline}) + b"\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise KatexServerError("KaTeX server exited unexpectedly")
+        return orjson.loads(line).get("html")
+
+    def close(self) -> None:
+        self.process.kill()
+        self.process.wait()
+
+
+idle_katex_servers: List[KatexServer] = []
+idle_katex_servers_lock = threading.Lock()
+
+
+def get_katex_server(katex_path: str) -> KatexServer:
+    with idle_katex_servers_lock:
+        while idle_katex_servers:
+            server = idle_katex_servers.pop()
+            if server.pid != os.getpid():
+                continue
+            if server.katex_path == katex_path:
+                return server
+            server.close()
+    return KatexServer(katex_path)
+
+
+def release_katex_server(server: KatexServer) -> None:
+    with idle_katex_servers_lock:
+        if len(idle_katex_servers) < MAX_IDLE_KATEX_SERVERS:
+            idle_katex_servers.append(server)
+            return
+    server.close()
+
+
+@lru_cache(maxsize=TEX_CACHE_SIZE)
+def render_tex_with_katex_server(katex_path: str, tex: str, is_inline: bool) -> Optional[str]:
+    server = get_katex_server(katex_path)
+    try:
+        rendered = server.render(tex, is_inline)
+    except BaseException:
+        # We may have been interrupted (e.g. by the Markdown
+        # processor's timeout) with a response still pending, so
+        # this process can't be reused.
+        server.close()
+        raise
+    release_katex_server(server)
+    return rendered
+
 
 def render_tex(tex: str, is_inline: bool = True) -> Optional[str]:
     r"""Render a TeX string into HTML using KaTeX
@@ -23,21 +108,15 @@ def render_tex(tex: str, is_inline: bool = True) -> Optional[str]:
     """
 
     katex_path = (
-        static_path("webpack-bundles/katex-cli.js")
+        static_path("webpack-bundles/katex-server.js")
         if settings.PRODUCTION
-        else os.path.join(settings.DEPLOY_ROOT, "node_modules/katex/cli.js")
+        else os.path.join(settings.DEPLOY_ROOT, "tools/node_lib/katex_server.js")
     )
     if not os.path.isfile(katex_path):
         logging.error("Cannot find KaTeX for latex rendering!")
         return None
-    command = ["node", katex_path]
-    if not is_inline:
-        command.extend(["--display-mode"])
     try:
-        stdout = subprocess.check_output(
-            command, input=tex, stderr=subprocess.DEVNULL, universal_newlines=True
-        )
-        # stdout contains a newline at the end
-        return stdout.strip()
-    except subprocess.CalledProcessError:
+        return render_tex_with_katex_server(katex_path, tex, is_inline)
+    except (OSError, ValueError, KatexServerError):
+        logging.exception("Error communicating with the KaTeX server")
         return None
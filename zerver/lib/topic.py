@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional
 
 import orjson
 from django.db import connection
@@ -201,46 +201,31 @@ def update_messages_for_topic_edit(
     return messages_list
 
 
-def generate_topic_history_from_db_rows(rows: List[Tuple[str, int]]) -> List[Dict[str, Any]]:
-    canonical_topic_names: Dict[str, Tuple[int, str]] = {}
-
-    # Sort rows by max_message_id so that if a topic
-    # has many different casings, we use the most
-    # recent row.
-    rows = sorted(rows, key=lambda tup: tup[1])
-
-    for (topic_name, max_message_id) in rows:
-        canonical_name = topic_name.lower()
-        canonical_topic_names[canonical_name] = (max_message_id, topic_name)
-
-    history = []
-    for canonical_topic, (max_message_id, topic_name) in canonical_topic_names.items():
-        history.append(
-            dict(name=topic_name, max_id=max_message_id),
-        )
-    return sorted(history, key=lambda x: -x["max_id"])
-
-
 def get_topic_history_for_public_stream(recipient_id: int) -> List[Dict[str, Any]]:
+    # Messages sent to a topic while another transaction was sending
+    # to it may not have been folded into its StreamTopic row yet.
     cursor = connection.cursor()
     query = """
-    SELECT
-        "zerver_message"."subject" as topic,
-        max("zerver_message".id) as max_message_id
-    FROM "zerver_message"
-    WHERE (
-        "zerver_message"."recipient_id" = %s
-    )
-    GROUP BY (
-        "zerver_message"."subject"
-    )
-    ORDER BY max("zerver_message".id) DESC
+    SELECT topic_name, last_message_id FROM (
+        SELECT DISTINCT ON (topic_upper) topic_name, last_message_id
+        FROM (
+            SELECT topic_upper, topic_name, last_message_id
+            FROM "zerver_streamtopic"
+            WHERE recipient_id = %s
+            UNION ALL
+            SELECT topic_upper, topic_name, last_message_id
+            FROM "zerver_streamtopiclog"
+            WHERE recipient_id = %s
+        ) AS topics
+        ORDER BY topic_upper, last_message_id DESC
+    ) AS topics
+    ORDER BY last_message_id DESC
     """
-    cursor.execute(query, [recipient_id])
+    cursor.execute(query, [recipient_id, recipient_id])
     rows = cursor.fetchall()
     cursor.close()
 
-    return generate_topic_history_from_db_rows(rows)
+    return [dict(name=topic_name, max_id=max_message_id) for topic_name, max_message_id in rows]
 
 
 def get_topic_history_for_stream(
@@ -249,26 +234,29 @@ def get_topic_history_for_stream(
     if public_history:
         return get_topic_history_for_public_stream(recipient_id)
 
+    # Topics are grouped by upper(subject), as in StreamTopic, and
+    # named by their most recent message, so that this matches
+    # get_topic_history_for_public_stream for the same messages.
     cursor = connection.cursor()
     query = """
-    SELECT
-        "zerver_message"."subject" as topic,
-        max("zerver_message".id) as max_message_id
-    FROM "zerver_message"
-    INNER JOIN "zerver_usermessage" ON (
-        "zerver_usermessage"."message_id" = "zerver_message"."id"
-    )
-    WHERE (
-        "zerver_usermessage"."user_profile_id" = %s AND
-        "zerver_message"."recipient_id" = %s
-    )
-    GROUP BY (
-        "zerver_message"."subject"
-    )
-    ORDER BY max("zerver_message".id) DESC
+    SELECT topic, max_message_id FROM (
+        SELECT DISTINCT ON (upper("zerver_message"."subject"))
+            "zerver_message"."subject" as topic,
+            "zerver_message".id as max_message_id
+        FROM "zerver_message"
+        INNER JOIN "zerver_usermessage" ON (
+            "zerver_usermessage"."message_id" = "zerver_message"."id"
+        )
+        WHERE (
+            "zerver_usermessage"."user_profile_id" = %s AND
+            "zerver_message"."recipient_id" = %s
+        )
+        ORDER BY upper("zerver_message"."subject"), "zerver_message".id DESC
+    ) AS topics
+    ORDER BY max_message_id DESC
     """
     cursor.execute(query, [user_profile.id, recipient_id])
     rows = cursor.fetchall()
     cursor.close()
 
-    return generate_topic_history_from_db_rows(rows)
+    return [dict(name=topic_name, max_id=max_message_id) for topic_name, max_message_id in rows]
@@ -0,0 +1,292 @@
+# Maintaining each user's unread messages, with the fields needed to
+# group them by conversation.
+#
+# When a client registers an event queue, we send it the IDs of the
+# user's most recent unread messages, grouped by conversation.
+# Computing that from the user's unread UserMessage rows, joined with
+# their Message rows, is one of our most expensive queries for users
+# with a large backlog of unread messages.  So we also store each
+# unread message in an UnreadMessage row, with its recipient, topic,
+# and sender, and keep those up to date as messages are sent, marked
+# as read or unread, edited, moved, deleted, and restored; fetching a
+# user's most recent unread messages then reads only that many rows,
+# in order, from a single index.  The rows are only ever inserted and
+# deleted (besides being deleted along with their message), so none
+# of this rewrites other messages' rows.
+#
+# A user's rows are built from their UserMessage rows the first time
+# they're needed (see get_unread_message_rows), and are only
+# maintained from then on; the UnreadSummary row for a user records
+# that their rows are complete.  Code that creates or changes
+# UserMessage rows in bulk, without going through the functions here,
+# must call invalidate_unread_summaries, so that the affected users'
+# rows are built again.
+#
+# A message sent to a user while their rows are being built would be
+# missed if the sender's transaction couldn't yet see the new
+# UnreadSummary row, and the build couldn't yet see the sender's
+# UserMessage row.  So building locks the UserProfile row FOR UPDATE,
+# and the statements here that add to users' rows are preceded by a
+# statement that locks the users' UserProfile rows FOR KEY SHARE
+# (which the deferred foreign key checks on the new UserMessage rows
+# take at commit anyway): each sender either finishes before the
+# build reads the UserMessage rows, or only adds to the user's rows
+# once the build has committed.
+from typing import Any, Collection, Dict, List, Optional
+
+from django.db import connection, transaction
+from psycopg2.sql import SQL, Composable
+
+from zerver.lib.topic import MESSAGE__TOPIC
+from zerver.models import UnreadMessage, UnreadSummary, UserMessage, UserProfile
+
+# Adds the messages to the affected users' rows; {source} must provide
+# user_profile_id and message_id columns.  Rows are inserted in a
+# consistent order, so that concurrent inserts of the same rows (which
+# wait for each other) can't deadlock.
+ADD_UNREAD_MESSAGES_QUERY = """
+    INSERT INTO zerver_unreadmessage
+        (user_profile_id, message_id, recipient_id, topic, sender_id)
+    SELECT
+        source.user_profile_id,
+        zerver_message.id,
+        zerver_message.recipient_id,
+        zerver_message.subject,
+        zerver_message.sender_id
+    FROM {source}
+    JOIN zerver_message ON zerver_message.id = source.message_id
+    {summary_join}
+    ORDER BY source.user_profile_id, zerver_message.id
+    ON CONFLICT (user_profile_id, message_id) DO NOTHING
+"""
+
+# We only maintain the rows of users whose rows are complete.
+SUMMARY_JOIN = """
+    JOIN zerver_unreadsummary
+        ON zerver_unreadsummary.user_profile_id = source.user_profile_id
+"""
+
+# Waits for any build of the users' rows to finish (see above); this
+# must be a separate statement from the one adding to their rows, so
+# that that one sees the UnreadSummary rows committed by the builds.
+# {source} must provide a user_profile_id column.
+LOCK_USERS_QUERY = """
+    SELECT zerver_userprofile.id
+    FROM zerver_userprofile
+    WHERE zerver_userprofile.id IN (SELECT source.user_profile_id FROM {source})
+    ORDER BY zerver_userprofile.id
+    FOR KEY SHARE
+"""
+
+
+def get_lock_users_query(source: Composable) -> Composable:
+    return SQL(LOCK_USERS_QUERY).format(source=source)
+
+
+def get_add_unread_messages_query(
+    source: Composable, only_summarized_users: bool = True
+) -> Composable:
+    return SQL(ADD_UNREAD_MESSAGES_QUERY).format(
+        source=source, summary_join=SQL(SUMMARY_JOIN if only_summarized_users else "")
+    )
+
+
+def execute_add_unread_messages(
+    source: Composable, params: Dict[str, Any], only_summarized_users: bool = True
+) -> None:
+    query = get_add_unread_messages_query(source, only_summarized_users)
+    if only_summarized_users:
+        # Both statements are sent in a single round trip.
+        query = SQL("{lock_users};\n{query}").format(
+            lock_users=get_lock_users_query(source), query=query
+        )
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+
+def add_unread_messages(user_profile_ids: List[int], message_ids: List[int]) -> None:
+    """Records that each user has the message at the same index unread.
+    Use this for newly created UserMessage rows (bulk_insert_ums does
+    this itself)."""
+    if not user_profile_ids:
+        return
+    source = SQL(
+        """
+        unnest(%(user_profile_ids)s::integer[], %(message_ids)s::integer[])
+            AS source(user_profile_id, message_id)
+    """
+    )
+    execute_add_unread_messages(
+        source, dict(user_profile_ids=user_profile_ids, message_ids=message_ids)
+    )
+
+
+def remove_unread_messages(
+    message_ids: Collection[int], user_profile: Optional[UserProfile] = None
+) -> None:
+    """Removes the messages from the user's rows (or everyone's, if
+    user_profile is None), e.g. because they were marked as read."""
+    if not message_ids:
+        return
+    rows = UnreadMessage.objects.filter(message_id__in=message_ids)
+    if user_profile is not None:
+        rows = rows.filter(user_profile=user_profile)
+    rows.delete()
+
+
+def refresh_unread_messages(
+    message_ids: Collection[int], user_profile: Optional[UserProfile] = None
+) -> None:
+    """Brings the entries for the messages in the user's rows (or
+    everyone's, if user_profile is None) up to date with their
+    UserMessage rows, after the messages were marked as unread, or
+    moved to another topic or stream, or some of their UserMessage
+    rows were created or deleted."""
+    if not message_ids:
+        return
+    with transaction.atomic():
+        remove_unread_messages(message_ids, user_profile)
+
+        params: Dict[str, Any] = dict(message_ids=list(message_ids))
+        user_filter = SQL("")
+        if user_profile is not None:
+            user_filter = SQL("AND user_profile_id = %(user_profile_id)s")
+            params["user_profile_id"] = user_profile.id
+        source = SQL(
+            """
+            (
+                SELECT user_profile_id, message_id
+                FROM zerver_usermessage
+                WHERE message_id = ANY(%(message_ids)s)
+                    AND (flags & 1) = 0
+                    {user_filter}
+            ) AS source
+        """
+        ).format(user_filter=user_filter)
+        execute_add_unread_messages(source, params)
+
+
+def clear_unread_messages(user_profile: UserProfile) -> None:
+    """Removes all of the user's unread messages, because they were all
+    marked as read."""
+    UnreadMessage.objects.filter(user_profile=user_profile).delete()
+
+
+def invalidate_unread_summaries(user_profile_ids: Collection[int]) -> None:
+    """Discards the users' rows, so that they're built again from their
+    UserMessage rows the next time they're needed."""
+    with transaction.atomic():
+        UnreadSummary.objects.filter(user_profile_id__in=user_profile_ids).delete()
+        UnreadMessage.objects.filter(user_profile_id__in=user_profile_ids).delete()
+
+
+# Builds the user's rows if they haven't been built yet, and then
+# fetches their most recent unread messages, in a single round trip.
+# The first statement only locks the user (see above) if their rows
+# haven't been built; if someone else builds them while we wait for
+# the lock, our UnreadSummary row conflicts with theirs, and so we
+# don't add any rows.  Each statement sees the rows committed before
+# it started, which is why these are separate statements.
+FETCH_UNREAD_MESSAGES_QUERY = """
+    SELECT zerver_userprofile.id
+    FROM zerver_userprofile
+    WHERE zerver_userprofile.id = %(user_profile_id)s
+        AND NOT EXISTS (
+            SELECT 1
+            FROM zerver_unreadsummary
+            WHERE zerver_unreadsummary.user_profile_id = %(user_profile_id)s
+        )
+    FOR UPDATE;
+
+    WITH summary AS (
+        INSERT INTO zerver_unreadsummary (user_profile_id)
+        SELECT %(user_profile_id)s
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM zerver_unreadsummary
+            WHERE zerver_unreadsummary.user_profile_id = %(user_profile_id)s
+        )
+        ON CONFLICT (user_profile_id) DO NOTHING
+        RETURNING user_profile_id
+    )
+    {add_unread_messages};
+
+    SELECT
+        zerver_unreadmessage.message_id,
+        zerver_unreadmessage.sender_id,
+        zerver_unreadmessage.topic,
+        zerver_unreadmessage.recipient_id,
+        zerver_recipient.type,
+        zerver_recipient.type_id
+    FROM zerver_unreadmessage
+    JOIN zerver_recipient ON zerver_recipient.id = zerver_unreadmessage.recipient_id
+    WHERE zerver_unreadmessage.user_profile_id = %(user_profile_id)s
+        AND zerver_unreadmessage.recipient_id <> ALL(%(excluded_recipient_ids)s::integer[])
+    ORDER BY zerver_unreadmessage.message_id DESC
+    LIMIT %(limit)s
+"""
+
+
+def get_unread_message_rows(
+    user_profile: UserProfile, excluded_recipient_ids: Collection[int], limit: int
+) -> List[Dict[str, Any]]:
+    """Returns a row for each of the user's `limit` most recent unread
+    messages, outside the excluded recipients, in the format of a
+    UserMessage values() query (see extract_unread_data_from_um_rows),
+    ordered by message ID."""
+    # The uncorrelated EXISTS is evaluated once, so once the user's
+    # rows are built, their UserMessage rows aren't scanned at all.
+    source = SQL(
+        """
+        (
+            SELECT user_profile_id, message_id
+            FROM zerver_usermessage
+            WHERE user_profile_id = %(user_profile_id)s
+                AND (flags & 1) = 0
+                AND EXISTS (SELECT 1 FROM summary)
+        ) AS source
+    """
+    )
+    query = SQL(FETCH_UNREAD_MESSAGES_QUERY).format(
+        add_unread_messages=get_add_unread_messages_query(source, only_summarized_users=False)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            query,
+            dict(
+                user_profile_id=user_profile.id,
+                excluded_recipient_ids=list(excluded_recipient_ids),
+                limit=limit,
+            ),
+        )
+        unread_messages = cursor.fetchall()
+
+    # The only flags that matter for unread messages are the mention
+    # flags, which are rarely set, and can change when a message is
+    # edited; so rather than storing them, we fetch the unread
+    # mentions using their partial index.
+    mention_flags = dict(
+        UserMessage.objects.filter(user_profile=user_profile)
+        .extra(where=[UserMessage.where_unread(), UserMessage.where_mentioned()])
+        .values_list("message_id", "flags")
+    )
+
+    return [
+        {
+            "message_id": message_id,
+            "message__sender_id": sender_id,
+            MESSAGE__TOPIC: topic,
+            "message__recipient_id": recipient_id,
+            "message__recipient__type": recipient_type,
+            "message__recipient__type_id": recipient_type_id,
+            "flags": mention_flags.get(message_id, 0),
+        }
+        for (
+            message_id,
+            sender_id,
+            topic,
+            recipient_id,
+            recipient_type,
+            recipient_type_id,
+        ) in reversed(unread_messages)
+    ]
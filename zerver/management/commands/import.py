@@ -48,7 +48,8 @@ import a database dump from one or more JSON files."""
         parser.add_argument(
             "--processes",
             default=settings.DEFAULT_DATA_EXPORT_IMPORT_PARALLELISM,
-            help="Number of processes to use for uploading Avatars to S3 in parallel",
+            help="Number of processes to use for uploading Avatars to S3 "
+            "and rendering message content in parallel",
         )
         parser.formatter_class = argparse.RawTextHelpFormatter
 
@@ -0,0 +1,56 @@
+from argparse import ArgumentParser
+from typing import Any
+
+import orjson
+from django.conf import settings
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Realm
+from zerver.tornado.django_api import requests_client
+from zerver.tornado.sharding import get_tornado_ports_for_host, get_tornado_uri_for_port
+
+
+class Command(ZulipBaseCommand):
+    help = """Move event queues between Tornado processes, without restarting them, so that
+each realm's queues are in the Tornado process that a sharding configuration
+assigns it to.  Used by scripts/refresh-sharding-and-restart.
+
+Usage example:
+
+./manage.py rebalance_tornado_event_queues --sharding-json /etc/zulip/sharding.json.tmp"""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument(
+            "--sharding-json",
+            default="/etc/zulip/sharding.json",
+            help="Sharding configuration to apply, as written by scripts/lib/sharding.py",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        with open(options["sharding_json"], "rb") as f:
+            realm_shard_map = orjson.loads(f.read())
+
+        realm_ports = {
+            str(realm.id): get_tornado_ports_for_host(
+                realm.host, realm_shard_map, settings.TORNADO_PORTS
+            )
+            for realm in Realm.objects.all()
+        }
+        for port in settings.TORNADO_PORTS:
+            resp = requests_client().post(
+                get_tornado_uri_for_port(port) + "/rebalance_tornado_event_queues",
+                data=dict(
+                    data=orjson.dumps(dict(realm_ports=realm_ports)),
+                    secret=settings.SHARED_SECRET,
+                ),
+                timeout=600,
+            )
+            result = resp.json()
+            for target_port, count in result["migrated"].items():
+                if count > 0:
+                    print(f"Moved {count} event queues from port {port} to port {target_port}")
+            if result["removed"] > 0:
+                print(
+                    f"Removed {result['removed']} event queues on port {port} "
+                    "belonging to users now served by another port"
+                )
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.5 on 2021-07-20 18:12
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("zerver", "0333_alter_realm_org_type"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="realm",
+            name="lazy_fan_out_threshold",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name="DeferredUserMessages",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                (
+                    "user_profile_ids",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.IntegerField(), size=None
+                    ),
+                ),
+                (
+                    "message",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.message"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="deferredusermessages",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["user_profile_ids"], name="zerver_defe_user_pr_53b62b_gin"
+            ),
+        ),
+    ]
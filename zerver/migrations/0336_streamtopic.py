@@ -0,0 +1,451 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.backends.postgresql.schema import DatabaseSchemaEditor
+from django.db.migrations.state import StateApps
+
+# BACKFILL runs without locking zerver_message, so while it runs,
+# these triggers record the topics of any messages that are sent,
+# moved, or deleted; CREATE_TRIGGERS then recomputes those topics
+# under the table lock.  Creating them waits for any transaction
+# that's already writing to zerver_message to finish, so BACKFILL
+# sees every change they don't record.
+TRACK_CHANGES = """
+LOCK TABLE zerver_message IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE UNLOGGED TABLE zerver_streamtopic_changed (
+    recipient_id integer NOT NULL,
+    topic_upper text NOT NULL
+);
+
+CREATE FUNCTION zerver_streamtopic_track_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO zerver_streamtopic_changed
+    SELECT recipient_id, upper(subject) FROM new_messages;
+    RETURN NULL;
+END $$;
+
+CREATE FUNCTION zerver_streamtopic_track_update() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO zerver_streamtopic_changed
+    SELECT changed.recipient_id, upper(changed.subject)
+    FROM old_messages
+    JOIN new_messages ON new_messages.id = old_messages.id
+    CROSS JOIN LATERAL (
+        VALUES
+            (old_messages.recipient_id, old_messages.subject),
+            (new_messages.recipient_id, new_messages.subject)
+    ) AS changed(recipient_id, subject)
+    WHERE new_messages.recipient_id <> old_messages.recipient_id
+        OR new_messages.subject <> old_messages.subject;
+    RETURN NULL;
+END $$;
+
+CREATE FUNCTION zerver_streamtopic_track_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO zerver_streamtopic_changed
+    SELECT recipient_id, upper(subject) FROM old_messages;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER zerver_streamtopic_track_insert
+    AFTER INSERT ON zerver_message
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE zerver_streamtopic_track_insert();
+
+CREATE TRIGGER zerver_streamtopic_track_update
+    AFTER UPDATE ON zerver_message
+    REFERENCING OLD TABLE AS old_messages NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE zerver_streamtopic_track_update();
+
+CREATE TRIGGER zerver_streamtopic_track_delete
+    AFTER DELETE ON zerver_message
+    REFERENCING OLD TABLE AS old_messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE zerver_streamtopic_track_delete();
+"""
+
+DROP_TRACKING = """
+DROP TRIGGER IF EXISTS zerver_streamtopic_track_insert ON zerver_message;
+DROP TRIGGER IF EXISTS zerver_streamtopic_track_update ON zerver_message;
+DROP TRIGGER IF EXISTS zerver_streamtopic_track_delete ON zerver_message;
+DROP FUNCTION IF EXISTS zerver_streamtopic_track_insert();
+DROP FUNCTION IF EXISTS zerver_streamtopic_track_update();
+DROP FUNCTION IF EXISTS zerver_streamtopic_track_delete();
+DROP TABLE IF EXISTS zerver_streamtopic_changed;
+"""
+
+# The StreamTopic rows are maintained by these triggers on
+# zerver_message, so that every way of sending, editing, moving,
+# deleting, or restoring messages keeps them up to date.  We use
+# statement-level triggers with transition tables, so that bulk
+# operations (e.g. moving a topic) update each affected topic once.
+#
+# Topics are matched the way Django's iexact does (and the
+# zerver_message_recipient_upper_subject index is built), by
+# upper(subject).
+#
+# Updating a topic's row locks it until the transaction commits, and
+# a send's transaction goes on to insert a UserMessage row for every
+# subscriber; so concurrent sends to a busy topic would each wait for
+# the previous one to commit.  Instead, new messages are recorded in
+# zerver_streamtopiclog, and folded into the topic's row only if no
+# other transaction holds it; otherwise whichever transaction next
+# locks it folds them in.
+CREATE_TRIGGERS = """
+LOCK TABLE zerver_message IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE FUNCTION zerver_streamtopic_fold(
+    recipient_ids integer[], topic_uppers text[]
+) RETURNS void LANGUAGE sql AS $$
+    -- Lock the topics' rows in a consistent order, before the log
+    -- rows, as zerver_streamtopic_message_insert does, so that we
+    -- don't deadlock with a send.
+    SELECT 1 FROM zerver_streamtopic
+    JOIN unnest(recipient_ids, topic_uppers) AS topic(recipient_id, topic_upper)
+        ON zerver_streamtopic.recipient_id = topic.recipient_id
+        AND zerver_streamtopic.topic_upper = topic.topic_upper
+    ORDER BY zerver_streamtopic.id
+    FOR UPDATE OF zerver_streamtopic;
+
+    WITH pending AS (
+        DELETE FROM zerver_streamtopiclog
+        USING unnest(recipient_ids, topic_uppers) AS topic(recipient_id, topic_upper)
+        WHERE zerver_streamtopiclog.recipient_id = topic.recipient_id
+            AND zerver_streamtopiclog.topic_upper = topic.topic_upper
+        RETURNING zerver_streamtopiclog.*
+    )
+    INSERT INTO zerver_streamtopic AS streamtopic
+        (recipient_id, topic_upper, topic_name, last_message_id, message_count)
+    SELECT DISTINCT ON (pending.recipient_id, pending.topic_upper)
+        pending.recipient_id,
+        pending.topic_upper,
+        pending.topic_name,
+        pending.last_message_id,
+        sum(pending.message_count) OVER (PARTITION BY pending.recipient_id, pending.topic_upper)
+    FROM pending
+    ORDER BY pending.recipient_id, pending.topic_upper, pending.last_message_id DESC
+    ON CONFLICT (recipient_id, topic_upper) DO UPDATE SET
+        topic_name = CASE
+            WHEN EXCLUDED.last_message_id > streamtopic.last_message_id THEN EXCLUDED.topic_name
+            ELSE streamtopic.topic_name
+        END,
+        last_message_id = GREATEST(streamtopic.last_message_id, EXCLUDED.last_message_id),
+        message_count = streamtopic.message_count + EXCLUDED.message_count;
+$$;
+
+CREATE FUNCTION zerver_streamtopic_add_messages(
+    recipient_ids integer[], subjects text[], message_ids integer[]
+) RETURNS void LANGUAGE sql AS $$
+    INSERT INTO zerver_streamtopic AS streamtopic
+        (recipient_id, topic_upper, topic_name, last_message_id, message_count)
+    SELECT DISTINCT ON (added.recipient_id, upper(added.subject))
+        added.recipient_id,
+        upper(added.subject),
+        added.subject,
+        added.id,
+        count(*) OVER (PARTITION BY added.recipient_id, upper(added.subject))
+    FROM unnest(recipient_ids, subjects, message_ids) AS added(recipient_id, subject, id)
+    JOIN zerver_recipient ON zerver_recipient.id = added.recipient_id
+    WHERE zerver_recipient.type = 2
+    ORDER BY added.recipient_id, upper(added.subject), added.id DESC
+    ON CONFLICT (recipient_id, topic_upper) DO UPDATE SET
+        topic_name = CASE
+            WHEN EXCLUDED.last_message_id > streamtopic.last_message_id THEN EXCLUDED.topic_name
+            ELSE streamtopic.topic_name
+        END,
+        last_message_id = GREATEST(streamtopic.last_message_id, EXCLUDED.last_message_id),
+        message_count = streamtopic.message_count + EXCLUDED.message_count;
+$$;
+
+CREATE FUNCTION zerver_streamtopic_remove_messages(
+    recipient_ids integer[], subjects text[], message_ids integer[]
+) RETURNS void LANGUAGE sql AS $$
+    -- The counts below are only right once any logged messages in
+    -- these topics are folded in.
+    SELECT zerver_streamtopic_fold(
+        array_agg(message.recipient_id), array_agg(upper(message.subject))
+    )
+    FROM unnest(recipient_ids, subjects) AS message(recipient_id, subject);
+
+    UPDATE zerver_streamtopic
+    SET message_count = zerver_streamtopic.message_count - removed.message_count
+    FROM (
+        SELECT message.recipient_id, upper(message.subject) AS topic_upper, count(*) AS message_count
+        FROM unnest(recipient_ids, subjects, message_ids) AS message(recipient_id, subject, id)
+        GROUP BY message.recipient_id, upper(message.subject)
+    ) AS removed
+    WHERE zerver_streamtopic.recipient_id = removed.recipient_id
+        AND zerver_streamtopic.topic_upper = removed.topic_upper;
+
+    -- Delete the topics that no longer have any messages.
+    DELETE FROM zerver_streamtopic
+    USING unnest(recipient_ids, subjects, message_ids) AS removed(recipient_id, subject, id)
+    WHERE zerver_streamtopic.recipient_id = removed.recipient_id
+        AND zerver_streamtopic.topic_upper = upper(removed.subject)
+        AND (
+            zerver_streamtopic.message_count <= 0
+            OR NOT EXISTS (
+                SELECT 1 FROM zerver_message
+                WHERE zerver_message.recipient_id = zerver_streamtopic.recipient_id
+                    AND upper(zerver_message.subject) = zerver_streamtopic.topic_upper
+            )
+        );
+
+    -- Find the new most recent message of the topics that lost theirs.
+    UPDATE zerver_streamtopic
+    SET (last_message_id, topic_name) = (
+        SELECT zerver_message.id, zerver_message.subject
+        FROM zerver_message
+        WHERE zerver_message.recipient_id = zerver_streamtopic.recipient_id
+            AND upper(zerver_message.subject) = zerver_streamtopic.topic_upper
+        ORDER BY zerver_message.id DESC
+        LIMIT 1
+    )
+    FROM unnest(recipient_ids, subjects, message_ids) AS removed(recipient_id, subject, id)
+    WHERE zerver_streamtopic.recipient_id = removed.recipient_id
+        AND zerver_streamtopic.topic_upper = upper(removed.subject)
+        AND zerver_streamtopic.last_message_id = removed.id;
+$$;
+
+CREATE FUNCTION zerver_streamtopic_message_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    added record;
+BEGIN
+    FOR added IN
+        INSERT INTO zerver_streamtopiclog
+            (recipient_id, topic_upper, topic_name, last_message_id, message_count)
+        SELECT DISTINCT ON (new_messages.recipient_id, upper(new_messages.subject))
+            new_messages.recipient_id,
+            upper(new_messages.subject),
+            new_messages.subject,
+            new_messages.id,
+            count(*) OVER (PARTITION BY new_messages.recipient_id, upper(new_messages.subject))
+        FROM new_messages
+        JOIN zerver_recipient ON zerver_recipient.id = new_messages.recipient_id
+        WHERE zerver_recipient.type = 2
+        ORDER BY new_messages.recipient_id, upper(new_messages.subject), new_messages.id DESC
+        RETURNING zerver_streamtopiclog.recipient_id, zerver_streamtopiclog.topic_upper
+    LOOP
+        -- Our own transaction's locks aren't skipped, so this only
+        -- finds nothing if the topic is new, or another transaction
+        -- holds its row.
+        PERFORM 1 FROM zerver_streamtopic
+        WHERE recipient_id = added.recipient_id AND topic_upper = added.topic_upper
+        FOR UPDATE SKIP LOCKED;
+        IF FOUND OR NOT EXISTS (
+            SELECT 1 FROM zerver_streamtopic
+            WHERE recipient_id = added.recipient_id AND topic_upper = added.topic_upper
+        ) THEN
+            PERFORM zerver_streamtopic_fold(
+                ARRAY[added.recipient_id], ARRAY[added.topic_upper]
+            );
+        END IF;
+    END LOOP;
+    RETURN NULL;
+END $$;
+
+CREATE FUNCTION zerver_streamtopic_message_update() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+    old_recipient_ids integer[];
+    old_subjects text[];
+    new_recipient_ids integer[];
+    new_subjects text[];
+    changed_message_ids integer[];
+BEGIN
+    SELECT
+        array_agg(old_messages.recipient_id),
+        array_agg(old_messages.subject::text),
+        array_agg(new_messages.recipient_id),
+        array_agg(new_messages.subject::text),
+        array_agg(new_messages.id)
+    INTO old_recipient_ids, old_subjects, new_recipient_ids, new_subjects, changed_message_ids
+    FROM old_messages
+    JOIN new_messages ON new_messages.id = old_messages.id
+    WHERE new_messages.recipient_id <> old_messages.recipient_id
+        OR new_messages.subject <> old_messages.subject;
+
+    -- Most updates to messages are edits to their content.
+    IF changed_message_ids IS NOT NULL THEN
+        PERFORM zerver_streamtopic_remove_messages(
+            old_recipient_ids, old_subjects, changed_message_ids
+        );
+        PERFORM zerver_streamtopic_add_messages(
+            new_recipient_ids, new_subjects, changed_message_ids
+        );
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE FUNCTION zerver_streamtopic_message_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM zerver_streamtopic_remove_messages(
+        array_agg(old_messages.recipient_id),
+        array_agg(old_messages.subject::text),
+        array_agg(old_messages.id)
+    )
+    FROM old_messages;
+    RETURN NULL;
+END $$;
+
+-- Recompute the topics that messages were sent to, moved into or out
+-- of, or deleted from while BACKFILL ran (which its snapshot can't
+-- have seen); the table lock above keeps any more from changing until
+-- the triggers exist.
+DELETE FROM zerver_streamtopic
+USING zerver_streamtopic_changed
+WHERE zerver_streamtopic.recipient_id = zerver_streamtopic_changed.recipient_id
+    AND zerver_streamtopic.topic_upper = zerver_streamtopic_changed.topic_upper;
+
+INSERT INTO zerver_streamtopic
+    (recipient_id, topic_upper, topic_name, last_message_id, message_count)
+SELECT DISTINCT ON (zerver_message.recipient_id, upper(zerver_message.subject))
+    zerver_message.recipient_id,
+    upper(zerver_message.subject),
+    zerver_message.subject,
+    zerver_message.id,
+    count(*) OVER (PARTITION BY zerver_message.recipient_id, upper(zerver_message.subject))
+FROM (SELECT DISTINCT recipient_id, topic_upper FROM zerver_streamtopic_changed) AS changed
+JOIN zerver_message
+    ON zerver_message.recipient_id = changed.recipient_id
+    AND upper(zerver_message.subject) = changed.topic_upper
+JOIN zerver_recipient ON zerver_recipient.id = zerver_message.recipient_id
+WHERE zerver_recipient.type = 2
+ORDER BY zerver_message.recipient_id, upper(zerver_message.subject), zerver_message.id DESC;
+
+CREATE TRIGGER zerver_streamtopic_message_insert
+    AFTER INSERT ON zerver_message
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE zerver_streamtopic_message_insert();
+
+CREATE TRIGGER zerver_streamtopic_message_update
+    AFTER UPDATE ON zerver_message
+    REFERENCING OLD TABLE AS old_messages NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE zerver_streamtopic_message_update();
+
+CREATE TRIGGER zerver_streamtopic_message_delete
+    AFTER DELETE ON zerver_message
+    REFERENCING OLD TABLE AS old_messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE zerver_streamtopic_message_delete();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER zerver_streamtopic_message_insert ON zerver_message;
+DROP TRIGGER zerver_streamtopic_message_update ON zerver_message;
+DROP TRIGGER zerver_streamtopic_message_delete ON zerver_message;
+DROP FUNCTION zerver_streamtopic_message_insert();
+DROP FUNCTION zerver_streamtopic_message_update();
+DROP FUNCTION zerver_streamtopic_message_delete();
+DROP FUNCTION zerver_streamtopic_add_messages(integer[], text[], integer[]);
+DROP FUNCTION zerver_streamtopic_remove_messages(integer[], text[], integer[]);
+DROP FUNCTION zerver_streamtopic_fold(integer[], text[]);
+"""
+
+# This runs before the triggers are created, in its own transaction,
+# so that it doesn't keep messages from being sent while it runs
+# (though the server is normally stopped during upgrades anyway); see
+# TRACK_CHANGES.
+BACKFILL = """
+INSERT INTO zerver_streamtopic
+    (recipient_id, topic_upper, topic_name, last_message_id, message_count)
+SELECT DISTINCT ON (zerver_message.recipient_id, upper(zerver_message.subject))
+    zerver_message.recipient_id,
+    upper(zerver_message.subject),
+    zerver_message.subject,
+    zerver_message.id,
+    count(*) OVER (PARTITION BY zerver_message.recipient_id, upper(zerver_message.subject))
+FROM zerver_message
+JOIN zerver_recipient ON zerver_recipient.id = zerver_message.recipient_id
+WHERE zerver_recipient.type = 2
+ORDER BY zerver_message.recipient_id, upper(zerver_message.subject), zerver_message.id DESC
+"""
+
+
+def track_changes(apps: StateApps, schema_editor: DatabaseSchemaEditor) -> None:
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(TRACK_CHANGES)
+
+
+def drop_tracking(apps: StateApps, schema_editor: DatabaseSchemaEditor) -> None:
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(DROP_TRACKING)
+
+
+def create_triggers(apps: StateApps, schema_editor: DatabaseSchemaEditor) -> None:
+    # RunSQL would run each statement in its own transaction, but the
+    # table lock must be held until the triggers exist.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_TRIGGERS)
+        cursor.execute(DROP_TRACKING)
+
+
+def drop_triggers(apps: StateApps, schema_editor: DatabaseSchemaEditor) -> None:
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(DROP_TRIGGERS)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("zerver", "0335_unread_conversations"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StreamTopic",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("topic_upper", models.TextField()),
+                ("topic_name", models.CharField(max_length=60)),
+                ("last_message_id", models.IntegerField()),
+                ("message_count", models.IntegerField()),
+                (
+                    "recipient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.recipient"
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("recipient", "topic_upper")},
+            },
+        ),
+        migrations.AddIndex(
+            model_name="streamtopic",
+            index=models.Index(
+                fields=["recipient", "-last_message_id"],
+                name="zerver_streamtopic_recipient_id_last_message_id_idx",
+            ),
+        ),
+        migrations.CreateModel(
+            name="StreamTopicLog",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("topic_upper", models.TextField()),
+                ("topic_name", models.CharField(max_length=60)),
+                ("last_message_id", models.IntegerField()),
+                ("message_count", models.IntegerField()),
+                (
+                    "recipient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.recipient"
+                    ),
+                ),
+            ],
+            options={
+                "index_together": {("recipient", "topic_upper")},
+            },
+        ),
+        migrations.RunPython(track_changes, reverse_code=drop_tracking, atomic=True),
+        migrations.RunSQL(BACKFILL, reverse_sql=migrations.RunSQL.noop, elidable=True),
+        migrations.RunPython(create_triggers, reverse_code=drop_triggers, atomic=True),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.5 on 2021-08-02 17:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("zerver", "0336_streamtopic"),
+    ]
+
+    operations = [
+        # Every user's rows are built again from their UserMessage rows
+        # the next time they're needed.
+        migrations.RunSQL("DELETE FROM zerver_unreadsummary", reverse_sql=migrations.RunSQL.noop),
+        migrations.DeleteModel(
+            name="UnreadConversation",
+        ),
+        migrations.CreateModel(
+            name="UnreadMessage",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("topic", models.CharField(max_length=60)),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="zerver.message"
+                    ),
+                ),
+                (
+                    "recipient",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="zerver.recipient",
+                    ),
+                ),
+                (
+                    "sender",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "user_profile",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user_profile", "message")},
+            },
+        ),
+    ]
@@ -24,6 +24,8 @@ from bitfield import BitField
 from bitfield.types import BitHandler
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, UserManager
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.exceptions import ValidationError
 from django.core.validators import MinLengthValidator, RegexValidator, URLValidator, validate_email
 from django.db import models, transaction
@@ -50,8 +52,10 @@ from zerver.lib.cache import (
     flush_message,
     flush_muting_users_cache,
     flush_realm,
+    flush_realm_recipient_info,
     flush_stream,
     flush_submessage,
+    flush_subscription,
     flush_used_upload_space_cache,
     flush_user_profile,
     get_realm_used_upload_space_cache_key,
@@ -404,6 +408,13 @@ class Realm(models.Model):
     # Messages older than this message ID in the organization are inaccessible.
     first_visible_message_id: int = models.IntegerField(default=0)
 
+    # When non-null, messages to public streams with more than this
+    # many subscribers only get UserMessage rows immediately for
+    # users whose rows will have flags set, or who will be notified;
+    # the rest are created shortly afterwards.  See
+    # zerver/lib/deferred_user_messages.py.
+    lazy_fan_out_threshold: Optional[int] = models.IntegerField(null=True)
+
     # Valid org types
     ORG_TYPES: Dict[str, Dict[str, Any]] = {
         "unspecified": {
@@ -2680,6 +2691,13 @@ class AbstractUserMessage(models.Model):
         # the code for example usage.
         return "flags & 1 = 0"
 
+    @staticmethod
+    def where_mentioned() -> str:
+        # Use this for Django ORM queries to access messages that
+        # mention the user, including wildcard mentions; this matches
+        # the zerver_usermessage_wildcard_mentioned_message_id index.
+        return "(flags & 8) != 0 OR (flags & 16) != 0"
+
     @staticmethod
     def where_starred() -> str:
         # Use this for Django ORM queries to access starred messages.
@@ -2723,6 +2741,101 @@ class UserMessage(AbstractUserMessage):
     message: Message = models.ForeignKey(Message, on_delete=CASCADE)
 
 
+class DeferredUserMessages(models.Model):
+    """The recipients of a message whose UserMessage rows (all of which
+    have no flags set) haven't been created yet, because the message
+    was sent with lazy fan-out; see zerver/lib/deferred_user_messages.py.
+    """
+
+    message: Message = models.OneToOneField(Message, on_delete=CASCADE)
+    user_profile_ids: List[int] = ArrayField(models.IntegerField())
+
+    class Meta:
+        indexes = [GinIndex(fields=["user_profile_ids"])]
+
+
+class UnreadMessage(models.Model):
+    """One of a user's unread messages, with the fields of the message
+    that fetching the user's unread messages needs, maintained as
+    UserMessage rows are created and marked as read, so that fetching
+    all of a user's unread messages doesn't require joining their
+    UserMessage rows with Message; see zerver/lib/unread_summary.py."""
+
+    id: int = models.BigAutoField(primary_key=True)
+
+    # The unique index on (user_profile, message) serves the lookups by
+    # user, and these rows are written for every unread message, so
+    # we don't index the other foreign keys, except for message.
+    user_profile: UserProfile = models.ForeignKey(UserProfile, on_delete=CASCADE, db_index=False)
+    message: Message = models.ForeignKey(Message, on_delete=CASCADE)
+    recipient: Recipient = models.ForeignKey(Recipient, on_delete=CASCADE, db_index=False)
+    # Empty for private messages.
+    topic: str = models.CharField(max_length=MAX_TOPIC_NAME_LENGTH)
+    sender: UserProfile = models.ForeignKey(
+        UserProfile, on_delete=CASCADE, db_index=False, related_name="+"
+    )
+
+    class Meta:
+        unique_together = ("user_profile", "message")
+
+
+class UnreadSummary(models.Model):
+    """Exists if the user's UnreadMessage rows are complete; until
+    then, they're built from the user's UserMessage rows the next time
+    they're needed."""
+
+    user_profile: UserProfile = models.OneToOneField(UserProfile, on_delete=CASCADE)
+
+
+class StreamTopic(models.Model):
+    """A topic in a stream, with its most recent message and its number
+    of messages, so that a stream's topic history can be read without
+    grouping all of the stream's messages by topic.
+
+    These rows are maintained by database triggers on zerver_message
+    (see migration 0336_streamtopic), so that every way of sending,
+    editing, moving, deleting, or restoring messages keeps them up to
+    date; code should never write them directly.  Messages sent to a
+    topic while another transaction is sending to it are recorded in
+    StreamTopicLog instead, so readers must combine the two."""
+
+    recipient: Recipient = models.ForeignKey(Recipient, on_delete=CASCADE)
+    # Topics are case-insensitive, so each topic is identified by
+    # upper() of its name, as in the indexes on zerver_message (which
+    # can be longer than the name itself).
+    topic_upper: str = models.TextField()
+    # The name of the topic in its most recent message.
+    topic_name: str = models.CharField(max_length=MAX_TOPIC_NAME_LENGTH)
+    last_message_id: int = models.IntegerField()
+    message_count: int = models.IntegerField()
+
+    class Meta:
+        unique_together = ("recipient", "topic_upper")
+        indexes = [
+            models.Index(
+                fields=("recipient", "-last_message_id"),
+                name="zerver_streamtopic_recipient_id_last_message_id_idx",
+            ),
+        ]
+
+
+class StreamTopicLog(models.Model):
+    """Messages sent to a topic whose StreamTopic row another
+    transaction had locked, so that concurrent sends to a busy topic
+    don't wait for each other to commit.  The next transaction to
+    lock the topic's row folds these into it (see migration
+    0336_streamtopic), so there are only ever a few."""
+
+    recipient: Recipient = models.ForeignKey(Recipient, on_delete=CASCADE)
+    topic_upper: str = models.TextField()
+    topic_name: str = models.CharField(max_length=MAX_TOPIC_NAME_LENGTH)
+    last_message_id: int = models.IntegerField()
+    message_count: int = models.IntegerField()
+
+    class Meta:
+        index_together = ("recipient", "topic_upper")
+
+
 def get_usermessage_by_message_id(
     user_profile: UserProfile, message_id: int
 ) -> Optional[UserMessage]:
@@ -2959,6 +3072,10 @@ class Subscription(models.Model):
     ]
 
 
+post_save.connect(flush_subscription, sender=Subscription)
+post_delete.connect(flush_subscription, sender=Subscription)
+
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600 * 24 * 7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
@@ -3921,6 +4038,8 @@ class AlertWord(models.Model):
 def flush_realm_alert_words(realm: Realm) -> None:
     cache_delete(realm_alert_words_cache_key(realm))
     cache_delete(realm_alert_words_automaton_cache_key(realm))
+    # Users with alert words are included in cached stream recipient info.
+    flush_realm_recipient_info(realm.id)
 
 
 def flush_alert_word(sender: Any, **kwargs: Any) -> None:
@@ -1,23 +1,72 @@
+import os
 import time
+from collections import deque
 from typing import Any, Callable, Collection, Dict, List
 from unittest import mock
+from urllib.parse import parse_qs
 
 import orjson
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
 
 from zerver.lib.actions import do_change_subscription_property, do_mute_topic
+from zerver.lib.exceptions import JsonableError
+from zerver.lib.response import json_response
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import HostRequestMock, mock_queue_publish
 from zerver.lib.user_groups import create_user_group, remove_user_from_user_group
-from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
+from zerver.models import Recipient, Stream, Subscription, UserProfile, get_realm, get_stream
+from zerver.tornado.django_api import send_event
 from zerver.tornado.event_queue import (
     ClientDescriptor,
+    MigratedQueue,
     allocate_client_descriptor,
+    checkpoint_event_queues,
+    clients,
+    coalesce_notices,
+    do_gc_event_queues,
+    fetch_events,
+    gc_event_queues,
+    gc_heap,
     get_client_descriptor,
+    get_client_descriptors_for_user,
+    get_wrapped_process_notification,
+    load_event_queues,
     maybe_enqueue_notifications,
+    migrate_event_queues,
+    migrated_queue_gc_heap,
+    migrated_queues,
+    migrated_realm_ports,
     missedmessage_hook,
+    persistent_queue_checkpoint_filename,
     persistent_queue_filename,
+    persistent_queue_journal_filename,
     process_notification,
+    rebalance_event_queues,
+    replay_event_queue_journal,
+    start_event_queue_checkpoint,
+    start_event_queue_journal,
+    stop_event_queue_journal,
+)
+from zerver.tornado.event_serialization import (
+    json_events_response,
+    serialize_event,
+    serialize_message_payload,
+    serialized_payloads,
+)
+from zerver.tornado.exceptions import BadEventQueueIdError, EventQueueMigratedError
+from zerver.tornado.journal import (
+    EventQueueJournal,
+    read_journal,
+    remove_if_exists,
+    truncate_partial_record,
+)
+from zerver.tornado.sharding import (
+    get_hash_ring,
+    get_hashed_tornado_port,
+    get_tornado_port_for_user,
+    get_tornado_ports,
+    get_user_tornado_port,
 )
 from zerver.tornado.views import cleanup_event_queue, get_events
 
@@ -504,6 +553,872 @@ class FileReloadLogicTest(ZulipTestCase):
             )
 
 
+class GarbageCollectionTest(ZulipTestCase):
+    def test_gc_event_queues(self) -> None:
+        hamlet = self.example_user("hamlet")
+        start = time.time()
+
+        def allocate_client() -> ClientDescriptor:
+            return allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=True,
+                    client_gravatar=True,
+                    client_type_name="website",
+                    event_types=None,
+                    last_connection_time=start,
+                    queue_timeout=600,
+                    realm_id=hamlet.realm_id,
+                    user_profile_id=hamlet.id,
+                )
+            )
+
+        allocate_client()
+        active_client = allocate_client()
+        deleted_client = allocate_client()
+        self.assert_length(gc_heap, 3)
+
+        # As though it connected after 5 minutes.
+        active_client.last_connection_time = start + 300
+        deleted_client.cleanup()
+
+        with mock.patch("zerver.tornado.event_queue.time.time", return_value=start + 650):
+            gc_event_queues(9800)
+        self.assertEqual(list(clients.keys()), [active_client.event_queue.id])
+        # Only the active client's rescheduled entry remains.
+        self.assertEqual(gc_heap, [(start + 900, active_client.event_queue.id)])
+
+        # A client that's connected doesn't expire.
+        active_client.current_handler_id = 1
+        with mock.patch("zerver.tornado.event_queue.time.time", return_value=start + 950):
+            gc_event_queues(9800)
+        self.assertEqual(list(clients.keys()), [active_client.event_queue.id])
+        self.assertEqual(gc_heap, [(start + 951, active_client.event_queue.id)])
+
+        active_client.current_handler_id = None
+        with mock.patch("zerver.tornado.event_queue.time.time", return_value=start + 1000):
+            gc_event_queues(9800)
+        self.assertEqual(clients, {})
+        self.assertEqual(gc_heap, [])
+
+
+class EventQueueJournalTest(ZulipTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.port = 9800
+        self.override = self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(
+                settings.TEST_WORKER_DIR, "event_queues%s.json"
+            )
+        )
+        self.override.enable()
+        self.filenames = [
+            persistent_queue_checkpoint_filename(self.port),
+            persistent_queue_checkpoint_filename(self.port) + ".tmp",
+            persistent_queue_journal_filename(self.port, old=True),
+            persistent_queue_journal_filename(self.port),
+        ]
+        start_event_queue_journal(self.port, 0)
+
+    def tearDown(self) -> None:
+        stop_event_queue_journal()
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.override.disable()
+        super().tearDown()
+
+    def allocate_client(self, user: UserProfile) -> ClientDescriptor:
+        return allocate_client_descriptor(
+            dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=user.realm_id,
+                user_profile_id=user.id,
+            )
+        )
+
+    def assert_replay_matches(self) -> None:
+        stop_event_queue_journal()
+        restored, last_seq = replay_event_queue_journal(self.port)
+        self.assertEqual(
+            {queue_id: client.to_dict() for queue_id, client in restored.items()},
+            {queue_id: client.to_dict() for queue_id, client in clients.items()},
+        )
+        start_event_queue_journal(self.port, last_seq + 1)
+
+    def umfe(self, messages: List[int]) -> Dict[str, Any]:
+        return dict(
+            type="update_message_flags",
+            operation="add",
+            flag="read",
+            all=False,
+            messages=messages,
+        )
+
+    def test_replay_journal(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        client = self.allocate_client(hamlet)
+        other_client = self.allocate_client(cordelia)
+
+        client.add_event(dict(type="unknown", value=1))
+        client.add_event(self.umfe([1, 2]))
+        client.add_event(self.umfe([3]))
+        client.add_event(dict(type="unknown", value=2))
+        other_client.add_event(dict(type="unknown", value=3))
+        self.assert_replay_matches()
+
+        # Converting virtual events into real ones and pruning the
+        # queue are both replayed.
+        client.event_queue.contents()
+        client.add_event(self.umfe([4]))
+        client.event_queue.prune(1)
+        self.assert_replay_matches()
+
+        do_gc_event_queues({other_client.event_queue.id}, {cordelia.id}, {cordelia.realm_id})
+        self.assertEqual(list(clients.keys()), [client.event_queue.id])
+        self.assert_replay_matches()
+
+        # A record truncated by a crash mid-write is ignored, and
+        # doesn't corrupt records written after the restart.
+        with open(persistent_queue_journal_filename(self.port), "ab") as f:
+            f.write(b'[1000, "push", ')
+        with self.assertLogs(level="WARNING") as logs:
+            self.assert_replay_matches()
+        self.assertEqual(
+            logs.output,
+            [
+                "WARNING:root:Ignoring truncated record at the end of "
+                + persistent_queue_journal_filename(self.port)
+            ],
+        )
+        client.add_event(dict(type="unknown", value=4))
+        self.assert_replay_matches()
+
+    def test_replay_message_events(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        client = self.allocate_client(hamlet)
+        other_client = self.allocate_client(cordelia)
+
+        payload = dict(id=1, content="hello")
+        client.add_event(dict(type="message", message=payload, flags=["read"]))
+        other_client.add_event(dict(type="message", message=payload, flags=[]))
+        self.assert_replay_matches()
+
+        # The payload is journaled once, and shared again by the
+        # restored queues.
+        records = list(read_journal(persistent_queue_journal_filename(self.port)))
+        [payload_seq] = [seq for (seq, op, queue_id, data) in records if op == "payload"]
+        self.assertEqual(
+            [data for (seq, op, queue_id, data) in records if op == "push_message"],
+            [
+                [payload_seq, dict(type="message", flags=["read"])],
+                [payload_seq, dict(type="message", flags=[])],
+            ],
+        )
+        stop_event_queue_journal()
+        restored, last_seq = replay_event_queue_journal(self.port)
+        self.assertIs(
+            restored[client.event_queue.id].event_queue.queue[0]["message"],
+            restored[other_client.event_queue.id].event_queue.queue[0]["message"],
+        )
+        start_event_queue_journal(self.port, last_seq + 1)
+
+        # After a checkpoint, the payload is journaled again, since the
+        # record from before it is discarded.
+        for step in checkpoint_event_queues(self.port):
+            pass
+        other_client.add_event(dict(type="message", message=payload, flags=["read"]))
+        self.assert_replay_matches()
+        records = list(read_journal(persistent_queue_journal_filename(self.port)))
+        self.assertEqual([op for (seq, op, queue_id, data) in records], ["payload", "push_message"])
+
+    def test_checkpoint(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        client = self.allocate_client(hamlet)
+        other_client = self.allocate_client(cordelia)
+        client.add_event(dict(type="unknown", value=1))
+
+        with mock.patch("zerver.tornado.event_queue.EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE", 1):
+            steps = checkpoint_event_queues(self.port)
+            next(steps)
+            # Changes made while the checkpoint is being written are
+            # journaled, whether or not the queue has been written yet.
+            client.add_event(dict(type="unknown", value=2))
+            other_client.add_event(dict(type="unknown", value=3))
+            new_client = self.allocate_client(hamlet)
+            new_client.add_event(dict(type="unknown", value=4))
+            # If we crash in the middle of a checkpoint, we still have
+            # everything we need.
+            self.assert_replay_matches()
+            for step in steps:
+                pass
+
+        self.assertTrue(os.path.exists(persistent_queue_checkpoint_filename(self.port)))
+        self.assertFalse(os.path.exists(persistent_queue_journal_filename(self.port, old=True)))
+        self.assert_replay_matches()
+
+        client.add_event(dict(type="unknown", value=5))
+        do_gc_event_queues({other_client.event_queue.id}, {cordelia.id}, {cordelia.realm_id})
+        self.assert_replay_matches()
+
+    def test_journal_file(self) -> None:
+        filename = os.path.join(settings.TEST_WORKER_DIR, "test_journal")
+        self.filenames.append(filename)
+        remove_if_exists(filename)
+        remove_if_exists(filename)
+
+        # With an IOLoop, the records from one iteration of it are
+        # written together.
+        ioloop = mock.Mock()
+        journal = EventQueueJournal(filename, 5, ioloop)
+        self.assertEqual(journal.record("touch", "a", 1), 5)
+        self.assertEqual(journal.record("touch", "a", 2), 6)
+        self.assertEqual(journal.last_seq(), 6)
+        ioloop.add_callback.assert_called_once_with(journal.flush)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"")
+        journal.flush()
+        journal.flush()
+        journal.close()
+        record = b'[5,"touch","a",1]\n[6,"touch","a",2]\n'
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), record)
+
+        # Message payloads are journaled once, unless they've been
+        # evicted from the cache of journaled payloads.
+        journal = EventQueueJournal(filename, 7)
+        payload = dict(id=1)
+        other_payload = dict(id=2)
+        with mock.patch("zerver.tornado.journal.JOURNALED_PAYLOAD_CACHE_SIZE", 1):
+            self.assertEqual(journal.record_message_payload(payload), 7)
+            self.assertEqual(journal.record_message_payload(payload), 7)
+            self.assertEqual(journal.record_message_payload(other_payload), 8)
+            self.assertEqual(journal.record_message_payload(payload), 9)
+        journal.close()
+        with open(filename, "wb") as f:
+            f.write(record)
+
+        # A partial final record is found however far back its start is.
+        with open(filename, "ab") as f:
+            f.write(b'[7,"push","a",{"type":"unknown","value":"' + b"x" * 20)
+        truncate_partial_record(filename, block_size=4)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), record)
+        truncate_partial_record(filename, block_size=4)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), record)
+
+        # Including when it's the only record.
+        with open(filename, "wb") as f:
+            f.write(b'[0,"push",')
+        truncate_partial_record(filename, block_size=4)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"")
+
+    def test_checkpoint_failure(self) -> None:
+        hamlet = self.example_user("hamlet")
+        client = self.allocate_client(hamlet)
+        client.add_event(dict(type="unknown", value=1))
+
+        ioloop = mock.Mock()
+        ioloop.add_callback.side_effect = lambda callback: callback()
+        with mock.patch(
+            "zerver.tornado.event_queue.tornado.ioloop.IOLoop.instance", return_value=ioloop
+        ):
+            with mock.patch.object(
+                ClientDescriptor, "to_dict", side_effect=OSError("Disk full")
+            ), self.assertLogs(level="ERROR") as logs:
+                start_event_queue_checkpoint(self.port)
+            self.assertIn(
+                f"ERROR:root:Tornado {self.port} failed to checkpoint event queues",
+                logs.output[0],
+            )
+            self.assertFalse(os.path.exists(persistent_queue_checkpoint_filename(self.port)))
+            self.assertTrue(os.path.exists(persistent_queue_journal_filename(self.port, old=True)))
+            # The records from before the failed checkpoint are still
+            # replayed.
+            client.add_event(dict(type="unknown", value=2))
+            self.assert_replay_matches()
+
+            # The next checkpoint keeps the records rotated out by the
+            # failed one, until it completes.
+            client.add_event(dict(type="unknown", value=3))
+            steps = checkpoint_event_queues(self.port)
+            next(steps)
+            self.assert_replay_matches()
+            for step in steps:
+                pass
+            self.assertFalse(os.path.exists(persistent_queue_journal_filename(self.port, old=True)))
+            self.assert_replay_matches()
+
+            with self.assertLogs(level="INFO") as logs:
+                start_event_queue_checkpoint(self.port)
+            self.assertIn(
+                f"INFO:root:Tornado {self.port} checkpointed 1 event queues", logs.output[0]
+            )
+
+    def test_replay_failure(self) -> None:
+        hamlet = self.example_user("hamlet")
+        client = self.allocate_client(hamlet)
+        client.add_event(dict(type="unknown", value=1))
+        stop_event_queue_journal()
+        with open(persistent_queue_journal_filename(self.port), "ab") as f:
+            f.write(
+                orjson.dumps(
+                    [1000, "unknown", client.event_queue.id, None],
+                    option=orjson.OPT_APPEND_NEWLINE,
+                )
+            )
+        with self.assertRaisesRegex(
+            AssertionError, "Unknown event queue journal operation unknown"
+        ):
+            replay_event_queue_journal(self.port)
+
+        # If the journal can't be replayed, we start without its
+        # queues, rather than failing to start; and since journaling
+        # is disabled, the journal is removed.
+        with mock.patch("zerver.tornado.event_queue.add_to_client_dicts"), self.assertLogs(
+            level="ERROR"
+        ) as logs:
+            load_event_queues(self.port)
+        self.assertIn(
+            f"ERROR:root:Tornado {self.port} could not replay event queue journal",
+            logs.output[0],
+        )
+        for filename in self.filenames:
+            self.assertFalse(os.path.exists(filename))
+
+
+class TornadoShardingTest(ZulipTestCase):
+    def test_get_tornado_ports(self) -> None:
+        realm = get_realm("zulip")
+        self.assertEqual(get_tornado_ports(realm), [settings.TORNADO_PORTS[0]])
+
+        with self.settings(TORNADO_PORTS=[9800, 9801, 9802]):
+            self.assertEqual(
+                get_tornado_ports(realm),
+                [get_hashed_tornado_port(realm.host, [9800, 9801, 9802])],
+            )
+            with mock.patch.dict("zerver.tornado.sharding.shard_map", {realm.host: 9802}):
+                self.assertEqual(get_tornado_ports(realm), [9802])
+                self.assertEqual(get_user_tornado_port(self.example_user("hamlet")), 9802)
+
+    def test_user_sharded_realm(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        users = [
+            self.example_user(name)
+            for name in ["hamlet", "cordelia", "othello", "iago", "prospero", "aaron", "polonius"]
+        ]
+        realm_ports = [9800, 9801]
+        user_ports = {user.id: get_tornado_port_for_user(user.id, realm_ports) for user in users}
+        # These users happen to be split between the two ports.
+        self.assertEqual(set(user_ports.values()), {9800, 9801})
+
+        with self.settings(TORNADO_PORTS=realm_ports, TORNADO_PROCESSES=2), mock.patch.dict(
+            "zerver.tornado.sharding.shard_map", {realm.host: realm_ports}
+        ):
+            self.assertEqual(get_tornado_ports(realm), realm_ports)
+            self.assertEqual(get_user_tornado_port(hamlet), user_ports[hamlet.id])
+
+            with mock.patch("zerver.tornado.django_api.queue_json_publish") as queue_json_publish:
+                send_event(realm, dict(type="unknown"), [hamlet.id])
+            self.assertEqual(queue_json_publish.call_count, 1)
+            queue_name, notice, _ = queue_json_publish.call_args[0]
+            self.assertEqual(queue_name, f"notify_tornado_port_{user_ports[hamlet.id]}")
+            self.assertEqual(notice["users"], [hamlet.id])
+
+            # Each port gets the event for just its own users.
+            user_dicts = [dict(id=user.id, flags=[]) for user in users]
+            with mock.patch("zerver.tornado.django_api.queue_json_publish") as queue_json_publish:
+                send_event(realm, dict(type="message"), user_dicts)
+            self.assertEqual(
+                {call[0][0]: call[0][1]["users"] for call in queue_json_publish.call_args_list},
+                {
+                    f"notify_tornado_port_{port}": [
+                        user_dict for user_dict in user_dicts if user_ports[user_dict["id"]] == port
+                    ]
+                    for port in realm_ports
+                },
+            )
+
+            # Messages to public streams go to every port, for clients
+            # with all_public_streams or a narrow.
+            with mock.patch("zerver.tornado.django_api.queue_json_publish") as queue_json_publish:
+                send_event(realm, dict(type="message", stream_name="Denmark"), [])
+            self.assertEqual(
+                [call[0][0] for call in queue_json_publish.call_args_list],
+                ["notify_tornado_port_9800", "notify_tornado_port_9801"],
+            )
+
+    def test_hash_ring(self) -> None:
+        hashes, owners = get_hash_ring((9800, 9801, 9802))
+        self.assertEqual(hashes, sorted(hashes))
+        self.assertEqual(len(hashes), len(owners))
+
+        hosts = [f"realm{i}.example.com" for i in range(1000)]
+        three_ports = {host: get_hashed_tornado_port(host, [9800, 9801, 9802]) for host in hosts}
+        four_ports = {
+            host: get_hashed_tornado_port(host, [9800, 9801, 9802, 9803]) for host in hosts
+        }
+        self.assertEqual(set(three_ports.values()), {9800, 9801, 9802})
+
+        # Adding a port only moves realms to the new port, and only
+        # about a quarter of them.
+        moved = [host for host in hosts if four_ports[host] != three_ports[host]]
+        self.assertEqual({four_ports[host] for host in moved}, {9803})
+        self.assertGreater(len(moved), 150)
+        self.assertLess(len(moved), 350)
+
+
+class EventQueueMigrationTest(ZulipTestCase):
+    def allocate_client(self, user: UserProfile) -> ClientDescriptor:
+        return allocate_client_descriptor(
+            dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=user.realm_id,
+                user_profile_id=user.id,
+            )
+        )
+
+    def internal_post(self, url: str, data: Dict[str, Any]) -> HttpResponse:
+        req = HostRequestMock(
+            dict(data=orjson.dumps(data).decode(), secret=settings.SHARED_SECRET),
+            user_profile=None,
+        )
+        req.META["REMOTE_ADDR"] = "127.0.0.1"
+        return self.client_post_request(url, req)
+
+    def fetch_events(self, user: UserProfile, queue_id: str) -> Dict[str, Any]:
+        return fetch_events(
+            dict(
+                queue_id=queue_id,
+                dont_block=True,
+                last_event_id=-1,
+                user_profile_id=user.id,
+                client_type_name="website",
+                handler_id=1,
+            )
+        )
+
+    def test_rebalance_event_queues(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.lear_user("cordelia")
+        hamlet_client = self.allocate_client(hamlet)
+        cordelia_client = self.allocate_client(cordelia)
+        cordelia_client.add_event(dict(type="unknown", value=1))
+        cordelia_queue_id = cordelia_client.event_queue.id
+        cordelia_queue = cordelia_client.to_dict()
+        realm_ports = {str(hamlet.realm_id): [9800], str(cordelia.realm_id): [9801]}
+
+        with mock.patch("zerver.tornado.event_queue.tornado_port", 9800), mock.patch(
+            "zerver.tornado.event_queue.AsyncHTTPClient"
+        ) as http_client:
+            result = self.internal_post(
+                "/rebalance_tornado_event_queues", dict(realm_ports=realm_ports)
+            )
+        self.assert_json_success(result)
+        self.assertEqual(orjson.loads(result.content)["migrated"], {"9801": 1})
+        self.assertEqual(orjson.loads(result.content)["removed"], 0)
+        [url], kwargs = http_client().fetch.call_args
+        self.assertEqual(url, "http://127.0.0.1:9801/import_tornado_event_queues")
+        handed_off = orjson.loads(parse_qs(kwargs["body"])["data"][0])
+        self.assertEqual(
+            handed_off,
+            dict(realm_ids=[cordelia.realm_id], queues=[[cordelia_queue_id, cordelia_queue]]),
+        )
+
+        self.assertEqual(list(clients.keys()), [hamlet_client.event_queue.id])
+        self.assertEqual(list(migrated_queues.keys()), [cordelia_queue_id])
+        self.assertEqual(migrated_queues[cordelia_queue_id].port, 9801)
+        self.assertEqual(gc_heap, [(mock.ANY, hamlet_client.event_queue.id)])
+
+        # Clients are told to retry, rather than that their queue is gone.
+        result = self.fetch_events(cordelia, cordelia_queue_id)
+        self.assertEqual(result["type"], "error")
+        self.assertIsInstance(result["exception"], EventQueueMigratedError)
+        result = self.fetch_events(hamlet, hamlet_client.event_queue.id)
+        self.assertEqual(result["type"], "response")
+
+        # Until the other process has the queues, notifications for
+        # the realm, and queues registered for it, are held back.
+        self.assertEqual(migrated_realm_ports, {})
+        [finish_import], _ = http_client().fetch().add_done_callback.call_args
+        notice = dict(event=dict(type="unknown", value=2), users=[cordelia.id])
+        with mock.patch("zerver.tornado.event_queue.queue_json_publish") as queue_json_publish:
+            process_notification(dict(notice, realm_id=cordelia.realm_id))
+        queue_json_publish.assert_not_called()
+        new_queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=True,
+            client_gravatar=True,
+            client_type_name="website",
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=600,
+            realm_id=cordelia.realm_id,
+            user_profile_id=cordelia.id,
+        )
+        with mock.patch("zerver.tornado.event_queue.AsyncHTTPClient") as http_client:
+            result = fetch_events(
+                dict(
+                    queue_id=None,
+                    dont_block=True,
+                    last_event_id=None,
+                    user_profile_id=cordelia.id,
+                    client_type_name="website",
+                    handler_id=1,
+                    new_queue_data=dict(new_queue_data),
+                )
+            )
+            http_client().fetch.assert_not_called()
+        self.assertEqual(result["type"], "response")
+        new_queue_id = result["response"]["queue_id"]
+        self.assertNotIn(new_queue_id, clients)
+        self.assertEqual(migrated_queues[new_queue_id].port, 9801)
+
+        # Once it confirms, they're sent on, in order.
+        future = mock.Mock()
+        future.exception.return_value = None
+        with mock.patch(
+            "zerver.tornado.event_queue.queue_json_publish"
+        ) as queue_json_publish, mock.patch(
+            "zerver.tornado.event_queue.AsyncHTTPClient"
+        ) as http_client:
+            finish_import(future)
+        queue_name, forwarded, send_notification_http = queue_json_publish.call_args[0]
+        self.assertEqual(queue_name, "notify_tornado")
+        self.assertEqual(forwarded, dict(notice, realm_id=cordelia.realm_id))
+        [url], kwargs = http_client().fetch.call_args
+        self.assertEqual(url, "http://127.0.0.1:9801/import_tornado_event_queues")
+        self.assertEqual(
+            [
+                queue_id
+                for (queue_id, data) in orjson.loads(parse_qs(kwargs["body"])["data"][0])["queues"]
+            ],
+            [new_queue_id],
+        )
+        self.assertEqual(migrated_realm_ports, {})
+        [finish_import], _ = http_client().fetch().add_done_callback.call_args
+        finish_import(future)
+        self.assertEqual(migrated_realm_ports, {cordelia.realm_id: 9801})
+
+        # After that, notifications for the realm are forwarded.
+        with mock.patch("zerver.tornado.event_queue.queue_json_publish") as queue_json_publish:
+            process_notification(dict(notice, realm_id=cordelia.realm_id))
+        queue_name, forwarded, send_notification_http = queue_json_publish.call_args[0]
+        self.assertEqual(queue_name, "notify_tornado")
+        self.assertEqual(forwarded, dict(notice, realm_id=cordelia.realm_id))
+        with mock.patch("zerver.tornado.django_api.requests_client") as requests_client:
+            send_notification_http(forwarded)
+        [url], kwargs = requests_client().post.call_args
+        self.assertEqual(url, "http://127.0.0.1:9801/notify_tornado")
+
+        # As are new queues for the realm.
+        with mock.patch("zerver.tornado.event_queue.AsyncHTTPClient") as http_client:
+            result = fetch_events(
+                dict(
+                    queue_id=None,
+                    dont_block=True,
+                    last_event_id=None,
+                    user_profile_id=cordelia.id,
+                    client_type_name="website",
+                    handler_id=1,
+                    new_queue_data=dict(new_queue_data),
+                )
+            )
+        [url], kwargs = http_client().fetch.call_args
+        self.assertEqual(url, "http://127.0.0.1:9801/import_tornado_event_queues")
+        self.assertEqual(result["type"], "response")
+        self.assertNotIn(result["response"]["queue_id"], clients)
+        self.assertEqual(migrated_queues[result["response"]["queue_id"]].port, 9801)
+
+        # If the other Tornado process fails to take the queues, we
+        # keep them, along with the events they missed meanwhile.
+        with mock.patch("zerver.tornado.event_queue.tornado_port", 9801), mock.patch(
+            "zerver.tornado.event_queue.AsyncHTTPClient"
+        ) as http_client:
+            rebalance_event_queues({hamlet.realm_id: [9802]})
+        self.assertEqual(list(clients.keys()), [])
+        process_notification(
+            dict(event=dict(type="unknown", value=3), users=[hamlet.id], realm_id=hamlet.realm_id)
+        )
+        [finish_import], _ = http_client().fetch().add_done_callback.call_args
+        future.exception.return_value = ConnectionError()
+        with self.assertLogs(level="ERROR") as error_log:
+            finish_import(future)
+        self.assertIn("failed to hand off 1 event queues to port 9802", error_log.output[0])
+        self.assertEqual(list(clients.keys()), [hamlet_client.event_queue.id])
+        self.assertEqual(
+            [
+                event["value"]
+                for event in get_client_descriptor(
+                    hamlet_client.event_queue.id
+                ).event_queue.contents()
+            ],
+            [3],
+        )
+        self.assertNotIn(hamlet.realm_id, migrated_realm_ports)
+        self.assertNotIn(hamlet_client.event_queue.id, migrated_queues)
+        self.assertEqual(gc_heap, [(mock.ANY, hamlet_client.event_queue.id)])
+
+        # Handing the realm back to this process restores the queue.
+        result = self.internal_post("/import_tornado_event_queues", handed_off)
+        self.assert_json_success(result)
+        self.assertEqual(orjson.loads(result.content)["imported"], 1)
+        self.assertEqual(migrated_realm_ports, {})
+        self.assertNotIn(cordelia_queue_id, migrated_queues)
+        self.assertEqual(get_client_descriptor(cordelia_queue_id).to_dict(), cordelia_queue)
+
+        # Importing the same queues again is a no-op.
+        result = self.internal_post("/import_tornado_event_queues", handed_off)
+        self.assertEqual(orjson.loads(result.content)["imported"], 0)
+        self.assert_length(get_client_descriptors_for_user(cordelia.id), 1)
+
+    def test_migration_of_late_queue_fails(self) -> None:
+        hamlet = self.example_user("hamlet")
+        self.allocate_client(hamlet)
+        with mock.patch("zerver.tornado.event_queue.tornado_port", 9800), mock.patch(
+            "zerver.tornado.event_queue.AsyncHTTPClient"
+        ) as http_client:
+            migrate_event_queues({hamlet.realm_id}, 9801)
+            # Registered while the hand-off is in progress.
+            result = fetch_events(
+                dict(
+                    queue_id=None,
+                    dont_block=True,
+                    last_event_id=None,
+                    user_profile_id=hamlet.id,
+                    client_type_name="website",
+                    handler_id=1,
+                    new_queue_data=dict(
+                        all_public_streams=False,
+                        apply_markdown=True,
+                        client_gravatar=True,
+                        client_type_name="website",
+                        event_types=None,
+                        last_connection_time=time.time(),
+                        queue_timeout=600,
+                        realm_id=hamlet.realm_id,
+                        user_profile_id=hamlet.id,
+                    ),
+                )
+            )
+            late_queue_id = result["response"]["queue_id"]
+            self.assertEqual(clients, {})
+            [finish_import], _ = http_client().fetch().add_done_callback.call_args
+            future = mock.Mock()
+            future.exception.return_value = None
+            finish_import(future)
+
+        # If the other process takes the realm's queues, but then fails
+        # to take those registered since, the clients of the latter
+        # have to register new queues.
+        [finish_import], _ = http_client().fetch().add_done_callback.call_args
+        future.exception.return_value = ConnectionError()
+        with self.assertLogs(level="ERROR"):
+            finish_import(future)
+        self.assertEqual(clients, {})
+        self.assertEqual(migrated_realm_ports, {hamlet.realm_id: 9801})
+        self.assertNotIn(late_queue_id, migrated_queues)
+        result = self.fetch_events(hamlet, late_queue_id)
+        self.assertIsInstance(result["exception"], BadEventQueueIdError)
+
+    def test_migrated_queue_expiry(self) -> None:
+        hamlet = self.example_user("hamlet")
+        queue_id = self.allocate_client(hamlet).event_queue.id
+        with mock.patch("zerver.tornado.event_queue.tornado_port", 9800), mock.patch(
+            "zerver.tornado.event_queue.AsyncHTTPClient"
+        ):
+            migrate_event_queues({hamlet.realm_id}, 9801)
+        expires = migrated_queues[queue_id].expires
+        self.assertEqual(migrated_queue_gc_heap, [(expires, queue_id)])
+
+        # Once the queue would have expired in the other process, we
+        # stop telling clients to retry with it.
+        with mock.patch("time.time", return_value=expires - 1):
+            gc_event_queues(9800)
+        self.assertIn(queue_id, migrated_queues)
+        with mock.patch("time.time", return_value=expires):
+            gc_event_queues(9800)
+        self.assertNotIn(queue_id, migrated_queues)
+        self.assertEqual(migrated_queue_gc_heap, [])
+
+    def test_rebalance_user_sharded_realm(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm_ports = [9800, 9801]
+        hamlet_port = get_tornado_port_for_user(hamlet.id, realm_ports)
+        # Another user served by the other port.
+        other_user = [
+            user
+            for user in hamlet.realm.get_active_users()
+            if get_tornado_port_for_user(user.id, realm_ports) != hamlet_port
+        ][0]
+        hamlet_client = self.allocate_client(hamlet)
+        self.allocate_client(other_user)
+        migrated_realm_ports[hamlet.realm_id] = 9802
+        migrated_queues["migrated"] = MigratedQueue(
+            port=9802, realm_id=hamlet.realm_id, expires=time.time() + 600
+        )
+
+        # Queues can't move between the shards of a realm, so those
+        # of users served by another shard are garbage-collected.
+        with mock.patch("zerver.tornado.event_queue.tornado_port", hamlet_port):
+            migrated, removed = rebalance_event_queues({hamlet.realm_id: realm_ports})
+        self.assertEqual(migrated, {})
+        self.assertEqual(removed, 1)
+        self.assertEqual(list(clients.keys()), [hamlet_client.event_queue.id])
+        self.assertEqual(migrated_realm_ports, {})
+        # Clients with queues handed off before the realm was sharded
+        # are told to register a new queue, rather than to retry.
+        self.assertEqual(migrated_queues, {})
+
+    def test_queue_ids_include_port(self) -> None:
+        hamlet = self.example_user("hamlet")
+        with self.settings(TORNADO_PROCESSES=2), mock.patch(
+            "zerver.tornado.event_queue.tornado_port", 9801
+        ):
+            client = self.allocate_client(hamlet)
+        self.assertEqual(client.event_queue.id, f"{settings.SERVER_GENERATION}:9801:0")
+
+
+class CoalesceNoticesTest(ZulipTestCase):
+    def flags_notice(
+        self, user_id: int, messages: List[int], operation: str = "add", flag: str = "read"
+    ) -> Dict[str, Any]:
+        return dict(
+            event=dict(
+                type="update_message_flags",
+                op=operation,
+                operation=operation,
+                flag=flag,
+                messages=messages,
+                all=False,
+            ),
+            users=[user_id],
+            realm_id=1,
+        )
+
+    def test_coalesce_flags(self) -> None:
+        notices = [
+            self.flags_notice(10, [1, 2]),
+            self.flags_notice(10, [2, 3]),
+            self.flags_notice(11, [4]),
+            self.flags_notice(11, [5], flag="starred"),
+            self.flags_notice(11, [6], operation="remove", flag="starred"),
+            self.flags_notice(11, [7], operation="remove", flag="starred"),
+        ]
+        coalesced = coalesce_notices(notices)
+        self.assertEqual(
+            [(notice["users"], notice["event"]["messages"]) for notice in coalesced],
+            [([10], [1, 2, 3]), ([11], [4]), ([11], [5]), ([11], [6, 7])],
+        )
+        # The original notices aren't modified, since they may be retried.
+        self.assertEqual(notices[0]["event"]["messages"], [1, 2])
+
+        # Marking everything as read isn't combined with anything.
+        all_notice = self.flags_notice(10, [])
+        all_notice["event"]["all"] = True
+        self.assert_length(coalesce_notices([self.flags_notice(10, [1]), all_notice]), 2)
+
+        # Nor are notices for different realms.
+        other_realm_notice = self.flags_notice(10, [2])
+        other_realm_notice["realm_id"] = 2
+        self.assert_length(coalesce_notices([self.flags_notice(10, [1]), other_realm_notice]), 2)
+
+    def test_coalesce_presence_and_typing(self) -> None:
+        def presence_notice(user_id: int, client: str, timestamp: int) -> Dict[str, Any]:
+            return dict(
+                event=dict(
+                    type="presence",
+                    email=f"user{user_id}@example.com",
+                    user_id=user_id,
+                    server_timestamp=timestamp,
+                    presence={client: dict(client=client, status="active", timestamp=timestamp)},
+                ),
+                users=[10, 11],
+            )
+
+        coalesced = coalesce_notices(
+            [
+                presence_notice(1, "website", 100),
+                presence_notice(1, "ZulipMobile", 101),
+                presence_notice(1, "website", 102),
+                presence_notice(2, "website", 103),
+            ]
+        )
+        self.assert_length(coalesced, 2)
+        self.assertEqual(coalesced[0]["event"]["server_timestamp"], 102)
+        self.assertEqual(
+            {
+                client: presence["timestamp"]
+                for client, presence in coalesced[0]["event"]["presence"].items()
+            },
+            {"website": 102, "ZulipMobile": 101},
+        )
+
+        typing_event = dict(type="typing", op="start", message_type="stream", stream_id=1)
+        typing_notice = dict(event=typing_event, users=[10, 11])
+        stop_notice = dict(event=dict(typing_event, op="stop"), users=[10, 11])
+        self.assertEqual(
+            coalesce_notices([typing_notice, dict(typing_notice), stop_notice]),
+            [typing_notice, stop_notice],
+        )
+
+    def test_wrapped_process_notification(self) -> None:
+        hamlet = self.example_user("hamlet")
+        client = allocate_client_descriptor(
+            dict(
+                user_profile_id=hamlet.id,
+                realm_id=hamlet.realm_id,
+                event_types=None,
+                client_type_name="website",
+                apply_markdown=True,
+                client_gravatar=True,
+                all_public_streams=False,
+                queue_timeout=600,
+                last_connection_time=time.time(),
+                narrow=[],
+            )
+        )
+        notices = [
+            self.flags_notice(hamlet.id, [1]),
+            self.flags_notice(hamlet.id, [2]),
+            self.flags_notice(hamlet.id, [3], flag="starred"),
+        ]
+        for notice in notices:
+            notice["realm_id"] = hamlet.realm_id
+        process_notifications = get_wrapped_process_notification("notify_tornado")
+
+        with self.settings(TORNADO_COALESCE_NOTICES=True), mock.patch(
+            "zerver.tornado.event_queue.statsd"
+        ) as statsd:
+            process_notifications(notices)
+        statsd.incr.assert_has_calls(
+            [mock.call("tornado.notices.received", 3), mock.call("tornado.notices.processed", 2)]
+        )
+        events = client.event_queue.contents()
+        self.assertEqual(
+            [(event["flag"], event["messages"]) for event in events],
+            [("read", [1, 2]), ("starred", [3])],
+        )
+
+
 class PruneInternalDataTest(ZulipTestCase):
     def test_prune_internal_data(self) -> None:
         user_profile = self.example_user("hamlet")
@@ -535,12 +1450,49 @@ class PruneInternalDataTest(ZulipTestCase):
         self.assertFalse("internal_data" in events[1])
         self.assertFalse("internal_data" in events[2])
 
+        # Pruning doesn't copy (or modify) the message payloads, which
+        # are shared with any other queues that received the message.
+        queued_events = list(client.event_queue.queue)
+        self.assertTrue("internal_data" in queued_events[0])
+        self.assertIs(events[0]["message"], queued_events[0]["message"])
+
         events = client.event_queue.contents(include_internal_data=True)
         self.assertTrue("internal_data" in events[0])
         self.assertTrue("internal_data" in events[1])
         self.assertTrue("internal_data" in events[2])
 
 
+class EventSerializationTest(ZulipTestCase):
+    def test_json_events_response(self) -> None:
+        payload = dict(id=1, content="<p>hello</p>", sender_id=2)
+        data = dict(
+            events=[
+                dict(id=0, type="message", message=payload, flags=["read"]),
+                dict(id=1, type="message", message=payload, flags=[]),
+                dict(id=2, type="heartbeat"),
+            ],
+            queue_id="1:0",
+        )
+        response = json_events_response(data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            orjson.loads(response.content), orjson.loads(json_response(data=data).content)
+        )
+
+        # The payload is serialized only once, however many events share it.
+        self.assertIs(serialized_payloads[id(payload)][0], payload)
+        serialized = serialize_message_payload(payload)
+        self.assertIs(serialize_message_payload(payload), serialized)
+
+        with mock.patch("zerver.tornado.event_serialization.SERIALIZED_PAYLOAD_CACHE_SIZE", 1):
+            other_payload = dict(id=2, content="<p>world</p>", sender_id=2)
+            serialize_message_payload(other_payload)
+        self.assertNotIn(id(payload), serialized_payloads)
+
+        response = json_events_response(data=dict(events=[]))
+        self.assertEqual(orjson.loads(response.content), dict(result="success", msg="", events=[]))
+
+
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
         hamlet = self.example_user("hamlet")
@@ -804,6 +1756,131 @@ class EventQueueTest(ZulipTestCase):
         queue.prune(1)
         self.verify_to_dict_end_to_end(client)
 
+    def test_compact_representation(self) -> None:
+        hamlet = self.example_user("hamlet")
+
+        def allocate_client(event_types: List[str], narrow: List[List[str]]) -> ClientDescriptor:
+            return allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=False,
+                    client_gravatar=True,
+                    client_type_name="".join(["Zulip", "Mobile"]),
+                    event_types=event_types,
+                    last_connection_time=time.time(),
+                    narrow=narrow,
+                    queue_timeout=0,
+                    realm_id=hamlet.realm_id,
+                    user_profile_id=hamlet.id,
+                )
+            )
+
+        client = allocate_client(["message", "typing"], [])
+        other_client = allocate_client(["message", "typing"], [])
+        self.assertIs(client.event_types, other_client.event_types)
+        self.assertIs(client.client_type_name, other_client.client_type_name)
+        self.assertFalse(hasattr(client, "__dict__"))
+        self.assertEqual(client.to_dict()["event_types"], ["message", "typing"])
+        self.verify_to_dict_end_to_end(client)
+
+        # Narrows are validated immediately, but the filter is only
+        # built when needed.
+        with self.assertRaises(JsonableError):
+            allocate_client(["message"], [["search", "foo"]])
+        narrowed_client = allocate_client(["message"], [["is", "private"]])
+        self.assertIsNone(narrowed_client._narrow_filter)
+        self.assertFalse(
+            narrowed_client.accepts_event(
+                dict(type="message", message=dict(type="stream"), flags=[])
+            )
+        )
+        self.assertIsNotNone(narrowed_client._narrow_filter)
+
+    def test_queue_limits(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        event = dict(type="arbitrary", value="x" * 100)
+
+        # Without a byte limit, we don't serialize events to measure them.
+        with mock.patch("zerver.tornado.event_queue.event_size") as event_size:
+            queue.push(event)
+        event_size.assert_not_called()
+        self.assertIsNone(queue.event_sizes)
+        queue.prune(0)
+        # Nor do we report their size.
+        with mock.patch("zerver.tornado.event_queue.statsd") as statsd, mock.patch(
+            "zerver.tornado.event_queue.gc_heap", []
+        ):
+            gc_event_queues(9800)
+        self.assertNotIn(
+            "tornado.queued_bytes", [call.args[0] for call in statsd.gauge.call_args_list]
+        )
+
+        with self.settings(TORNADO_EVENT_QUEUE_MAX_EVENTS=3, TORNADO_EVENT_QUEUE_MAX_BYTES=10000):
+            for i in range(3):
+                queue.push(event)
+            self.assertEqual(len(queue.queue), 3)
+            self.assertGreater(queue.queued_bytes, 300)
+            queue.prune(1)
+            assert queue.event_sizes is not None
+            self.assertEqual(queue.queued_bytes, sum(queue.event_sizes))
+            self.assertEqual(len(queue.event_sizes), 2)
+            with mock.patch("zerver.tornado.event_queue.statsd") as statsd, mock.patch(
+                "zerver.tornado.event_queue.gc_heap", []
+            ):
+                gc_event_queues(9800)
+            statsd.gauge.assert_any_call("tornado.queued_bytes", queue.queued_bytes)
+            for i in range(2):
+                queue.push(event)
+
+        # The queue's events are replaced by a virtual event, which
+        # persists across restarts.
+        self.assertEqual(queue.queue, deque())
+        self.assertEqual(queue.queued_bytes, 0)
+        self.assertTrue(queue.resync_required())
+        queue.push(event)
+        self.assertEqual(queue.contents(), [])
+        self.verify_to_dict_end_to_end(client)
+        self.assertTrue(ClientDescriptor.from_dict(client.to_dict()).event_queue.resync_required())
+
+        # When the client next fetches events, it's told to register
+        # a new queue.
+        result = fetch_events(
+            dict(
+                queue_id=queue.id,
+                dont_block=True,
+                last_event_id=4,
+                user_profile_id=client.user_profile_id,
+                client_type_name="website",
+                handler_id=1,
+            )
+        )
+        self.assertEqual(result["type"], "error")
+        self.assertIsInstance(result["exception"], BadEventQueueIdError)
+        self.assertNotIn(queue.id, clients)
+
+        client = self.get_client_descriptor()
+        with self.settings(TORNADO_EVENT_QUEUE_MAX_BYTES=300):
+            client.event_queue.push(event)
+            client.event_queue.push(event)
+            self.assertFalse(client.event_queue.resync_required())
+            client.event_queue.push(event)
+            self.assertTrue(client.event_queue.resync_required())
+
+    def test_message_event_size(self) -> None:
+        payload = dict(id=1, content="x" * 1000)
+        real_dumps = orjson.dumps
+        with mock.patch(
+            "zerver.tornado.event_serialization.orjson.dumps", side_effect=real_dumps
+        ) as dumps, self.settings(TORNADO_EVENT_QUEUE_MAX_BYTES=100000):
+            for i in range(3):
+                queue = self.get_client_descriptor().event_queue
+                event = dict(type="message", message=payload, flags=["read"] * i)
+                queue.push(event)
+                self.assertEqual(queue.queued_bytes, len(serialize_event(dict(event, id=0))))
+        # The payload is serialized once for all the queues.
+        self.assertEqual([call.args[0] for call in dumps.call_args_list].count(payload), 1)
+
 
 class SchemaMigrationsTests(ZulipTestCase):
     def test_reformat_legacy_send_message_event(self) -> None:
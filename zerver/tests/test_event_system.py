@@ -34,8 +34,12 @@ from zerver.models import (
 from zerver.tornado.event_queue import (
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
+    do_gc_event_queues,
+    get_client_descriptor,
     get_client_info_for_message_event,
     process_message_event,
+    realm_clients_all_streams,
+    realm_clients_by_narrow_term,
     send_restart_events,
 )
 from zerver.tornado.views import get_events, get_events_backend
@@ -599,6 +603,63 @@ class ClientDescriptorsTest(ZulipTestCase):
         dct = client_info[client.event_queue.id]
         self.assertEqual(dct["is_sender"], True)
 
+    def test_get_client_info_for_narrowed_clients(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+
+        def allocate_narrowed_client(narrow: List[List[str]]) -> str:
+            client = allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=True,
+                    client_gravatar=True,
+                    client_type_name="website",
+                    event_types=["message"],
+                    last_connection_time=time.time(),
+                    queue_timeout=0,
+                    realm_id=realm.id,
+                    user_profile_id=hamlet.id,
+                    narrow=narrow,
+                )
+            )
+            return client.event_queue.id
+
+        stream_queue_id = allocate_narrowed_client([["stream", "Denmark"]])
+        other_stream_queue_id = allocate_narrowed_client([["stream", "Verona"]])
+        sender_queue_id = allocate_narrowed_client([["sender", "Othello@zulip.com"]])
+        topic_queue_id = allocate_narrowed_client([["topic", "Lunch"]])
+        private_queue_id = allocate_narrowed_client([["is", "private"]])
+        starred_queue_id = allocate_narrowed_client([["is", "starred"]])
+
+        # Only queues whose narrow could match are considered.
+        message_event = dict(
+            realm_id=realm.id,
+            stream_name="denmark",
+            message_dict=dict(sender_email="othello@zulip.com", subject="lunch"),
+        )
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(
+            set(client_info.keys()),
+            {stream_queue_id, sender_queue_id, topic_queue_id, starred_queue_id},
+        )
+
+        message_event = dict(realm_id=realm.id, stream_name="Verona")
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(set(client_info.keys()), {other_stream_queue_id, starred_queue_id})
+
+        do_gc_event_queues(
+            {stream_queue_id, sender_queue_id, topic_queue_id, private_queue_id},
+            {hamlet.id},
+            {realm.id},
+        )
+        self.assertEqual(
+            realm_clients_by_narrow_term[realm.id],
+            {("stream", "verona"): [get_client_descriptor(other_stream_queue_id)]},
+        )
+        do_gc_event_queues({other_stream_queue_id, starred_queue_id}, {hamlet.id}, {realm.id})
+        self.assertEqual(realm_clients_by_narrow_term, {})
+        self.assertEqual(realm_clients_all_streams, {})
+
     def test_get_client_info_for_normal_users(self) -> None:
         hamlet = self.example_user("hamlet")
         cordelia = self.example_user("cordelia")
@@ -980,7 +1041,7 @@ class FetchQueriesTest(ZulipTestCase):
             with mock.patch("zerver.lib.events.always_want") as want_mock:
                 fetch_initial_state_data(user)
 
-        self.assert_length(queries, 33)
+        self.assert_length(queries, 34)
 
         expected_counts = dict(
             alert_words=1,
@@ -1010,7 +1071,7 @@ class FetchQueriesTest(ZulipTestCase):
             subscription=4,
             update_display_settings=0,
             update_global_notifications=0,
-            update_message_flags=5,
+            update_message_flags=6,
             user_status=1,
             video_calls=0,
             giphy=0,
@@ -97,6 +97,7 @@ from zerver.lib.actions import (
     do_update_user_presence,
     do_update_user_status,
     lookup_default_stream_groups,
+    notify_pipelined_send_failed,
     remove_members_from_user_group,
     try_add_realm_custom_profile_field,
     try_update_realm_custom_profile_field,
@@ -115,6 +116,7 @@ from zerver.lib.event_schema import (
     check_hotspots,
     check_invites_changed,
     check_message,
+    check_message_send_failed,
     check_muted_topics,
     check_muted_users,
     check_presence,
@@ -168,6 +170,7 @@ from zerver.lib.events import (
     fetch_initial_state_data,
     post_process_state,
 )
+from zerver.lib.exceptions import JsonableError
 from zerver.lib.mention import MentionData
 from zerver.lib.message import render_markdown
 from zerver.lib.test_classes import ZulipTestCase
@@ -206,6 +209,7 @@ from zerver.tornado.event_queue import (
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
     create_heartbeat_event,
+    get_client_descriptors_for_user,
     send_restart_events,
 )
 from zerver.views.realm_playgrounds import access_playground_by_id
@@ -2011,6 +2015,33 @@ class NormalActionsTest(BaseAction):
         events = self.verify_action(lambda: do_set_zoom_token(self.user_profile, None))
         check_has_zoom_token("events[0]", events[0], value=False)
 
+    def test_message_send_failed(self) -> None:
+        def notify() -> None:
+            [client] = get_client_descriptors_for_user(self.user_profile.id)
+            notify_pipelined_send_failed(
+                dict(
+                    sender_id=self.user_profile.id,
+                    sender_queue_id=client.event_queue.id,
+                    local_id="1.01",
+                ),
+                JsonableError("Stream 'nonexistent' does not exist"),
+            )
+
+        events = self.verify_action(notify, state_change_expected=False)
+        check_message_send_failed("events[0]", events[0])
+        self.assertEqual(events[0]["local_id"], "1.01")
+        self.assertNotIn("queue_id", events[0])
+
+        # Only the client that sent the message gets the event.
+        self.verify_action(
+            lambda: notify_pipelined_send_failed(
+                dict(sender_id=self.user_profile.id, sender_queue_id="other", local_id="1.02"),
+                JsonableError("Stream 'nonexistent' does not exist"),
+            ),
+            state_change_expected=False,
+            num_events=0,
+        )
+
     def test_restart_event(self) -> None:
         with self.assertRaises(RestartEventException):
             self.verify_action(lambda: send_restart_events(immediate=True))
@@ -3,6 +3,7 @@ from typing import Callable
 from unittest import mock, skipUnless
 
 import DNS
+import orjson
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse
@@ -134,6 +135,26 @@ class RateLimitTests(ZulipTestCase):
         newlimit = int(result["X-RateLimit-Remaining"])
         self.assertEqual(limit, newlimit + 1)
 
+    def test_ratelimit_message_batch(self) -> None:
+        user = self.example_user("hamlet")
+        RateLimitedUser(user).clear_history()
+        messages = [
+            dict(type="stream", to="Verona", topic="whatever", content=f"message {i}")
+            for i in range(3)
+        ]
+
+        # Each message in a batch counts as a request.
+        result = self.api_post(
+            user, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assert_json_success(result)
+        self.assertEqual(int(result["X-RateLimit-Remaining"]), 2)
+
+        result = self.api_post(
+            user, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assertEqual(result.status_code, 429)
+
     def do_test_hit_ratelimits(self, request_func: Callable[[], HttpResponse]) -> HttpResponse:
         start_time = time.time()
         for i in range(6):
@@ -13,6 +13,7 @@ from markdown import Markdown
 from zerver.lib.actions import (
     change_user_is_active,
     do_add_alert_words,
+    do_change_full_name,
     do_create_realm,
     do_remove_realm_emoji,
     do_set_realm_property,
@@ -24,6 +25,7 @@ from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.exceptions import MarkdownRenderingException
 from zerver.lib.markdown import (
+    LinkifierMatcher,
     MarkdownListPreprocessor,
     MessageRenderingResult,
     clear_state_for_testing,
@@ -39,6 +41,7 @@ from zerver.lib.markdown import (
     url_to_a,
 )
 from zerver.lib.markdown.fenced_code import FencedBlockPreprocessor
+from zerver.lib.markdown.pool import MarkdownRenderingPool
 from zerver.lib.mdiff import diff_strings
 from zerver.lib.mention import (
     MentionData,
@@ -49,7 +52,8 @@ from zerver.lib.mention import (
 from zerver.lib.message import render_markdown
 from zerver.lib.request import JsonableError
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.tex import render_tex
+from zerver.lib.tex import KatexServerError, render_tex, render_tex_with_katex_server
+from zerver.lib.types import LinkifierDict
 from zerver.lib.user_groups import create_user_group
 from zerver.models import (
     Message,
@@ -287,6 +291,44 @@ class MarkdownMiscTest(ZulipTestCase):
                 render_tex("random text")
             self.assertEqual(m.output, ["ERROR:root:Cannot find KaTeX for latex rendering!"])
 
+    def test_katex_server_error(self) -> None:
+        render_tex_with_katex_server.cache_clear()
+        with mock.patch(
+            "zerver.lib.tex.KatexServer.render", side_effect=KatexServerError
+        ), self.assertLogs(level="ERROR") as m:
+            self.assertIsNone(render_tex("x^2"))
+        self.assertEqual(
+            m.output[0].splitlines()[0], "ERROR:root:Error communicating with the KaTeX server"
+        )
+
+        # The next formula is rendered by a new KaTeX process.
+        rendered = render_tex("x^2")
+        assert rendered is not None
+        self.assertIn("katex", rendered)
+
+    def test_markdown_rendering_pool(self) -> None:
+        realm = get_realm("zulip")
+        requests = [("**bold**", False, False), (":)", False, True), ("#**Denmark**", True, False)]
+        with MarkdownRenderingPool(realm, 1) as pool:
+            self.assertEqual(
+                pool.render(requests),
+                [
+                    markdown_convert(
+                        content,
+                        message_realm=realm,
+                        sent_by_bot=sent_by_bot,
+                        translate_emoticons=translate_emoticons,
+                    ).rendered_content
+                    for content, sent_by_bot, translate_emoticons in requests
+                ],
+            )
+
+            with mock.patch(
+                "zerver.lib.markdown.pool.markdown_convert",
+                side_effect=MarkdownRenderingException,
+            ):
+                self.assertEqual(pool.render(requests[:1]), [None])
+
 
 class MarkdownListPreprocessorTest(ZulipTestCase):
     # We test that the preprocessor inserts blank lines at correct places.
@@ -1439,8 +1481,8 @@ class MarkdownTest(ZulipTestCase):
         converted = markdown_convert(content, message_realm=realm, message=msg)
         converted_topic = topic_links(realm.id, msg.topic_name())
 
-        # The second linkifier (which was saved later) was ignored as the content was marked AtomicString after first conversion.
-        # There was no easy way to support parsing both linkifiers and not run into an infinite loop, hence the second linkifier is ignored.
+        # The second linkifier (which was saved later) was ignored, since where
+        # linkifiers' matches overlap, only the first linkifier's match is linked.
         self.assertEqual(
             converted.rendered_content,
             '<p>We should fix <a href="https://trac.example.com/ticket/ABC-123">ABC-123</a> or <a href="https://trac.example.com/ticket/16">trac ABC-123</a> today.</p>',
@@ -1503,6 +1545,65 @@ class MarkdownTest(ZulipTestCase):
         converted_boring_topic = topic_links(realm.id, boring_msg.topic_name())
         self.assertEqual(converted_boring_topic, [])
 
+    def test_linkifier_matcher(self) -> None:
+        linkifiers: List[LinkifierDict] = [
+            {
+                "pattern": r"#(?P<id>[0-9]+)",
+                "url_format": "https://trac.example.com/%(id)s",
+                "id": 1,
+            },
+            {"pattern": r"GH-(?P<id>[0-9]+)", "url_format": "https://github.com/%(id)s", "id": 2},
+            {
+                "pattern": r"(?P<org>[a-z]+)/(?P<repo>[a-z]+)#(?P<id>[0-9]+)",
+                "url_format": "https://github.com/%(org)s/%(repo)s/pull/%(id)s",
+                "id": 3,
+            },
+        ]
+        matcher = LinkifierMatcher(linkifiers)
+        assert matcher.regex is not None
+        self.assertEqual(
+            [
+                matcher.get_url_and_text(m)
+                for m in matcher.regex.finditer("Fix #12, GH-3 and zulip/zulip#7 (not a#1)")
+            ],
+            [
+                ("https://trac.example.com/12", "#12"),
+                ("https://github.com/3", "GH-3"),
+                ("https://github.com/zulip/zulip/pull/7", "zulip/zulip#7"),
+            ],
+        )
+        self.assertTrue(matcher.might_match("see #12"))
+        self.assertFalse(matcher.might_match("nothing to see"))
+        self.assertFalse(LinkifierMatcher([]).might_match("#12"))
+
+        # Character classes that look like groups can't be renamed
+        # safely, so these linkifiers are applied one at a time.
+        linkifiers.append(
+            {"pattern": r"[(?P<x>]+(?P<id>[0-9]+)", "url_format": "https://x.com/%(id)s", "id": 4}
+        )
+        matcher = LinkifierMatcher(linkifiers)
+        self.assertIsNone(matcher.regex)
+        self.assertTrue(matcher.might_match("nothing to see"))
+
+        realm = get_realm("zulip")
+        for linkifier in linkifiers:
+            RealmFilter(
+                realm=realm, pattern=linkifier["pattern"], url_format_string=linkifier["url_format"]
+            ).save()
+        flush_per_request_caches()
+        self.assertEqual(
+            markdown_convert("Fix #12 and P12", message_realm=realm).rendered_content,
+            '<p>Fix <a href="https://trac.example.com/12">#12</a> and '
+            '<a href="https://x.com/12">P12</a></p>',
+        )
+        self.assertEqual(
+            topic_links(realm.id, "#12 and P12"),
+            [
+                {"url": "https://trac.example.com/12", "text": "#12"},
+                {"url": "https://x.com/12", "text": "P12"},
+            ],
+        )
+
     def test_is_status_message(self) -> None:
         user_profile = self.example_user("othello")
         msg = Message(sender=user_profile, sending_client=get_client("test"))
@@ -1557,6 +1658,68 @@ class MarkdownTest(ZulipTestCase):
         )
         self.assertEqual(rendering_result.user_ids_with_alert_words, set())
 
+    @override_settings(RENDERED_MARKDOWN_CACHE=True)
+    def test_rendered_markdown_cache(self) -> None:
+        othello = self.example_user("othello")
+        cordelia = self.example_user("cordelia")
+        hamlet = self.example_user("hamlet")
+        do_add_alert_words(othello, ["ALERTWORD"])
+        content = "@**Cordelia, lear's daughter**: ALERTWORD in #**Denmark** https://example.com"
+
+        def render(content: str) -> Tuple[Message, MessageRenderingResult, List[str]]:
+            msg = Message(sender=hamlet, sending_client=get_client("test"))
+            with mock.patch("zerver.lib.markdown.statsd") as m:
+                rendering_result = render_markdown(
+                    msg,
+                    content,
+                    realm_alert_words_automaton=get_alert_word_automaton(hamlet.realm),
+                )
+            return msg, rendering_result, [call[0][0] for call in m.incr.call_args_list]
+
+        msg, rendering_result, stats = render(content)
+        self.assertEqual(stats, ["markdown.render_cache.miss"])
+        self.assertEqual(rendering_result.mentions_user_ids, {cordelia.id})
+        self.assertEqual(rendering_result.user_ids_with_alert_words, {othello.id})
+        self.assertTrue(msg.has_link)
+
+        msg, cached_rendering_result, stats = render(content)
+        self.assertEqual(stats, ["markdown.render_cache.hit"])
+        self.assertEqual(cached_rendering_result, rendering_result)
+        self.assertTrue(msg.has_link)
+
+        # Alert words are found using the current alert words, even
+        # when the rendering comes from the cache.
+        do_add_alert_words(cordelia, ["alertword"])
+        msg, rendering_result, stats = render(content)
+        self.assertEqual(stats, ["markdown.render_cache.hit"])
+        self.assertEqual(rendering_result.user_ids_with_alert_words, {othello.id, cordelia.id})
+
+        # Changing data that the rendering depends on misses the cache.
+        do_change_full_name(cordelia, "Cordelia", acting_user=None)
+        msg, rendering_result, stats = render(content)
+        self.assertEqual(stats, ["markdown.render_cache.miss"])
+        self.assertEqual(rendering_result.mentions_user_ids, set())
+
+        # As does changing the realm's default code block language.
+        content = "```\nprint('hello')\n```"
+        msg, rendering_result, stats = render(content)
+        self.assertEqual(stats, ["markdown.render_cache.miss"])
+        do_set_realm_property(
+            hamlet.realm, "default_code_block_language", "python", acting_user=None
+        )
+        msg, python_rendering_result, stats = render(content)
+        self.assertEqual(stats, ["markdown.render_cache.miss"])
+        self.assertNotEqual(
+            python_rendering_result.rendered_content, rendering_result.rendered_content
+        )
+        self.assertIn('data-code-language="Python"', python_rendering_result.rendered_content)
+
+        # Renderings using data from third-party sites aren't cached.
+        content = "https://twitter.com/wdaher/status/287977969287315456"
+        for i in range(2):
+            msg, rendering_result, stats = render(content)
+            self.assertEqual(stats, ["markdown.render_cache.miss"])
+
     def test_alert_words_returns_user_ids_with_alert_words(self) -> None:
         alert_words_for_users: Dict[str, List[str]] = {
             "hamlet": ["how"],
@@ -14,6 +14,7 @@ from sqlalchemy.sql.elements import ClauseElement
 from analytics.lib.counts import COUNT_STATS
 from analytics.models import RealmCount
 from zerver.lib.actions import (
+    do_change_user_delivery_email,
     do_claim_attachments,
     do_deactivate_user,
     do_set_realm_property,
@@ -28,7 +29,7 @@ from zerver.lib.message import (
     render_markdown,
     update_first_visible_message_id,
 )
-from zerver.lib.narrow import build_narrow_filter, is_web_public_compatible
+from zerver.lib.narrow import build_narrow_filter, get_narrow_index_term, is_web_public_compatible
 from zerver.lib.request import JsonableError
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import StreamDict, create_streams_if_needed, get_public_streams_queryset
@@ -57,6 +58,8 @@ from zerver.views.message_fetch import (
     exclude_muting_conditions,
     find_first_unread_anchor,
     get_messages_backend,
+    get_narrow_query_cache_key,
+    narrow_query_cache,
     ok_to_include_history,
     post_process_limited_query,
 )
@@ -550,6 +553,23 @@ class NarrowLibraryTest(ZulipTestCase):
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
 
+    def test_get_narrow_index_term(self) -> None:
+        self.assertEqual(get_narrow_index_term([["stream", "Devel"]]), ("stream", "devel"))
+        self.assertEqual(
+            get_narrow_index_term([["topic", "Python"], ["stream", "devel"]]),
+            ("stream", "devel"),
+        )
+        self.assertEqual(
+            get_narrow_index_term([["topic", "python"], ["sender", "Hamlet@zulip.com"]]),
+            ("sender", "hamlet@zulip.com"),
+        )
+        self.assertEqual(
+            get_narrow_index_term([["is", "starred"], ["topic", "Python"]]), ("topic", "python")
+        )
+        self.assertEqual(get_narrow_index_term([["is", "private"]]), ("is", "private"))
+        self.assertIsNone(get_narrow_index_term([["is", "starred"]]))
+        self.assertIsNone(get_narrow_index_term([]))
+
     def test_is_web_public_compatible(self) -> None:
         self.assertTrue(is_web_public_compatible([]))
         self.assertTrue(is_web_public_compatible([{"operator": "has", "operand": "attachment"}]))
@@ -2801,6 +2821,274 @@ class GetOldMessagesTest(ZulipTestCase):
         result = self.client_get("/json/messages", dict(anchor=1, num_before=0, num_after=6000))
         self.assert_json_error(result, "Too many messages requested (maximum 5000).")
 
+    @override_settings(NARROW_QUERY_CACHE=True)
+    def test_narrow_query_cache(self) -> None:
+        narrow_query_cache.clear()
+        hamlet = self.login("hamlet")
+        cordelia = self.example_user("cordelia")
+        message_ids = [
+            self.send_stream_message(cordelia, "Denmark", f"message {i}", "cached")
+            for i in range(5)
+        ]
+        narrow = [
+            dict(operator="stream", operand="Denmark"),
+            dict(operator="topic", operand="cached"),
+        ]
+
+        def get_message_ids(anchor: int) -> List[int]:
+            result = self.client_get(
+                "/json/messages",
+                dict(
+                    narrow=orjson.dumps(narrow).decode(),
+                    anchor=anchor,
+                    num_before=1,
+                    num_after=0,
+                ),
+            )
+            return [message["id"] for message in self.assert_json_success(result)["messages"]]
+
+        self.assertEqual(get_message_ids(message_ids[-1]), message_ids[-2:])
+        self.assert_length(narrow_query_cache, 1)
+
+        # Fetching more messages in the same narrow reuses the query.
+        with mock.patch(
+            "zerver.views.message_fetch.add_narrow_conditions"
+        ) as add_narrow_conditions:
+            self.assertEqual(get_message_ids(message_ids[-3]), message_ids[-4:-2])
+        add_narrow_conditions.assert_not_called()
+        self.assert_length(narrow_query_cache, 1)
+
+        # Streams are identified by their recipient, however they're named.
+        stream = get_stream("Denmark", hamlet.realm)
+        range_params = dict(before_anchor=message_ids[-1], before_limit=2)
+        key = get_narrow_query_cache_key(hamlet, hamlet.realm, narrow, False, True, range_params)
+        self.assertIsNotNone(key)
+        self.assertEqual(
+            get_narrow_query_cache_key(
+                hamlet,
+                hamlet.realm,
+                [dict(operator="stream", operand=stream.id), narrow[1]],
+                False,
+                True,
+                range_params,
+            ),
+            key,
+        )
+
+        # And users by their ID, however they're named.
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        for email_term, id_term in [
+            (
+                dict(operator="sender", operand=cordelia.email),
+                dict(operator="sender", operand=cordelia.id),
+            ),
+            (
+                dict(operator="pm-with", operand=f"{othello.email},{cordelia.email}"),
+                dict(operator="pm-with", operand=[cordelia.id, othello.id]),
+            ),
+        ]:
+            key = get_narrow_query_cache_key(
+                hamlet, hamlet.realm, [email_term], False, False, range_params
+            )
+            self.assertIsNotNone(key)
+            self.assertEqual(
+                get_narrow_query_cache_key(
+                    hamlet, hamlet.realm, [id_term], False, False, range_params
+                ),
+                key,
+            )
+
+        do_change_user_delivery_email(cordelia, "new-cordelia@zulip.com")
+        self.assertIsNone(
+            get_narrow_query_cache_key(
+                hamlet,
+                hamlet.realm,
+                [dict(operator="sender", operand="cordelia@zulip.com")],
+                False,
+                False,
+                range_params,
+            )
+        )
+
+        # The conditions for some operators depend on more than the
+        # operand, so they aren't cached.
+        self.assertIsNone(
+            get_narrow_query_cache_key(
+                hamlet,
+                hamlet.realm,
+                [dict(operator="in", operand="home")],
+                False,
+                False,
+                range_params,
+            )
+        )
+
+    def test_get_messages_with_cursor(self) -> None:
+        hamlet = self.login("hamlet")
+        cordelia = self.example_user("cordelia")
+        self.subscribe(hamlet, "Scotland")
+        self.subscribe(cordelia, "Scotland")
+        message_ids = [
+            self.send_stream_message(cordelia, "Scotland", f"message {i}") for i in range(10)
+        ]
+        narrow = orjson.dumps([dict(operator="stream", operand="Scotland")]).decode()
+
+        def get_messages(params: Dict[str, Union[str, int]]) -> Dict[str, Any]:
+            result = self.client_get("/json/messages", dict(narrow=narrow, **params))
+            return self.assert_json_success(result)
+
+        result = get_messages(dict(anchor="newest", num_before=4, num_after=0))
+        self.assertEqual([message["id"] for message in result["messages"]], message_ids[-4:])
+
+        # Scroll back through the narrow with the cursors.
+        result = get_messages(dict(cursor=result["cursor"], num_before=4, num_after=0))
+        self.assertEqual([message["id"] for message in result["messages"]], message_ids[-8:-4])
+        self.assertFalse(result["found_anchor"])
+        self.assertFalse(result["found_oldest"])
+
+        # The cursor covers everything fetched so far, so fetching
+        # newer messages only returns ones sent since.
+        new_message_id = self.send_stream_message(cordelia, "Scotland", "new message")
+        result = get_messages(dict(cursor=result["cursor"], num_before=0, num_after=4))
+        self.assertEqual([message["id"] for message in result["messages"]], [new_message_id])
+        self.assertTrue(result["found_newest"])
+
+        result = get_messages(dict(cursor=result["cursor"], num_before=1000, num_after=4))
+        self.assertEqual([message["id"] for message in result["messages"]][-2:], message_ids[:2])
+        self.assertTrue(result["found_oldest"])
+        self.assertTrue(result["found_newest"])
+
+        cursor = result["cursor"]
+        result = self.client_get(
+            "/json/messages",
+            dict(narrow=narrow, cursor=cursor, anchor="newest", num_before=1, num_after=0),
+        )
+        self.assert_json_error(result, "Cannot specify both an anchor and a cursor.")
+        result = self.client_get(
+            "/json/messages", dict(narrow=narrow, cursor="invalid", num_before=1, num_after=0)
+        )
+        self.assert_json_error(result, "Invalid cursor")
+
+        # Cursors are only valid for the narrow and user they were issued for.
+        result = self.client_get("/json/messages", dict(cursor=cursor, num_before=1, num_after=0))
+        self.assert_json_error(result, "Invalid cursor")
+        self.login("cordelia")
+        result = self.client_get(
+            "/json/messages", dict(narrow=narrow, cursor=cursor, num_before=1, num_after=0)
+        )
+        self.assert_json_error(result, "Invalid cursor")
+
+        self.login("hamlet")
+        with mock.patch(
+            "zerver.views.message_fetch.MESSAGE_FETCH_CURSOR_MAX_AGE",
+            datetime.timedelta(seconds=-1),
+        ):
+            result = self.client_get(
+                "/json/messages", dict(narrow=narrow, cursor=cursor, num_before=1, num_after=0)
+            )
+        self.assert_json_error(result, "Invalid cursor")
+
+    def test_get_messages_with_cursor_after_losing_access(self) -> None:
+        hamlet = self.login("hamlet")
+        cordelia = self.example_user("cordelia")
+        self.make_stream("private", invite_only=True, history_public_to_subscribers=True)
+        self.subscribe(cordelia, "private")
+        message_ids = [
+            self.send_stream_message(cordelia, "private", f"message {i}") for i in range(4)
+        ]
+        self.subscribe(hamlet, "private")
+        narrow = orjson.dumps([dict(operator="stream", operand="private")]).decode()
+
+        # Hamlet can read the stream's history while subscribed.
+        result = self.client_get(
+            "/json/messages", dict(narrow=narrow, anchor="newest", num_before=2, num_after=0)
+        )
+        result = self.assert_json_success(result)
+        self.assertEqual([message["id"] for message in result["messages"]], message_ids[-2:])
+
+        # But not with the cursor once unsubscribed, since he never
+        # received those messages.
+        self.unsubscribe(hamlet, "private")
+        result = self.client_get(
+            "/json/messages",
+            dict(narrow=narrow, cursor=result["cursor"], num_before=2, num_after=0),
+        )
+        result = self.assert_json_success(result)
+        self.assertEqual(result["messages"], [])
+
+    def test_get_messages_batch(self) -> None:
+        hamlet = self.login("hamlet")
+        cordelia = self.example_user("cordelia")
+        self.subscribe(hamlet, "Scotland")
+        self.subscribe(cordelia, "Scotland")
+        stream_message_ids = [
+            self.send_stream_message(cordelia, "Scotland", f"message {i}") for i in range(3)
+        ]
+        private_message_id = self.send_personal_message(cordelia, hamlet, "private")
+
+        narrows: List[Dict[str, Any]] = [
+            dict(anchor="newest", num_before=5, num_after=0),
+            dict(
+                narrow=[dict(operator="stream", operand="Scotland")],
+                anchor=stream_message_ids[1],
+                num_before=1,
+                num_after=1,
+            ),
+            dict(
+                narrow=[["pm-with", cordelia.email]],
+                anchor="newest",
+                num_before=5,
+                num_after=0,
+            ),
+            dict(
+                narrow=[dict(operator="stream", operand="nonexistent")],
+                anchor="newest",
+                num_before=5,
+                num_after=0,
+            ),
+            dict(cursor="invalid", num_before=5, num_after=0),
+        ]
+        result = self.client_get(
+            "/json/messages/batch", dict(narrows=orjson.dumps(narrows).decode())
+        )
+        results = self.assert_json_success(result)["narrows"]
+        self.assert_length(results, 5)
+        self.assertEqual(
+            [message["id"] for message in results[0]["messages"]][-4:],
+            [*stream_message_ids, private_message_id],
+        )
+        self.assertEqual([message["id"] for message in results[1]["messages"]], stream_message_ids)
+        self.assertEqual(
+            [message["id"] for message in results[2]["messages"]][-1:], [private_message_id]
+        )
+        self.assertEqual(
+            results[3],
+            dict(
+                result="error",
+                msg="Invalid narrow operator: unknown stream nonexistent",
+                code="BAD_NARROW",
+            ),
+        )
+        self.assertEqual(results[4], dict(result="error", msg="Invalid cursor", code="BAD_REQUEST"))
+
+        # Each result is what GET /messages would return for the narrow.
+        for spec, narrow_result in zip(narrows[:3], results):
+            params = dict(spec, narrow=orjson.dumps(spec.get("narrow", [])).decode())
+            expected = self.assert_json_success(self.client_get("/json/messages", params))
+            for key in ["messages", "anchor", "found_anchor", "found_oldest", "found_newest"]:
+                self.assertEqual(narrow_result[key], expected[key])
+
+        result = self.client_get(
+            "/json/messages/batch", dict(narrows=orjson.dumps(narrows[:1] * 21).decode())
+        )
+        self.assert_json_error(result, "Too many narrows; at most 20 can be fetched at once.")
+        narrows = [dict(anchor="newest", num_before=2500, num_after=0)] * 3
+        result = self.client_get(
+            "/json/messages/batch", dict(narrows=orjson.dumps(narrows).decode())
+        )
+        self.assert_json_error(result, "Too many messages requested (maximum 5000).")
+
     def test_bad_int_params(self) -> None:
         """
         num_before, num_after, and narrow must all be non-negative
@@ -5,7 +5,7 @@ import orjson
 from django.db import connection
 from django.http import HttpResponse
 
-from zerver.lib.actions import do_change_stream_invite_only
+from zerver.lib.actions import do_change_stream_invite_only, do_delete_messages
 from zerver.lib.fix_unreads import fix, fix_unsubscribed
 from zerver.lib.message import (
     MessageDict,
@@ -18,11 +18,14 @@ from zerver.lib.message import (
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import get_subscription, queries_captured
 from zerver.lib.topic_mutes import add_topic_mute
+from zerver.lib.unread_summary import get_unread_message_rows, invalidate_unread_summaries
 from zerver.models import (
     Message,
     Recipient,
     Stream,
     Subscription,
+    UnreadMessage,
+    UnreadSummary,
     UserMessage,
     UserProfile,
     get_realm,
@@ -412,6 +415,8 @@ class FixUnreadTests(ZulipTestCase):
         assert_unread(um_muted_topic_id)
         assert_unread(um_muted_stream_id)
         assert_unread(um_unsubscribed_id)
+        get_raw_unread_data(user)
+        self.assertTrue(UnreadSummary.objects.filter(user_profile=user).exists())
 
         # fix unsubscribed
         with connection.cursor() as cursor, self.assertLogs(
@@ -439,8 +444,15 @@ class FixUnreadTests(ZulipTestCase):
         assert_unread(um_muted_stream_id)
         assert_unread(um_normal_id)
 
-        # The unsubscribed entry should change.
+        # The unsubscribed entry should change, and the user's unread
+        # summary is built again without it.
         assert_read(um_unsubscribed_id)
+        self.assertFalse(UnreadSummary.objects.filter(user_profile=user).exists())
+        um_unsubscribed = UserMessage.objects.get(id=um_unsubscribed_id)
+        self.assertNotIn(
+            um_unsubscribed.message_id,
+            [row["message_id"] for row in get_unread_message_rows(user, [], 100)],
+        )
 
         with self.assertLogs("zulip.fix_unreads", "INFO") as info_logs:
             # test idempotency
@@ -976,6 +988,86 @@ class GetUnreadMsgsTest(ZulipTestCase):
         result = get_unread_data()
         self.assertEqual(result["mentions"], [])
 
+    def test_unread_summary(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+
+        def check_unread_data() -> None:
+            # The maintained summary should match the one built
+            # from scratch from the UserMessage rows.
+            maintained_data = get_raw_unread_data(hamlet)
+            invalidate_unread_summaries([hamlet.id])
+            self.assertEqual(get_raw_unread_data(hamlet), maintained_data)
+
+        check_unread_data()
+        self.assertTrue(UnreadSummary.objects.filter(user_profile=hamlet).exists())
+
+        stream_message_id = self.send_stream_message(cordelia, "Denmark", "hello", "summary")
+        self.send_stream_message(cordelia, "Denmark", "@**King Hamlet** hello", "summary")
+        pm_message_id = self.send_personal_message(cordelia, hamlet, "hello")
+        check_unread_data()
+
+        self.login_user(hamlet)
+        result = self.client_post(
+            "/json/messages/flags",
+            {"messages": orjson.dumps([stream_message_id]).decode(), "op": "add", "flag": "read"},
+        )
+        self.assert_json_success(result)
+        check_unread_data()
+
+        result = self.client_post(
+            "/json/messages/flags",
+            {
+                "messages": orjson.dumps([stream_message_id]).decode(),
+                "op": "remove",
+                "flag": "read",
+            },
+        )
+        self.assert_json_success(result)
+        check_unread_data()
+
+        result = self.api_patch(
+            cordelia,
+            f"/api/v1/messages/{stream_message_id}",
+            {"topic": "moved", "propagate_mode": "change_all"},
+        )
+        self.assert_json_success(result)
+        check_unread_data()
+
+        do_delete_messages(hamlet.realm, [Message.objects.get(id=pm_message_id)])
+        check_unread_data()
+
+        result = self.client_post(
+            "/json/mark_stream_as_read", {"stream_id": get_stream("Denmark", hamlet.realm).id}
+        )
+        self.assert_json_success(result)
+        check_unread_data()
+
+        result = self.client_post("/json/mark_all_as_read")
+        self.assert_json_success(result)
+        self.assertFalse(UnreadMessage.objects.filter(user_profile=hamlet).exists())
+        check_unread_data()
+
+    def test_unread_message_rows_limit(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        self.login_user(hamlet)
+        self.client_post("/json/mark_all_as_read")
+
+        message_ids = [
+            self.send_stream_message(cordelia, "Denmark", f"hello {i}", "limited") for i in range(4)
+        ]
+        rows = get_unread_message_rows(hamlet, [], 3)
+        self.assertEqual([row["message_id"] for row in rows], message_ids[1:])
+
+        denmark_recipient_id = get_stream("Denmark", hamlet.realm).recipient_id
+        self.assertEqual(get_unread_message_rows(hamlet, [denmark_recipient_id], 3), [])
+
+        with mock.patch("zerver.lib.message.MAX_UNREAD_MESSAGES", 3):
+            raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(sorted(raw_unread_data["stream_dict"]), message_ids[1:])
+        self.assertTrue(raw_unread_data["old_unreads_missing"])
+
 
 class MessageAccessTests(ZulipTestCase):
     def test_update_invalid_flags(self) -> None:
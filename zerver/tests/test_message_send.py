@@ -1,5 +1,5 @@
 import datetime
-from typing import Any, List, Mapping, Optional, Set
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Set
 from unittest import mock
 
 import orjson
@@ -21,6 +21,7 @@ from zerver.lib.actions import (
     do_create_realm,
     do_create_user,
     do_deactivate_user,
+    do_mute_user,
     do_send_messages,
     do_set_realm_property,
     extract_private_recipients,
@@ -35,12 +36,19 @@ from zerver.lib.actions import (
 )
 from zerver.lib.addressee import Addressee
 from zerver.lib.cache import cache_delete, get_stream_cache_key
-from zerver.lib.message import MessageDict, get_raw_unread_data, get_recent_private_conversations
+from zerver.lib.deferred_user_messages import backfill_deferred_user_messages
+from zerver.lib.message import (
+    MessageDict,
+    SendMessageRequest,
+    get_raw_unread_data,
+    get_recent_private_conversations,
+)
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import (
     get_user_messages,
     make_client,
     message_stream_count,
+    mock_queue_publish,
     most_recent_message,
     most_recent_usermessage,
     queries_captured,
@@ -49,6 +57,7 @@ from zerver.lib.test_helpers import (
 from zerver.lib.timestamp import convert_to_UTC, datetime_to_timestamp
 from zerver.models import (
     MAX_TOPIC_NAME_LENGTH,
+    DeferredUserMessages,
     Message,
     Realm,
     RealmDomain,
@@ -66,6 +75,7 @@ from zerver.models import (
     get_user,
 )
 from zerver.views.message_send import InvalidMirrorInput
+from zerver.worker.queue_processors import PipelinedMessageSendWorker, get_worker
 
 
 class MessagePOSTTest(ZulipTestCase):
@@ -1331,6 +1341,234 @@ class MessagePOSTTest(ZulipTestCase):
         result = self.api_post(sender, "/api/v1/messages", payload)
         self.assert_json_success(result)
 
+    def test_send_message_batch(self) -> None:
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        cordelia = self.example_user("cordelia")
+        self.subscribe(othello, "Verona")
+        self.login_user(hamlet)
+
+        messages = [
+            dict(
+                type="stream",
+                to="Verona",
+                topic="batch",
+                content="First, for @**Othello, the Moor of Venice**",
+            ),
+            dict(type="stream", to="nonexistent", topic="batch", content="Not sent"),
+            dict(type="private", to=[othello.id, cordelia.id], content="Second"),
+            dict(
+                type="stream",
+                to=get_stream("Denmark", hamlet.realm).id,
+                topic="batch",
+                content="Third",
+            ),
+        ]
+        result = self.client_post(
+            "/json/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        results = self.assert_json_success(result)["messages"]
+        self.assert_length(results, 4)
+        self.assertEqual(
+            results[1],
+            dict(
+                result="error",
+                msg="Stream 'nonexistent' does not exist",
+                code="STREAM_DOES_NOT_EXIST",
+            ),
+        )
+
+        message_ids = [results[i]["id"] for i in [0, 2, 3]]
+        self.assertEqual(message_ids, sorted(message_ids))
+        self.assertEqual(
+            [
+                message.content
+                for message in Message.objects.filter(id__in=message_ids).order_by("id")
+            ],
+            ["First, for @**Othello, the Moor of Venice**", "Second", "Third"],
+        )
+
+        # As with POST /messages, the recipients of a private message
+        # can be a comma-separated string of email addresses.
+        result = self.client_post(
+            "/json/messages/batch",
+            {
+                "messages": orjson.dumps(
+                    [dict(type="private", to=f"{othello.email},{cordelia.email}", content="Fourth")]
+                ).decode()
+            },
+        )
+        [message_result] = self.assert_json_success(result)["messages"]
+        message = Message.objects.get(id=message_result["id"])
+        self.assertEqual(message.recipient, Message.objects.get(id=message_ids[1]).recipient)
+        self.assertTrue(
+            UserMessage.objects.get(user_profile=othello, message_id=message_ids[0]).flags.mentioned
+        )
+        self.assertFalse(
+            UserMessage.objects.get(user_profile=othello, message_id=message_ids[1]).flags.mentioned
+        )
+
+        result = self.client_post(
+            "/json/messages/batch", {"messages": orjson.dumps([messages[0]] * 101).decode()}
+        )
+        self.assert_json_error(result, "Too many messages; at most 100 can be sent at once.")
+
+    def pipelined_message_send_worker(self) -> PipelinedMessageSendWorker:
+        worker = get_worker("pipelined_message_send")
+        assert isinstance(worker, PipelinedMessageSendWorker)
+        return worker
+
+    @override_settings(PIPELINED_MESSAGE_SEND=True)
+    def test_pipelined_send(self) -> None:
+        hamlet = self.example_user("hamlet")
+        self.login_user(hamlet)
+        last_message_id = self.get_last_message().id
+
+        def post_message(payload: Dict[str, str]) -> Dict[str, Any]:
+            with mock_queue_publish("zerver.lib.actions.queue_json_publish") as m:
+                result = self.client_post("/json/messages", payload)
+            self.assert_json_success(result)
+            queued = [call.args[1] for call in m.call_args_list]
+            if queued:
+                self.assertEqual(m.call_args.args[0], "pipelined_message_send")
+                self.assertNotIn("id", result.json())
+            return dict(result=result.json(), queued=queued)
+
+        payload = dict(
+            type="stream",
+            to=orjson.dumps("Verona").decode(),
+            topic="pipelined",
+            content="Pipelined message.",
+            local_id="1.01",
+            queue_id="some_queue_id",
+        )
+        [event] = post_message(payload)["queued"]
+        # Nothing is sent until the queue worker runs.
+        self.assertEqual(self.get_last_message().id, last_message_id)
+
+        events: List[Mapping[str, Any]] = []
+        with self.tornado_redirected_to_list(events, expected_num_events=1):
+            self.pipelined_message_send_worker().consume_batch([event])
+        message = self.get_last_message()
+        self.assertEqual(message.content, "Pipelined message.")
+        self.assertEqual(message.topic_name(), "pipelined")
+        self.assertEqual(events[0]["event"]["local_id"], "1.01")
+        self.assertEqual(events[0]["event"]["sender_queue_id"], "some_queue_id")
+
+        # Validation errors are still returned by the request.
+        result = self.client_post(
+            "/json/messages", dict(payload, to=orjson.dumps("nonexistent").decode())
+        )
+        self.assert_json_error(result, "Stream 'nonexistent' does not exist")
+
+        # With a sharded queue, all of a sender's messages go to the
+        # same shard.
+        with self.settings(PIPELINED_MESSAGE_SEND_SHARDS=4):
+            with mock_queue_publish("zerver.lib.actions.queue_json_publish") as m:
+                self.client_post("/json/messages", payload)
+            self.assertEqual(m.call_args.args[0], f"pipelined_message_send_shard_{hamlet.id % 4}")
+
+        # Requests from clients without local echo are queued too, so
+        # that the sender's messages are sent in order.
+        del payload["local_id"]
+        [event] = post_message(payload)["queued"]
+        self.pipelined_message_send_worker().consume_batch([event])
+        self.assertEqual(self.get_last_message().content, "Pipelined message.")
+
+        # Wildcard mentions the sender may not be allowed to use can
+        # only be checked once the message is rendered, so the
+        # client's queue gets an event if the check fails.
+        do_set_realm_property(
+            hamlet.realm,
+            "wildcard_mention_policy",
+            Realm.WILDCARD_MENTION_POLICY_ADMINS,
+            acting_user=None,
+        )
+        last_message_id = self.get_last_message().id
+        [event] = post_message(dict(payload, local_id="1.02", content="@**all** hi"))["queued"]
+        with mock.patch(
+            "zerver.lib.message.num_subscribers_for_stream_id", return_value=16
+        ), self.tornado_redirected_to_list(events, expected_num_events=1):
+            self.pipelined_message_send_worker().consume_batch([event])
+        self.assertEqual(self.get_last_message().id, last_message_id)
+        self.assertEqual(
+            events[0]["event"],
+            dict(
+                type="message_send_failed",
+                queue_id="some_queue_id",
+                local_id="1.02",
+                msg="You do not have permission to use wildcard mentions in this stream.",
+                code="BAD_REQUEST",
+            ),
+        )
+        self.assertEqual(events[0]["users"], [hamlet.id])
+
+        # If the message can't be sent by the time the worker runs, and
+        # the client has no event queue to tell, the Notification Bot
+        # tells the sender why.
+        self.make_stream("private", invite_only=True)
+        self.subscribe(hamlet, "private")
+        payload = dict(payload, to=orjson.dumps("private").decode())
+        del payload["queue_id"]
+        [event] = post_message(payload)["queued"]
+        self.unsubscribe(hamlet, "private")
+        self.pipelined_message_send_worker().consume_batch([event])
+        message = self.get_last_message()
+        self.assertEqual(message.sender.email, settings.NOTIFICATION_BOT)
+        self.assertEqual(message.recipient_id, hamlet.recipient_id)
+        self.assertIn("Your message could not be sent", message.content)
+
+    @override_settings(PIPELINED_MESSAGE_SEND=True)
+    def test_pipelined_send_batch_failure(self) -> None:
+        hamlet = self.example_user("hamlet")
+        self.login_user(hamlet)
+
+        queued = []
+        for i in range(3):
+            with mock_queue_publish("zerver.lib.actions.queue_json_publish") as m:
+                result = self.client_post(
+                    "/json/messages",
+                    dict(
+                        type="stream",
+                        to=orjson.dumps("Verona").decode(),
+                        topic="pipelined",
+                        content=f"Message {i}",
+                        local_id=f"1.0{i}",
+                        queue_id="some_queue_id",
+                    ),
+                )
+            self.assert_json_success(result)
+            queued.append(m.call_args.args[1])
+
+        # If sending the batch fails, its messages are sent one at a
+        # time, so that only the one that fails isn't sent.
+        original_do_send_messages = do_send_messages
+
+        def fail_on_second_message(
+            send_requests: Sequence[Optional[SendMessageRequest]],
+        ) -> List[int]:
+            for send_request in send_requests:
+                if send_request is not None and send_request.message.content == "Message 1":
+                    raise Exception("Oops")
+            return original_do_send_messages(send_requests)
+
+        events: List[Mapping[str, Any]] = []
+        with mock.patch(
+            "zerver.worker.queue_processors.do_send_messages", side_effect=fail_on_second_message
+        ), self.assertLogs(level="ERROR") as logs, self.tornado_redirected_to_list(
+            events, expected_num_events=3
+        ):
+            self.pipelined_message_send_worker().consume_batch(queued)
+        self.assertEqual(len(logs.output), 2)
+
+        messages = Message.objects.filter(subject="pipelined").order_by("id")
+        self.assertEqual([message.content for message in messages], ["Message 0", "Message 2"])
+        [failed_event] = [
+            event["event"] for event in events if event["event"]["type"] == "message_send_failed"
+        ]
+        self.assertEqual(failed_event["local_id"], "1.01")
+        self.assertEqual(failed_event["msg"], "Internal server error")
+
 
 class ScheduledMessageTest(ZulipTestCase):
     def last_scheduled_message(self) -> ScheduledMessage:
@@ -1582,6 +1820,161 @@ class StreamMessagesTest(ZulipTestCase):
         num_active_users = num_extra_users / 2
         self.assertTrue(ums_created > (num_active_users * num_messages))
 
+    def test_bulk_insert_ums_copy(self) -> None:
+        """
+        Checks that inserting UserMessage rows via COPY (see
+        bulk_insert_ums) creates the same rows, with the same flags,
+        as inserting them via INSERT.  To compare the latency of the
+        two, see the benchmark_user_message_inserts management command.
+        """
+        recipient_counts = [5, 20]
+
+        sender = self.example_user("cordelia")
+        realm = sender.realm
+        stream = get_stream("Denmark", realm)
+        recipient = stream.recipient
+        sending_client = make_client(name="test suite")
+        num_users = 0
+
+        def send_test_message() -> int:
+            message = Message(
+                sender=sender,
+                recipient=recipient,
+                content="whatever",
+                date_sent=timezone_now(),
+                sending_client=sending_client,
+            )
+            message.set_topic_name("lunch")
+            do_send_messages([build_message_send_dict(message=message)])
+            return message.id
+
+        for recipient_count in recipient_counts:
+            users = UserProfile.objects.bulk_create(
+                UserProfile(
+                    realm=realm, email=f"bulk{i}@example.com", delivery_email=f"bulk{i}@example.com"
+                )
+                for i in range(num_users, recipient_count)
+            )
+            num_users = max(num_users, recipient_count)
+            Subscription.objects.bulk_create(
+                Subscription(user_profile=user, is_user_active=True, recipient=recipient)
+                for user in users
+            )
+
+            with mock.patch("zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD", 10 ** 9):
+                insert_message_id = send_test_message()
+            with mock.patch("zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD", 0):
+                copy_message_id = send_test_message()
+
+            # Both paths create the same rows, with the same flags.
+            def get_flags(message_id: int) -> Dict[int, int]:
+                return dict(
+                    UserMessage.objects.filter(message_id=message_id).values_list(
+                        "user_profile_id", "flags"
+                    )
+                )
+
+            insert_flags = get_flags(insert_message_id)
+            self.assertGreater(len(insert_flags), recipient_count)
+            self.assertEqual(get_flags(copy_message_id), insert_flags)
+
+    def test_lazy_fan_out(self) -> None:
+        realm = get_realm("zulip")
+        realm.lazy_fan_out_threshold = 2
+        realm.save(update_fields=["lazy_fan_out_threshold"])
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        stream_name = "Verona"
+        subscriber_ids = {user.id for user in self.users_subscribed_to_stream(stream_name, realm)}
+        self.assertIn(cordelia.id, subscriber_ids)
+
+        with mock_queue_publish(
+            "zerver.lib.actions.queue_json_publish"
+        ) as m, self.captureOnCommitCallbacks(execute=True):
+            message_id = self.send_stream_message(
+                self.example_user("iago"), stream_name, content="@**King Hamlet** hello"
+            )
+        m.assert_any_call("deferred_user_messages", {"message_id": message_id}, None)
+
+        def get_user_ids_with_rows() -> Set[int]:
+            return set(
+                UserMessage.objects.filter(message_id=message_id).values_list(
+                    "user_profile_id", flat=True
+                )
+            )
+
+        # Mentioned users get their rows immediately.
+        self.assertIn(hamlet.id, get_user_ids_with_rows())
+        self.assertNotIn(cordelia.id, get_user_ids_with_rows())
+        deferred = DeferredUserMessages.objects.get(message_id=message_id)
+        self.assertIn(cordelia.id, deferred.user_profile_ids)
+        self.assertNotIn(hamlet.id, deferred.user_profile_ids)
+
+        # Reading messages creates the reader's pending rows.
+        self.login_user(cordelia)
+        result = self.client_get(
+            "/json/messages", dict(anchor=message_id, num_before=0, num_after=0)
+        )
+        self.assert_json_success(result)
+        self.assertEqual(most_recent_usermessage(cordelia).message_id, message_id)
+
+        # And the queue worker creates the rest.
+        backfill_deferred_user_messages(message_id)
+        self.assertFalse(DeferredUserMessages.objects.filter(message_id=message_id).exists())
+        # Which is a no-op if it runs again.
+        backfill_deferred_user_messages(message_id)
+        self.assertTrue(set(deferred.user_profile_ids) <= get_user_ids_with_rows())
+        UserMessage.objects.get(user_profile=cordelia, message_id=message_id, flags=0)
+
+        # Messages to private streams are never deferred.
+        self.make_stream("private", invite_only=True)
+        for user in [hamlet, cordelia, self.example_user("othello")]:
+            self.subscribe(user, "private")
+        message_id = self.send_stream_message(hamlet, "private")
+        self.assertFalse(DeferredUserMessages.objects.filter(message_id=message_id).exists())
+        self.assertIn(cordelia.id, get_user_ids_with_rows())
+
+    def test_lazy_fan_out_flags(self) -> None:
+        realm = get_realm("zulip")
+        realm.lazy_fan_out_threshold = 2
+        realm.save(update_fields=["lazy_fan_out_threshold"])
+        iago = self.example_user("iago")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        # Keep the deferred rows from being backfilled straight away.
+        with mock_queue_publish("zerver.lib.actions.queue_json_publish"):
+            message_id = self.send_stream_message(iago, "Verona", content="hello")
+        deferred = DeferredUserMessages.objects.get(message_id=message_id)
+        self.assertIn(cordelia.id, deferred.user_profile_ids)
+        self.assertIn(othello.id, deferred.user_profile_ids)
+
+        # Editing the message to mention a recipient whose row is
+        # deferred creates it, so that it's flagged.
+        self.login_user(iago)
+        result = self.client_patch(
+            f"/json/messages/{message_id}", dict(content="@**Cordelia Lear** hello")
+        )
+        self.assert_json_success(result)
+        um = UserMessage.objects.get(user_profile=cordelia, message_id=message_id)
+        self.assertTrue(um.flags.mentioned)
+        deferred.refresh_from_db()
+        self.assertNotIn(cordelia.id, deferred.user_profile_ids)
+        self.assertIn(othello.id, deferred.user_profile_ids)
+        backfill_deferred_user_messages(message_id)
+        um = UserMessage.objects.get(user_profile=cordelia, message_id=message_id)
+        self.assertTrue(um.flags.mentioned)
+
+        # Muting a user marks their messages as read, including those
+        # whose rows are deferred.
+        with mock_queue_publish("zerver.lib.actions.queue_json_publish"):
+            message_id = self.send_stream_message(iago, "Verona", content="hello again")
+        self.assertFalse(
+            UserMessage.objects.filter(user_profile=othello, message_id=message_id).exists()
+        )
+        do_mute_user(othello, iago)
+        um = UserMessage.objects.get(user_profile=othello, message_id=message_id)
+        self.assertTrue(um.flags.read)
+
     def test_not_too_many_queries(self) -> None:
         recipient_list = [
             self.example_user("hamlet"),
@@ -1,8 +1,18 @@
 from django.utils.timezone import now as timezone_now
 
-from zerver.lib.actions import do_change_stream_invite_only, get_client
+from zerver.lib.actions import do_change_stream_invite_only, do_delete_messages, get_client
+from zerver.lib.retention import restore_all_data_from_archive
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import Message, UserMessage, get_realm, get_stream
+from zerver.lib.topic import get_topic_history_for_stream
+from zerver.models import (
+    Message,
+    Stream,
+    StreamTopic,
+    StreamTopicLog,
+    UserMessage,
+    get_realm,
+    get_stream,
+)
 
 
 class TopicHistoryTest(ZulipTestCase):
@@ -146,6 +156,165 @@ class TopicHistoryTest(ZulipTestCase):
         self.assertNotIn("topic1", [topic["name"] for topic in history])
         self.assertNotIn("topic2", [topic["name"] for topic in history])
 
+    def test_stream_topics(self) -> None:
+        iago = self.example_user("iago")
+        self.login_user(iago)
+        old_stream = self.make_stream("old_stream")
+        new_stream = self.make_stream("new_stream")
+        self.subscribe(iago, old_stream.name)
+        self.subscribe(iago, new_stream.name)
+
+        def assert_stream_topics(stream: Stream) -> None:
+            # The StreamTopic rows should always match the stream's messages.
+            expected = {}
+            for message in Message.objects.filter(recipient=stream.recipient).order_by("id"):
+                topic_upper = message.topic_name().upper()
+                message_count = expected.get(topic_upper, ("", 0, 0))[2] + 1
+                expected[topic_upper] = (message.topic_name(), message.id, message_count)
+            stream_topics = StreamTopic.objects.filter(recipient=stream.recipient)
+            self.assertEqual(
+                {
+                    stream_topic.topic_upper: (
+                        stream_topic.topic_name,
+                        stream_topic.last_message_id,
+                        stream_topic.message_count,
+                    )
+                    for stream_topic in stream_topics
+                },
+                expected,
+            )
+            # Without concurrent sends, nothing is left in the log.
+            self.assertFalse(StreamTopicLog.objects.exists())
+
+        alpha_ids = [
+            self.send_stream_message(iago, "old_stream", topic_name=topic_name)
+            for topic_name in ["alpha", "Alpha", "alpha"]
+        ]
+        beta_ids = [
+            self.send_stream_message(iago, "old_stream", topic_name="beta") for i in range(2)
+        ]
+        assert_stream_topics(old_stream)
+
+        # Rename the latest message in a topic, changing the case of
+        # the topic's name.
+        result = self.client_patch(
+            f"/json/messages/{alpha_ids[-1]}", {"topic": "ALPHA", "propagate_mode": "change_one"}
+        )
+        self.assert_json_success(result)
+        assert_stream_topics(old_stream)
+
+        # Move one message to another topic.
+        result = self.client_patch(
+            f"/json/messages/{beta_ids[-1]}", {"topic": "alpha", "propagate_mode": "change_one"}
+        )
+        self.assert_json_success(result)
+        assert_stream_topics(old_stream)
+
+        # Move a whole topic to another stream.
+        result = self.client_patch(
+            f"/json/messages/{alpha_ids[0]}",
+            {
+                "stream_id": new_stream.id,
+                "propagate_mode": "change_all",
+                "send_notification_to_old_thread": "false",
+                "send_notification_to_new_thread": "false",
+            },
+        )
+        self.assert_json_success(result)
+        self.assertFalse(
+            StreamTopic.objects.filter(recipient=old_stream.recipient, topic_upper="ALPHA").exists()
+        )
+        assert_stream_topics(old_stream)
+        assert_stream_topics(new_stream)
+
+        # Delete the only message left in a topic, and restore it.
+        do_delete_messages(iago.realm, [Message.objects.get(id=beta_ids[0])])
+        self.assertFalse(
+            StreamTopic.objects.filter(recipient=old_stream.recipient, topic_upper="BETA").exists()
+        )
+        assert_stream_topics(old_stream)
+        restore_all_data_from_archive()
+        self.assertTrue(
+            StreamTopic.objects.filter(recipient=old_stream.recipient, topic_upper="BETA").exists()
+        )
+        assert_stream_topics(old_stream)
+
+        endpoint = f"/json/users/me/{new_stream.id}/topics"
+        result = self.client_get(endpoint, {})
+        history = self.assert_json_success(result)["topics"]
+        self.assertEqual(history, [dict(name="alpha", max_id=beta_ids[-1])])
+
+    def test_stream_topic_log(self) -> None:
+        iago = self.example_user("iago")
+        self.login_user(iago)
+        stream = self.make_stream("busy_stream")
+        self.subscribe(iago, stream.name)
+        message_ids = [
+            self.send_stream_message(iago, stream.name, topic_name="busy") for i in range(2)
+        ]
+
+        # Simulate the second message having been sent while another
+        # transaction was sending to the topic.
+        stream_topic = StreamTopic.objects.get(recipient=stream.recipient, topic_upper="BUSY")
+        stream_topic.last_message_id = message_ids[0]
+        stream_topic.message_count = 1
+        stream_topic.save()
+        StreamTopicLog.objects.create(
+            recipient=stream.recipient,
+            topic_upper="BUSY",
+            topic_name="busy",
+            last_message_id=message_ids[1],
+            message_count=1,
+        )
+
+        # Readers see the logged message.
+        endpoint = f"/json/users/me/{stream.id}/topics"
+        result = self.client_get(endpoint, {})
+        history = self.assert_json_success(result)["topics"]
+        self.assertEqual(history, [dict(name="busy", max_id=message_ids[1])])
+
+        # And the next message sent to the topic folds it in.
+        message_ids.append(self.send_stream_message(iago, stream.name, topic_name="Busy"))
+        self.assertFalse(StreamTopicLog.objects.exists())
+        stream_topic.refresh_from_db()
+        self.assertEqual(
+            (stream_topic.topic_name, stream_topic.last_message_id, stream_topic.message_count),
+            ("Busy", message_ids[2], 3),
+        )
+
+        # As does deleting one of the topic's messages.
+        StreamTopicLog.objects.create(
+            recipient=stream.recipient,
+            topic_upper="BUSY",
+            topic_name="busy",
+            last_message_id=message_ids[0],
+            message_count=0,
+        )
+        do_delete_messages(iago.realm, [Message.objects.get(id=message_ids[2])])
+        self.assertFalse(StreamTopicLog.objects.exists())
+        stream_topic.refresh_from_db()
+        self.assertEqual(
+            (stream_topic.topic_name, stream_topic.last_message_id, stream_topic.message_count),
+            ("busy", message_ids[1], 2),
+        )
+
+    def test_topics_history_case_folding(self) -> None:
+        hamlet = self.example_user("hamlet")
+        stream = self.make_stream("case_folding")
+        self.subscribe(hamlet, stream.name)
+        # These are grouped differently by str.lower() and by
+        # Postgres's upper().
+        for topic_name in ["istanbul", "ıstanbul", "Straße", "STRASSE", "straße"]:
+            self.send_stream_message(hamlet, stream.name, topic_name=topic_name)
+
+        # Hamlet received every message in the stream, so the topic
+        # history computed from his messages is the stream's.
+        assert stream.recipient_id is not None
+        self.assertEqual(
+            get_topic_history_for_stream(hamlet, stream.recipient_id, public_history=False),
+            get_topic_history_for_stream(hamlet, stream.recipient_id, public_history=True),
+        )
+
     def test_bad_stream_id(self) -> None:
         self.login("iago")
 
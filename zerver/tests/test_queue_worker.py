@@ -36,6 +36,7 @@ from zerver.worker.queue_processors import (
     FetchLinksEmbedData,
     LoopQueueProcessingWorker,
     MissedMessageWorker,
+    PipelinedMessageSendWorker,
     QueueProcessingWorker,
     get_active_worker_queues,
 )
@@ -734,9 +735,16 @@ class WorkerTest(ZulipTestCase):
         test_queue_names = set(get_active_worker_queues(only_test_queues=True))
         worker_queue_names = {
             queue_class.queue_name
-            for base in [QueueProcessingWorker, EmailSendingWorker, LoopQueueProcessingWorker]
+            for base in [
+                QueueProcessingWorker,
+                EmailSendingWorker,
+                LoopQueueProcessingWorker,
+                PipelinedMessageSendWorker,
+            ]
             for queue_class in base.__subclasses__()
-            if not isabstract(queue_class)
+            # PipelinedMessageSendWorker is registered once per shard,
+            # as a subclass.
+            if not isabstract(queue_class) and queue_class is not PipelinedMessageSendWorker
         }
 
         # Verify that the set of active worker queues equals the set
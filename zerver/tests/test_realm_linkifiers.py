@@ -1,7 +1,15 @@
 import re
-
+from typing import Any, List, Mapping
+
+from zerver.lib.actions import (
+    do_add_linkifier,
+    do_change_full_name,
+    do_deactivate_user,
+    do_rerender_messages,
+    do_update_linkifier,
+)
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import RealmFilter
+from zerver.models import Message, RealmFilter, get_realm
 
 
 class RealmFilterTest(ZulipTestCase):
@@ -206,3 +214,96 @@ class RealmFilterTest(ZulipTestCase):
         data["url_format_string"] = "https://realm.com/my_realm_filter/%(id)s"
         result = self.client_patch(f"/json/realm/filters/{linkifier_id + 1}", info=data)
         self.assert_json_error(result, "Linkifier not found.")
+
+    def test_rerender_messages(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", "Fixed by ZUL-1234")
+        other_message_id = self.send_stream_message(hamlet, "Denmark", "Fixed by nobody")
+        other_rendered_content = Message.objects.get(id=other_message_id).rendered_content
+
+        events: List[Mapping[str, Any]] = []
+        with self.tornado_redirected_to_list(events, expected_num_events=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                linkifier_id = do_add_linkifier(
+                    realm, r"ZUL-(?P<id>\d+)", "https://trac.example.com/ticket/%(id)s"
+                )
+
+        message = Message.objects.get(id=message_id)
+        self.assertIn('href="https://trac.example.com/ticket/1234"', message.rendered_content)
+        self.assertEqual(
+            Message.objects.get(id=other_message_id).rendered_content, other_rendered_content
+        )
+        event = events[2]["event"]
+        self.assertEqual(event["type"], "update_message")
+        self.assertEqual(event["message_ids"], [message_id])
+        self.assertEqual(event["rendered_content"], message.rendered_content)
+        self.assertIn(hamlet.id, [user["id"] for user in events[2]["users"]])
+
+        # Clients fetching the message get the new rendering.
+        self.login_user(hamlet)
+        fetched_message = self.get_messages(anchor=message_id, num_before=0, num_after=0)[0]
+        self.assertEqual(fetched_message["content"], message.rendered_content)
+
+        with self.tornado_redirected_to_list(events, expected_num_events=3):
+            with self.captureOnCommitCallbacks(execute=True):
+                do_update_linkifier(
+                    realm,
+                    linkifier_id,
+                    r"ZUL-(?P<id>\d+)",
+                    "https://trac.example.com/issues/%(id)s",
+                )
+        message = Message.objects.get(id=message_id)
+        self.assertIn('href="https://trac.example.com/issues/1234"', message.rendered_content)
+
+    def test_rerender_messages_with_mentions(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        cordelia = self.example_user("cordelia")
+        message_id = self.send_stream_message(
+            hamlet, "Denmark", "@**Othello, the Moor of Venice** fixed ZUL-1234"
+        )
+        renamed_message_id = self.send_stream_message(
+            hamlet, "Denmark", "@**Cordelia, lear's daughter** fixed ZUL-1235"
+        )
+        renamed_rendered_content = Message.objects.get(id=renamed_message_id).rendered_content
+
+        do_deactivate_user(othello, acting_user=None)
+        do_change_full_name(cordelia, "Cordelia", acting_user=None)
+        with self.captureOnCommitCallbacks(execute=True):
+            do_add_linkifier(realm, r"ZUL-(?P<id>\d+)", "https://trac.example.com/ticket/%(id)s")
+
+        # Mentions of deactivated users are kept.
+        message = Message.objects.get(id=message_id)
+        self.assertIn('href="https://trac.example.com/ticket/1234"', message.rendered_content)
+        self.assertIn(f'data-user-id="{othello.id}"', message.rendered_content)
+
+        # Messages whose mentions would change keep their old rendering.
+        self.assertEqual(
+            Message.objects.get(id=renamed_message_id).rendered_content, renamed_rendered_content
+        )
+
+    def test_rerender_edited_message(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        message_id = self.send_stream_message(hamlet, "Denmark", "Fixed by ZUL-1234")
+        other_message_id = self.send_stream_message(hamlet, "Denmark", "Fixed by ZUL-1235")
+        message = Message.objects.get(id=message_id)
+        other_message = Message.objects.get(id=other_message_id)
+        do_add_linkifier(realm, r"ZUL-(?P<id>\d+)", "https://trac.example.com/ticket/%(id)s")
+
+        # The message is edited after it was fetched to be re-rendered.
+        Message.objects.filter(id=message_id).update(
+            content="Fixed by ZUL-1236", rendered_content="<p>Edited</p>"
+        )
+        do_rerender_messages(realm, [message])
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content, "<p>Edited</p>")
+
+        # Its edit is kept, while other messages are still re-rendered.
+        do_rerender_messages(realm, [message, other_message])
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content, "<p>Edited</p>")
+        self.assertIn(
+            'href="https://trac.example.com/ticket/1235"',
+            Message.objects.get(id=other_message_id).rendered_content,
+        )
@@ -1,6 +1,6 @@
 import datetime
 from email.headerregistry import Address
-from typing import Any, Dict, Iterable, List, Mapping, Optional, TypeVar, Union
+from typing import AbstractSet, Any, Dict, Iterable, List, Mapping, Optional, TypeVar, Union
 from unittest import mock
 
 import orjson
@@ -11,9 +11,11 @@ from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.actions import (
+    RecipientInfoResult,
     change_user_is_active,
     create_users,
     do_change_can_create_users,
+    do_change_notification_settings,
     do_change_user_role,
     do_create_user,
     do_deactivate_user,
@@ -25,6 +27,7 @@ from zerver.lib.actions import (
     get_emails_from_user_ids,
     get_recipient_info,
 )
+from zerver.lib.alert_words import remove_user_alert_words, user_alert_words
 from zerver.lib.avatar import avatar_url, get_gravatar_url
 from zerver.lib.create_user import copy_user_settings
 from zerver.lib.events import do_events_register
@@ -34,6 +37,7 @@ from zerver.lib.send_email import (
     deliver_scheduled_emails,
     send_future_email,
 )
+from zerver.lib.soft_deactivation import do_soft_deactivate_users
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import (
@@ -1690,6 +1694,81 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info["default_bot_user_ids"], {normal_bot.id})
 
+    def test_stream_recipient_info_cache(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        iago = self.example_user("iago")
+        realm = hamlet.realm
+
+        stream_name = "Test stream"
+        topic_name = "test topic"
+
+        for user in [hamlet, cordelia, iago]:
+            self.subscribe(user, stream_name)
+
+        stream = get_stream(stream_name, realm)
+        recipient = stream.recipient
+        assert recipient is not None
+
+        stream_topic = StreamTopicTarget(
+            stream_id=stream.id,
+            topic_name=topic_name,
+        )
+
+        def get_info(
+            possibly_mentioned_user_ids: AbstractSet[int] = set(),
+        ) -> RecipientInfoResult:
+            return get_recipient_info(
+                realm_id=realm.id,
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+                possible_wildcard_mention=False,
+            )
+
+        # The first message creates the cache versions, and the second
+        # fills the cache.
+        get_info()
+        get_info()
+        with queries_captured() as queries:
+            info = get_info()
+        # Only the query for users who muted the topic remains.
+        self.assert_length(queries, 1)
+        self.assertEqual(info["active_user_ids"], {hamlet.id, cordelia.id, iago.id})
+
+        # Bulk subscription changes flush the cache.
+        self.subscribe(othello, stream_name)
+        info = get_info()
+        self.assertEqual(info["active_user_ids"], {hamlet.id, cordelia.id, iago.id, othello.id})
+
+        # As does saving a subscription...
+        sub = get_subscription(stream_name, othello)
+        sub.push_notifications = True
+        sub.save()
+        self.assertEqual(get_info()["stream_push_user_ids"], {othello.id})
+
+        # ... or changing a relevant user setting.
+        do_change_notification_settings(
+            cordelia, "enable_stream_email_notifications", True, acting_user=None
+        )
+        self.assertEqual(get_info()["stream_email_user_ids"], {cordelia.id})
+
+        # Soft-deactivated users without alert words are only included
+        # when mentioned.
+        remove_user_alert_words(iago, user_alert_words(iago))
+        do_soft_deactivate_users([iago])
+        get_info()
+        info = get_info()
+        self.assertNotIn(iago.id, info["active_user_ids"])
+        info = get_info(possibly_mentioned_user_ids={iago.id})
+        self.assertEqual(info["long_term_idle_user_ids"], {iago.id})
+        self.assertIn(iago.id, info["um_eligible_user_ids"])
+
+        self.unsubscribe(othello, stream_name)
+        self.assertNotIn(othello.id, get_info()["active_user_ids"])
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user("hamlet")
         realm = hamlet.realm
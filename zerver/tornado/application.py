@@ -22,6 +22,8 @@ def create_tornado_application() -> tornado.web.Application:
         r"/json/events",
         r"/api/v1/events",
         r"/api/v1/events/internal",
+        r"/rebalance_tornado_event_queues",
+        r"/import_tornado_event_queues",
     )
 
     return tornado.web.Application(
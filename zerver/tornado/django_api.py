@@ -12,7 +12,13 @@ from requests.packages.urllib3.util.retry import Retry
 from zerver.lib.queue import queue_json_publish
 from zerver.models import Client, Realm, UserProfile
 from zerver.tornado.event_queue import process_notification
-from zerver.tornado.sharding import get_tornado_port, get_tornado_uri, notify_tornado_queue_name
+from zerver.tornado.sharding import (
+    get_tornado_port_for_user,
+    get_tornado_ports,
+    get_tornado_uri_for_port,
+    get_user_tornado_uri,
+    notify_tornado_queue_name,
+)
 
 
 class TornadoAdapter(HTTPAdapter):
@@ -80,7 +86,7 @@ def request_event_queue(
     if not settings.USING_TORNADO:
         return None
 
-    tornado_uri = get_tornado_uri(user_profile.realm)
+    tornado_uri = get_user_tornado_uri(user_profile)
     req = {
         "dont_block": "true",
         "apply_markdown": orjson.dumps(apply_markdown),
@@ -110,7 +116,7 @@ def get_user_events(
     if not settings.USING_TORNADO:
         return []
 
-    tornado_uri = get_tornado_uri(user_profile.realm)
+    tornado_uri = get_user_tornado_uri(user_profile)
     post_data: Dict[str, Any] = {
         "queue_id": queue_id,
         "last_event_id": last_event_id,
@@ -123,11 +129,11 @@ def get_user_events(
     return resp.json()["events"]
 
 
-def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
+def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
     if not settings.USING_TORNADO or settings.RUNNING_INSIDE_TORNADO:
         process_notification(data)
     else:
-        tornado_uri = get_tornado_uri(realm)
+        tornado_uri = get_tornado_uri_for_port(port)
         requests_client().post(
             tornado_uri + "/notify_tornado",
             data=dict(data=orjson.dumps(data), secret=settings.SHARED_SECRET),
@@ -149,9 +155,41 @@ def send_event(
 ) -> None:
     """`users` is a list of user IDs, or in some special cases like message
     send/update or embeds, dictionaries containing extra data."""
-    port = get_tornado_port(realm)
+    realm_ports = get_tornado_ports(realm)
+    if len(realm_ports) == 1:
+        send_event_to_tornado_port(realm_ports[0], realm, event, list(users))
+        return
+
+    # This realm's users are sharded between several Tornado
+    # processes; each gets the event for just its own users.
+    users_by_port: Dict[int, List[Union[int, Mapping[str, Any]]]] = {
+        port: [] for port in realm_ports
+    }
+    for user in users:
+        user_profile_id = user if isinstance(user, int) else user["id"]
+        users_by_port[get_tornado_port_for_user(user_profile_id, realm_ports)].append(user)
+
+    # Clients with all_public_streams, or with a narrow, receive
+    # messages sent to public streams regardless of the list of
+    # users, so every process needs those.
+    broadcast = (
+        event["type"] == "message" and "stream_name" in event and not event.get("invite_only")
+    )
+    for port, port_users in users_by_port.items():
+        if port_users or broadcast:
+            send_event_to_tornado_port(port, realm, event, port_users)
+
+
+def send_event_to_tornado_port(
+    port: int,
+    realm: Realm,
+    event: Mapping[str, Any],
+    users: Sequence[Union[int, Mapping[str, Any]]],
+) -> None:
     queue_json_publish(
         notify_tornado_queue_name(port),
-        dict(event=event, users=list(users)),
-        lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs),
+        # realm_id lets a Tornado process forward the notice, if it
+        # has since handed off the realm's event queues.
+        dict(event=event, users=users, realm_id=realm.id),
+        lambda *args, **kwargs: send_notification_http(port, *args, **kwargs),
     )
@@ -2,6 +2,8 @@
 # high-level documentation on how this system works.
 import atexit
 import copy
+import heapq
+import itertools
 import logging
 import os
 import random
@@ -19,50 +21,75 @@ from typing import (
     Deque,
     Dict,
     Iterable,
+    Iterator,
     List,
     Mapping,
     MutableMapping,
+    NamedTuple,
     Optional,
     Sequence,
     Set,
     Tuple,
+    TypeVar,
     Union,
     cast,
 )
+from urllib.parse import urlencode
 
 import orjson
 import tornado.ioloop
 from django.conf import settings
 from django.utils.translation import gettext as _
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPResponse
 from typing_extensions import TypedDict
 
 from version import API_FEATURE_LEVEL, ZULIP_VERSION
 from zerver.decorator import cachify
 from zerver.lib.message import MessageDict
-from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.narrow import (
+    build_narrow_filter,
+    check_supported_events_narrow_filter,
+    get_narrow_index_term,
+)
 from zerver.lib.notification_data import UserMessageNotificationsData
 from zerver.lib.queue import queue_json_publish, retry_event
 from zerver.lib.request import JsonableError
+from zerver.lib.topic import get_topic_from_message_info
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_timer_restart
 from zerver.tornado.autoreload import add_reload_hook
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
-from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.event_serialization import event_size
+from zerver.tornado.exceptions import BadEventQueueIdError, EventQueueMigratedError
 from zerver.tornado.handlers import (
     clear_handler_by_id,
     finish_handler,
     get_handler_by_id,
     handler_stats_string,
 )
+from zerver.tornado.journal import EventQueueJournal, read_journal, remove_if_exists
+from zerver.tornado.sharding import (
+    get_tornado_port_for_user,
+    get_tornado_uri_for_port,
+    notify_tornado_queue_name,
+)
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each run only looks at the queues
+# whose timeout may have passed (see gc_heap), not every queue.
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
 
+# When journaling event queues, we write a fresh checkpoint (allowing
+# us to discard the journal up to that point) every 5 minutes.  The
+# checkpoint is written a chunk of queues at a time, so that it
+# doesn't block the IOLoop.
+EVENT_QUEUE_CHECKPOINT_FREQ_MSECS = 1000 * 60 * 5
+EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE = 1000
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -79,7 +106,45 @@ def create_heartbeat_event() -> Dict[str, str]:
     return dict(type="heartbeat")
 
 
+# A Tornado process can have hundreds of thousands of event queues,
+# most of which were registered by a handful of clients (the web
+# app, the mobile apps, etc.) with the same event_types, so we share
+# a single copy of those between all the queues using them.
+interned_event_types: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+# Shared by all the queues without a narrow; never mutated.
+EMPTY_NARROW: List[List[str]] = []
+
+
+def intern_event_types(event_types: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    if event_types is None:
+        return None
+    key = tuple(sys.intern(event_type) for event_type in event_types)
+    return interned_event_types.setdefault(key, key)
+
+
 class ClientDescriptor:
+    __slots__ = (
+        "user_profile_id",
+        "realm_id",
+        "current_handler_id",
+        "current_client_name",
+        "event_queue",
+        "event_types",
+        "last_connection_time",
+        "apply_markdown",
+        "client_gravatar",
+        "slim_presence",
+        "all_public_streams",
+        "client_type_name",
+        "_timeout_handle",
+        "narrow",
+        "_narrow_filter",
+        "bulk_message_deletion",
+        "stream_typing_notifications",
+        "queue_timeout",
+    )
+
     def __init__(
         self,
         user_profile_id: int,
@@ -105,16 +170,20 @@ class ClientDescriptor:
         self.current_handler_id: Optional[int] = None
         self.current_client_name: Optional[str] = None
         self.event_queue = event_queue
-        self.event_types = event_types
+        self.event_types = intern_event_types(event_types)
         self.last_connection_time = time.time()
         self.apply_markdown = apply_markdown
         self.client_gravatar = client_gravatar
         self.slim_presence = slim_presence
         self.all_public_streams = all_public_streams
-        self.client_type_name = client_type_name
+        self.client_type_name = sys.intern(client_type_name)
         self._timeout_handle: Any = None  # TODO: should be return type of ioloop.call_later
-        self.narrow = narrow
-        self.narrow_filter = build_narrow_filter(narrow)
+        # Most queues aren't narrowed, and the filter for those that
+        # are is only needed once they receive a message, so we build
+        # it lazily; see narrow_filter.
+        check_supported_events_narrow_filter(narrow)
+        self.narrow = narrow if narrow else EMPTY_NARROW
+        self._narrow_filter: Optional[Callable[[Mapping[str, Any]], bool]] = None
         self.bulk_message_deletion = bulk_message_deletion
         self.stream_typing_notifications = stream_typing_notifications
 
@@ -133,7 +202,7 @@ class ClientDescriptor:
             realm_id=self.realm_id,
             event_queue=self.event_queue.to_dict(),
             queue_timeout=self.queue_timeout,
-            event_types=self.event_types,
+            event_types=list(self.event_types) if self.event_types is not None else None,
             last_connection_time=self.last_connection_time,
             apply_markdown=self.apply_markdown,
             client_gravatar=self.client_gravatar,
@@ -178,6 +247,12 @@ class ClientDescriptor:
         ret.last_connection_time = d["last_connection_time"]
         return ret
 
+    @property
+    def narrow_filter(self) -> Callable[[Mapping[str, Any]], bool]:
+        if self._narrow_filter is None:
+            self._narrow_filter = build_narrow_filter(self.narrow)
+        return self._narrow_filter
+
     def prepare_for_pickling(self) -> None:
         self.current_handler_id = None
         self._timeout_handle = None
@@ -234,6 +309,7 @@ class ClientDescriptor:
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        journal_record("touch", self.event_queue.id, self.last_connection_time)
 
         def timeout_callback() -> None:
             self._timeout_handle = None
@@ -285,6 +361,16 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
 
 
 class EventQueue:
+    __slots__ = (
+        "queue",
+        "next_event_id",
+        "newest_pruned_id",
+        "id",
+        "virtual_events",
+        "event_sizes",
+        "queued_bytes",
+    )
+
     def __init__(self, id: str) -> None:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
@@ -295,6 +381,12 @@ class EventQueue:
         self.newest_pruned_id: Optional[int] = -1
         self.id: str = id
         self.virtual_events: Dict[str, Dict[str, Any]] = {}
+        # The serialized size of each event in the queue, which we
+        # only track (serializing each event) if
+        # TORNADO_EVENT_QUEUE_MAX_BYTES is set; otherwise, this is
+        # None, since even an empty deque takes over 600 bytes.
+        self.event_sizes: Optional[Deque[int]] = None
+        self.queued_bytes = 0
 
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
@@ -317,8 +409,29 @@ class EventQueue:
         ret.newest_pruned_id = d.get("newest_pruned_id", None)
         ret.queue = deque(d["queue"])
         ret.virtual_events = d.get("virtual_events", {})
+        ret.compute_sizes()
         return ret
 
+    def compute_sizes(self) -> None:
+        if settings.TORNADO_EVENT_QUEUE_MAX_BYTES is None:
+            self.event_sizes = None
+            self.queued_bytes = 0
+        else:
+            self.event_sizes = deque(event_size(event) for event in self.queue)
+            self.queued_bytes = sum(self.event_sizes)
+
+    def resync_required(self) -> bool:
+        return "resync" in self.virtual_events
+
+    def over_limit(self) -> bool:
+        return (
+            settings.TORNADO_EVENT_QUEUE_MAX_EVENTS is not None
+            and len(self.queue) > settings.TORNADO_EVENT_QUEUE_MAX_EVENTS
+        ) or (
+            settings.TORNADO_EVENT_QUEUE_MAX_BYTES is not None
+            and self.queued_bytes > settings.TORNADO_EVENT_QUEUE_MAX_BYTES
+        )
+
     def push(self, orig_event: Mapping[str, Any]) -> None:
         # By default, we make a shallow copy of the event dictionary
         # to push into the target event queue; this allows the calling
@@ -326,9 +439,13 @@ class EventQueue:
         # This behavior is important because the event_queue system is
         # about to mutate the event dictionary, minimally to add the
         # event_id attribute.
+        journal_push(self.id, orig_event)
         event = dict(orig_event)
         event["id"] = self.next_event_id
         self.next_event_id += 1
+        if self.resync_required():
+            # The client will have to reload all of its state anyway.
+            return
         full_event_type = compute_full_event_type(event)
         if full_event_type == "restart" or full_event_type.startswith("flags/"):
             if full_event_type not in self.virtual_events:
@@ -346,11 +463,32 @@ class EventQueue:
                 virtual_event["messages"] += event["messages"]
         else:
             self.queue.append(event)
+            if settings.TORNADO_EVENT_QUEUE_MAX_BYTES is not None:
+                if self.event_sizes is not None and len(self.event_sizes) == len(self.queue) - 1:
+                    size = event_size(event)
+                    self.event_sizes.append(size)
+                    self.queued_bytes += size
+                else:
+                    # The limit was configured after some of the
+                    # events were pushed.
+                    self.compute_sizes()
+            if self.over_limit():
+                # Rather than letting the queue of a client that isn't
+                # fetching its events grow without bound, we discard
+                # its events, and replace them with a virtual event
+                # requiring the client to register a new queue; see
+                # fetch_events.
+                self.queue.clear()
+                self.event_sizes = None
+                self.queued_bytes = 0
+                self.virtual_events = {"resync": dict(type="resync", id=event["id"])}
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self) -> Dict[str, Any]:
+        if self.event_sizes:
+            self.queued_bytes -= self.event_sizes.popleft()
         return self.queue.popleft()
 
     def empty(self) -> bool:
@@ -358,12 +496,27 @@ class EventQueue:
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
+        if len(self.queue) != 0 and self.queue[0]["id"] <= through_id:
+            journal_record("prune", self.id, through_id)
         while len(self.queue) != 0 and self.queue[0]["id"] <= through_id:
-            self.newest_pruned_id = self.queue[0]["id"]
-            self.pop()
+            self.newest_pruned_id = self.queue.popleft()["id"]
+            if self.event_sizes:
+                self.queued_bytes -= self.event_sizes.popleft()
 
     def contents(self, include_internal_data: bool = False) -> List[Dict[str, Any]]:
-        contents: List[Dict[str, Any]] = []
+        if self.resync_required():
+            return []
+        if not self.virtual_events:
+            contents = list(self.queue)
+            if include_internal_data:
+                return contents
+            return prune_internal_data(contents)
+
+        # Converting the virtual events to real events changes how
+        # future events are collapsed, so it needs to be replayed.
+        journal_record("contents", self.id)
+
+        contents = []
         virtual_id_map: Dict[str, Dict[str, Any]] = {}
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
@@ -383,6 +536,7 @@ class EventQueue:
 
         self.virtual_events = {}
         self.queue = deque(contents)
+        self.compute_sizes()
 
         if include_internal_data:
             return contents
@@ -392,12 +546,18 @@ class EventQueue:
 def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Prunes the internal_data data structures, which are not intended to
     be exposed to API clients.
+
+    The payloads of events (e.g. the `message` dictionary of message
+    events) are shared between all the event queues that received the
+    event, and are never mutated once pushed, so we only copy the
+    top-level dictionary of the events we need to prune.
     """
-    events = copy.deepcopy(events)
-    for event in events:
-        if event["type"] == "message" and "internal_data" in event:
-            del event["internal_data"]
-    return events
+    return [
+        {key: value for key, value in event.items() if key != "internal_data"}
+        if event["type"] == "message" and "internal_data" in event
+        else event
+        for event in events
+    ]
 
 
 # maps queue ids to client descriptors
@@ -405,7 +565,18 @@ clients: Dict[str, ClientDescriptor] = {}
 # maps user id to list of client descriptors
 user_clients: Dict[int, List[ClientDescriptor]] = {}
 # maps realm id to list of client descriptors with all_public_streams=True
+# (or a narrow), except those indexed in realm_clients_by_narrow_term
 realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
+# maps realm id to narrow term to list of client descriptors with
+# all_public_streams=True (or a narrow) whose narrow only matches
+# stream messages matching that term; see get_narrow_index_term.
+realm_clients_by_narrow_term: Dict[int, Dict[Tuple[str, str], List[ClientDescriptor]]] = {}
+
+# heap of (time at which the queue may expire, queue id), with exactly
+# one entry per event queue.  Rather than updating the heap every time
+# a client connects, gc_event_queues reschedules entries for queues
+# that turn out to have been used since the entry was added.
+gc_heap: List[Tuple[float, str]] = []
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -416,13 +587,92 @@ gc_hooks: List[Callable[[int, ClientDescriptor, bool], None]] = []
 
 next_queue_id = 0
 
+# The port of this Tornado process, set by setup_event_queue.  When
+# running several Tornado processes, it's included in queue IDs, so
+# that they remain unique when queues are handed off between them.
+tornado_port: Optional[int] = None
+
+
+class MigratedQueue(NamedTuple):
+    port: int
+    realm_id: int
+    # When we stop telling clients to retry with the queue.  By then,
+    # the queue has expired in the other process, unless the client
+    # has reconnected to it there.
+    expires: float
+
+
+# Realms, and event queues, that have been handed off to another
+# Tornado process (see migrate_event_queues), mapped to its port.
+migrated_realm_ports: Dict[int, int] = {}
+migrated_queues: Dict[str, MigratedQueue] = {}
+# Heap of (expires, queue ID) for migrated_queues.
+migrated_queue_gc_heap: List[Tuple[float, str]] = []
+
+
+class PendingMigration:
+    """A hand-off of event queues to another Tornado process (see
+    migrate_event_queues) that the other process hasn't confirmed yet.
+
+    Until it has, we can't forward notices for the realms being handed
+    off, since the other process would drop those for queues it
+    doesn't have yet; so we keep them, along with any queues
+    registered for the realms in the meantime, in the backlog, in the
+    order they arrived."""
+
+    __slots__ = ("realm_ids", "port", "backlog", "imported")
+
+    def __init__(self, realm_ids: AbstractSet[int], port: int) -> None:
+        self.realm_ids = realm_ids
+        self.port = port
+        # ("notice", notice) or ("queues", queues) entries.
+        self.backlog: Deque[Tuple[str, Any]] = deque()
+        # Whether the other process has taken any of the queues.
+        self.imported = False
+
+
+# Realms whose event queues are being handed off, mapped to the
+# PendingMigration; they're added to migrated_realm_ports once it
+# completes.
+pending_migrations: Dict[int, PendingMigration] = {}
+
+# Journal of changes to the event queues since the last checkpoint;
+# only present if settings.TORNADO_EVENT_QUEUE_JOURNAL is enabled.
+event_queue_journal: Optional[EventQueueJournal] = None
+
+
+def journal_record(op: str, queue_id: str, data: Any = None) -> None:
+    if event_queue_journal is not None:
+        event_queue_journal.record(op, queue_id, data)
+
+
+def journal_push(queue_id: str, event: Mapping[str, Any]) -> None:
+    if event_queue_journal is None:
+        return
+    if event["type"] != "message":
+        event_queue_journal.record("push", queue_id, event)
+        return
+
+    # The message payload is shared by every queue receiving the
+    # message, so it's journaled only once; each queue's record just
+    # has the rest of its event (flags, etc.).
+    payload_seq = event_queue_journal.record_message_payload(event["message"])
+    overlay = {key: value for key, value in event.items() if key != "message"}
+    event_queue_journal.record("push_message", queue_id, [payload_seq, overlay])
+
 
 def clear_client_event_queues_for_testing() -> None:
     assert settings.TEST_SUITE
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_clients_by_narrow_term.clear()
+    gc_heap.clear()
     gc_hooks.clear()
+    migrated_realm_ports.clear()
+    migrated_queues.clear()
+    migrated_queue_gc_heap.clear()
+    pending_migrations.clear()
     global next_queue_id
     next_queue_id = 0
 
@@ -446,28 +696,71 @@ def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDe
     return realm_clients_all_streams.get(realm_id, [])
 
 
+def get_narrowed_client_descriptors_for_stream_message(
+    realm_id: int, event_template: Mapping[str, Any]
+) -> Iterator[ClientDescriptor]:
+    """Returns the client descriptors in realm_clients_by_narrow_term
+    whose narrow could match this stream message."""
+    realm_index = realm_clients_by_narrow_term.get(realm_id)
+    if realm_index is None:
+        return
+
+    terms = [("stream", event_template["stream_name"].lower())]
+    message = event_template.get("message_dict")
+    if message is not None:
+        terms.append(("sender", message["sender_email"].lower()))
+        terms.append(("topic", get_topic_from_message_info(message).lower()))
+    for term in terms:
+        yield from realm_index.get(term, [])
+
+
+def get_client_narrow_index_term(client: ClientDescriptor) -> Optional[Tuple[str, str]]:
+    if client.narrow == []:
+        return None
+    return get_narrow_index_term(client.narrow)
+
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
+    heapq.heappush(
+        gc_heap, (client.last_connection_time + client.queue_timeout, client.event_queue.id)
+    )
     if client.all_public_streams or client.narrow != []:
-        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        term = get_client_narrow_index_term(client)
+        if term is None:
+            realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        else:
+            realm_clients_by_narrow_term.setdefault(client.realm_id, {}).setdefault(
+                term, []
+            ).append(client)
 
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ":" + str(next_queue_id)
+    if settings.TORNADO_PROCESSES > 1 and tornado_port is not None:
+        queue_id = f"{settings.SERVER_GENERATION}:{tornado_port}:{next_queue_id}"
+    else:
+        queue_id = str(settings.SERVER_GENERATION) + ":" + str(next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    journal_record("create", queue_id, client.to_dict())
     return client
 
 
+KeyT = TypeVar("KeyT")
+
+
 def do_gc_event_queues(
-    to_remove: AbstractSet[str], affected_users: AbstractSet[int], affected_realms: AbstractSet[int]
+    to_remove: AbstractSet[str],
+    affected_users: AbstractSet[int],
+    affected_realms: AbstractSet[int],
+    run_gc_hooks: bool = True,
 ) -> None:
     def filter_client_dict(
-        client_dict: MutableMapping[int, List[ClientDescriptor]], key: int
+        client_dict: MutableMapping[KeyT, List[ClientDescriptor]], key: KeyT
     ) -> None:
         if key not in client_dict:
             return
@@ -484,13 +777,28 @@ def do_gc_event_queues(
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
 
+    affected_narrow_terms: Set[Tuple[int, Tuple[str, str]]] = set()
     for id in to_remove:
-        for cb in gc_hooks:
-            cb(
-                clients[id].user_profile_id,
-                clients[id],
-                clients[id].user_profile_id not in user_clients,
-            )
+        client = clients[id]
+        if client.all_public_streams or client.narrow != []:
+            term = get_client_narrow_index_term(client)
+            if term is not None:
+                affected_narrow_terms.add((client.realm_id, term))
+    for realm_id, term in affected_narrow_terms:
+        realm_index = realm_clients_by_narrow_term[realm_id]
+        filter_client_dict(realm_index, term)
+        if len(realm_index) == 0:
+            del realm_clients_by_narrow_term[realm_id]
+
+    for id in to_remove:
+        journal_record("gc", id)
+        if run_gc_hooks:
+            for cb in gc_hooks:
+                cb(
+                    clients[id].user_profile_id,
+                    clients[id],
+                    clients[id].user_profile_id not in user_clients,
+                )
         del clients[id]
 
 
@@ -499,17 +807,37 @@ def gc_event_queues(port: int) -> None:
     to_remove: Set[str] = set()
     affected_users: Set[int] = set()
     affected_realms: Set[int] = set()
-    for (id, client) in clients.items():
+    while len(gc_heap) != 0 and gc_heap[0][0] <= start:
+        (_, id) = heapq.heappop(gc_heap)
+        client = clients.get(id)
+        if client is None:
+            # This queue was already deleted, e.g. via DELETE /events.
+            continue
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+            continue
+
+        # The client has connected since this entry was added.  If
+        # it's connected right now, it can't expire until after it
+        # disconnects, so we check it again on the next run.
+        heapq.heappush(
+            gc_heap, (max(client.last_connection_time + client.queue_timeout, start + 1), id)
+        )
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    while len(migrated_queue_gc_heap) != 0 and migrated_queue_gc_heap[0][0] <= start:
+        (expires, id) = heapq.heappop(migrated_queue_gc_heap)
+        migrated = migrated_queues.get(id)
+        # The queue may have been handed back and forth since.
+        if migrated is not None and migrated.expires == expires:
+            del migrated_queues[id]
+
     if settings.PRODUCTION:
         logging.info(
             "Tornado %d removed %d expired event queues owned by %d users in %.3fs."
@@ -523,6 +851,15 @@ def gc_event_queues(port: int) -> None:
         )
     statsd.gauge("tornado.active_queues", len(clients))
     statsd.gauge("tornado.active_users", len(user_clients))
+    statsd.gauge(
+        "tornado.queued_events", sum(len(client.event_queue.queue) for client in clients.values())
+    )
+    if settings.TORNADO_EVENT_QUEUE_MAX_BYTES is not None:
+        # We only measure the queued events when there's a limit.
+        statsd.gauge(
+            "tornado.queued_bytes",
+            sum(client.event_queue.queued_bytes for client in clients.values()),
+        )
 
 
 def persistent_queue_filename(port: int, last: bool = False) -> str:
@@ -536,6 +873,16 @@ def persistent_queue_filename(port: int, last: bool = False) -> str:
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ("." + str(port),)
 
 
+def persistent_queue_checkpoint_filename(port: int) -> str:
+    return persistent_queue_filename(port) + ".checkpoint"
+
+
+def persistent_queue_journal_filename(port: int, old: bool = False) -> str:
+    if old:
+        return persistent_queue_filename(port) + ".journal.old"
+    return persistent_queue_filename(port) + ".journal"
+
+
 def dump_event_queues(port: int) -> None:
     start = time.time()
 
@@ -550,6 +897,76 @@ def dump_event_queues(port: int) -> None:
         )
 
 
+def persist_event_queues(port: int) -> None:
+    if event_queue_journal is None:
+        dump_event_queues(port)
+        return
+
+    # The journal already contains everything we need to restore
+    # the event queues, so we just need to make sure it's written out.
+    stop_event_queue_journal()
+    logging.info("Tornado %d flushed its event queue journal", port)
+
+
+def replay_event_queue_journal(port: int) -> Tuple[Dict[str, ClientDescriptor], int]:
+    """Restores event queues from the most recent checkpoint, followed
+    by the journal of changes since then.  Returns the restored queues,
+    and the last journal sequence number seen.
+
+    Each queue in the checkpoint is stored as a "create" record whose
+    sequence number is that of the last journal record reflected in
+    its state; since checkpoints are written incrementally, this
+    differs between queues, and we skip any journal records that are
+    already reflected in the checkpointed state of their queue.
+    """
+    restored: Dict[str, ClientDescriptor] = {}
+    restored_through_seq: Dict[str, int] = {}
+    # Message payloads, by the sequence number of their record; the
+    # restored queues share them, just like the original ones did.
+    payloads: Dict[int, Dict[str, Any]] = {}
+    last_seq = -1
+
+    for filename in [
+        persistent_queue_checkpoint_filename(port),
+        persistent_queue_journal_filename(port, old=True),
+        persistent_queue_journal_filename(port),
+    ]:
+        for (seq, op, queue_id, data) in read_journal(filename):
+            last_seq = max(last_seq, seq)
+            if op == "payload":
+                payloads[seq] = data
+                continue
+            if seq <= restored_through_seq.get(queue_id, -1):
+                continue
+
+            if op == "create":
+                restored[queue_id] = ClientDescriptor.from_dict(data)
+                restored_through_seq[queue_id] = seq
+                continue
+
+            client = restored.get(queue_id)
+            if client is None:
+                # This queue was garbage-collected before the checkpoint.
+                continue
+            if op == "push":
+                client.event_queue.push(data)
+            elif op == "push_message":
+                payload_seq, overlay = data
+                client.event_queue.push(dict(overlay, message=payloads[payload_seq]))
+            elif op == "prune":
+                client.event_queue.prune(data)
+            elif op == "contents":
+                client.event_queue.contents()
+            elif op == "touch":
+                client.last_connection_time = data
+            elif op == "gc":
+                del restored[queue_id]
+            else:
+                raise AssertionError(f"Unknown event queue journal operation {op}")
+
+    return restored, last_seq
+
+
 def load_event_queues(port: int) -> None:
     global clients
     start = time.time()
@@ -568,6 +985,15 @@ def load_event_queues(port: int) -> None:
             logging.exception(
                 "Tornado %d could not deserialize event queues", port, stack_info=True
             )
+    dumped_queue_ids = set(clients.keys())
+
+    journal_clients: Dict[str, ClientDescriptor] = {}
+    last_seq = -1
+    try:
+        journal_clients, last_seq = replay_event_queue_journal(port)
+    except Exception:
+        logging.exception("Tornado %d could not replay event queue journal", port, stack_info=True)
+    clients.update(journal_clients)
 
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
@@ -579,6 +1005,314 @@ def load_event_queues(port: int) -> None:
             "Tornado %d loaded %d event queues in %.3fs", port, len(clients), time.time() - start
         )
 
+    if settings.TORNADO_EVENT_QUEUE_JOURNAL:
+        start_event_queue_journal(port, last_seq + 1, tornado.ioloop.IOLoop.instance())
+        # Queues from a full dump (written before journaling was
+        # enabled) need to be added to the journal.
+        for queue_id in dumped_queue_ids:
+            if queue_id not in journal_clients:
+                journal_record("create", queue_id, clients[queue_id].to_dict())
+    else:
+        # These queues will be included in the full dump written at
+        # shutdown, so the journal is no longer needed.
+        remove_if_exists(persistent_queue_checkpoint_filename(port))
+        remove_if_exists(persistent_queue_journal_filename(port, old=True))
+        remove_if_exists(persistent_queue_journal_filename(port))
+
+
+def start_event_queue_journal(
+    port: int, next_seq: int, ioloop: Optional[tornado.ioloop.IOLoop] = None
+) -> None:
+    global event_queue_journal
+    event_queue_journal = EventQueueJournal(
+        persistent_queue_journal_filename(port), next_seq, ioloop
+    )
+
+
+def stop_event_queue_journal() -> None:
+    global event_queue_journal
+    if event_queue_journal is not None:
+        event_queue_journal.close()
+        event_queue_journal = None
+
+
+def checkpoint_event_queues(port: int) -> Iterator[None]:
+    """Writes a checkpoint of all event queues, yielding after each
+    chunk of queues so that the caller can let the IOLoop process
+    other work in between.  Once the checkpoint is complete, the
+    journal records from before it was started are discarded."""
+    assert event_queue_journal is not None
+    event_queue_journal.rotate(persistent_queue_journal_filename(port, old=True))
+
+    # Queues created after this point are recorded in the new journal.
+    queue_ids = list(clients.keys())
+    checkpoint_filename = persistent_queue_checkpoint_filename(port)
+    with open(checkpoint_filename + ".tmp", "wb") as checkpoint:
+        for i in range(0, len(queue_ids), EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE):
+            for queue_id in queue_ids[i : i + EVENT_QUEUE_CHECKPOINT_CHUNK_SIZE]:
+                client = clients.get(queue_id)
+                if client is None:
+                    # Garbage-collected since we started.
+                    continue
+                checkpoint.write(
+                    orjson.dumps(
+                        [event_queue_journal.last_seq(), "create", queue_id, client.to_dict()],
+                        option=orjson.OPT_APPEND_NEWLINE,
+                    )
+                )
+            yield
+    os.rename(checkpoint_filename + ".tmp", checkpoint_filename)
+    remove_if_exists(persistent_queue_journal_filename(port, old=True))
+
+
+checkpoint_in_progress = False
+
+
+def start_event_queue_checkpoint(port: int) -> None:
+    global checkpoint_in_progress
+    if checkpoint_in_progress or event_queue_journal is None:
+        return
+    checkpoint_in_progress = True
+    start = time.time()
+    num_queues = len(clients)
+    steps = checkpoint_event_queues(port)
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    def step() -> None:
+        global checkpoint_in_progress
+        try:
+            next(steps)
+        except StopIteration:
+            checkpoint_in_progress = False
+            logging.info(
+                "Tornado %d checkpointed %d event queues in %.3fs",
+                port,
+                num_queues,
+                time.time() - start,
+            )
+        except Exception:
+            checkpoint_in_progress = False
+            logging.exception("Tornado %d failed to checkpoint event queues", port, stack_info=True)
+        else:
+            ioloop.add_callback(step)
+
+    step()
+
+
+def export_event_queues(realm_ids: AbstractSet[int]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Removes this process's event queues for the given realms,
+    returning them in the format used for persisting them."""
+    exported: List[Tuple[str, Dict[str, Any]]] = []
+    affected_users: Set[int] = set()
+    affected_realms: Set[int] = set()
+    for queue_id, client in clients.items():
+        if client.realm_id not in realm_ids:
+            continue
+        # Any connected client will immediately reconnect, and be
+        # routed to the Tornado process that now has its queue.
+        client.finish_current_handler()
+        exported.append((queue_id, client.to_dict()))
+        affected_users.add(client.user_profile_id)
+        affected_realms.add(client.realm_id)
+
+    # The users still have these queues, just in another process, so
+    # we don't run the GC hooks (e.g. missed-message notifications).
+    exported_ids = {queue_id for (queue_id, _) in exported}
+    do_gc_event_queues(exported_ids, affected_users, affected_realms, run_gc_hooks=False)
+    if exported_ids:
+        # Unlike for garbage-collected queues, we drop their entries
+        # in gc_heap, since they may be imported here again.
+        gc_heap[:] = [entry for entry in gc_heap if entry[1] not in exported_ids]
+        heapq.heapify(gc_heap)
+    return exported
+
+
+def import_event_queues(
+    realm_ids: Iterable[int], queues: Iterable[Tuple[str, Dict[str, Any]]]
+) -> int:
+    """Adds event queues handed off by another Tornado process, which
+    is no longer serving the given realms."""
+    for realm_id in realm_ids:
+        migrated_realm_ports.pop(realm_id, None)
+
+    num_imported = 0
+    for (queue_id, data) in queues:
+        if queue_id in clients:
+            # A retried request; we already have this queue.
+            continue
+        client = ClientDescriptor.from_dict(data)
+        clients[queue_id] = client
+        add_to_client_dicts(client)
+        migrated_queues.pop(queue_id, None)
+        journal_record("create", queue_id, data)
+        num_imported += 1
+    return num_imported
+
+
+def mark_migrated_queues(queues: Iterable[Tuple[str, Dict[str, Any]]], port: int) -> None:
+    now = time.time()
+    for (queue_id, data) in queues:
+        migrated = MigratedQueue(
+            port=port, realm_id=data["realm_id"], expires=now + data["queue_timeout"]
+        )
+        migrated_queues[queue_id] = migrated
+        heapq.heappush(migrated_queue_gc_heap, (migrated.expires, queue_id))
+
+
+def migrate_event_queues(realm_ids: AbstractSet[int], port: int) -> int:
+    """Hands off this process's event queues for the given realms to
+    the Tornado process on the given port, via its
+    /import_tornado_event_queues endpoint.  Afterwards, notifications
+    for those realms that arrive here are forwarded to that process,
+    as are the queues of any clients registering via a Django process
+    that still routes the realms here.
+
+    The request is made asynchronously, so that it doesn't block the
+    IOLoop; until it completes, notices for the realms are kept in a
+    PendingMigration, and if it fails, we take the queues back and
+    apply the notices to them here."""
+    queues = export_event_queues(realm_ids)
+    # Clients fetching events from these queues are told to retry.
+    mark_migrated_queues(queues, port)
+    migration = PendingMigration(realm_ids, port)
+    for realm_id in realm_ids:
+        pending_migrations[realm_id] = migration
+    send_migrated_event_queues(migration, queues)
+    return len(queues)
+
+
+def send_migrated_event_queues(
+    migration: PendingMigration, queues: List[Tuple[str, Dict[str, Any]]]
+) -> None:
+    def finish_import(future: "Future[HTTPResponse]") -> None:
+        if future.exception() is None:
+            migration.imported = True
+        else:
+            logging.error(
+                "Tornado %s failed to hand off %d event queues to port %d",
+                tornado_port,
+                len(queues),
+                migration.port,
+                exc_info=future.exception(),
+            )
+            if not migration.imported:
+                # Keep serving the queues here, rather than losing them.
+                abort_migration(migration, queues)
+                return
+            # The other process already has the realms' other queues,
+            # so these can't stay here; their clients will get an
+            # error, and register new queues.
+            for (queue_id, _) in queues:
+                migrated_queues.pop(queue_id, None)
+        continue_migration(migration)
+
+    future = AsyncHTTPClient().fetch(
+        get_tornado_uri_for_port(migration.port) + "/import_tornado_event_queues",
+        method="POST",
+        body=urlencode(
+            dict(
+                data=orjson.dumps(dict(realm_ids=sorted(migration.realm_ids), queues=queues)),
+                secret=settings.SHARED_SECRET,
+            )
+        ),
+        request_timeout=60,
+    )
+    future.add_done_callback(finish_import)
+
+
+def continue_migration(migration: PendingMigration) -> None:
+    """Forwards the backlog of a PendingMigration whose queues the
+    other process has taken, in order, up to the next queues to hand
+    off; once there are none left, the migration is complete."""
+    while migration.backlog:
+        (kind, item) = migration.backlog.popleft()
+        if kind == "notice":
+            forward_notification(migration.port, item)
+        else:
+            # We continue once the other process has these queues.
+            send_migrated_event_queues(migration, item)
+            return
+
+    for realm_id in migration.realm_ids:
+        if pending_migrations.get(realm_id) is migration:
+            del pending_migrations[realm_id]
+            migrated_realm_ports[realm_id] = migration.port
+
+
+def abort_migration(migration: PendingMigration, queues: List[Tuple[str, Dict[str, Any]]]) -> None:
+    for realm_id in migration.realm_ids:
+        if pending_migrations.get(realm_id) is migration:
+            del pending_migrations[realm_id]
+    import_event_queues([], queues)
+    for (kind, item) in migration.backlog:
+        if kind == "notice":
+            process_notification(item)
+        else:
+            import_event_queues([], item)
+    migration.backlog.clear()
+
+
+def rebalance_event_queues(realm_ports: Mapping[int, Sequence[int]]) -> Tuple[Dict[int, int], int]:
+    """Applies a new assignment of realms to Tornado processes.
+
+    The event queues of each realm that realm_ports assigns to a
+    single other Tornado process are handed off to it.  For realms
+    sharded by user between several processes, requests are routed
+    to the process whose port is in the queue ID, so queues can't be
+    moved; instead, we garbage-collect those belonging to users now
+    served by another process, whose clients then re-register there.
+
+    Returns the number of queues handed off to each port, and the
+    number of queues garbage-collected."""
+    assert tornado_port is not None
+    realms_by_port: Dict[int, Set[int]] = {}
+    user_sharded_realm_ports: Dict[int, Sequence[int]] = {}
+    for realm_id, ports in realm_ports.items():
+        if len(ports) > 1:
+            # We'll receive notifications for this realm's users
+            # that this process serves, so stop forwarding them.
+            migrated_realm_ports.pop(realm_id, None)
+            user_sharded_realm_ports[realm_id] = ports
+        elif ports[0] != tornado_port:
+            realms_by_port.setdefault(ports[0], set()).add(realm_id)
+
+    # Requests for a user-sharded realm's queues are routed by the
+    # port in the queue ID, so the queues it handed off before it was
+    # sharded will never be routed to the process that has them.
+    for queue_id, migrated_queue in list(migrated_queues.items()):
+        if migrated_queue.realm_id in user_sharded_realm_ports:
+            del migrated_queues[queue_id]
+
+    migrated = {
+        port: migrate_event_queues(realm_ids, port) for port, realm_ids in realms_by_port.items()
+    }
+
+    to_remove = [
+        client
+        for client in clients.values()
+        if client.realm_id in user_sharded_realm_ports
+        and get_tornado_port_for_user(
+            client.user_profile_id, user_sharded_realm_ports[client.realm_id]
+        )
+        != tornado_port
+    ]
+    for client in to_remove:
+        client.cleanup()
+    return migrated, len(to_remove)
+
+
+def forward_notification(port: int, notice: Mapping[str, Any]) -> None:
+    def send_notification_http(notice: Mapping[str, Any]) -> None:
+        # Must be imported here, since django_api imports this module.
+        from zerver.tornado.django_api import requests_client
+
+        requests_client().post(
+            get_tornado_uri_for_port(port) + "/notify_tornado",
+            data=dict(data=orjson.dumps(notice), secret=settings.SHARED_SECRET),
+        )
+
+    queue_json_publish(notify_tornado_queue_name(port), dict(notice), send_notification_http)
+
 
 def send_restart_events(immediate: bool = False) -> None:
     event: Dict[str, Any] = dict(
@@ -595,12 +1329,15 @@ def send_restart_events(immediate: bool = False) -> None:
 
 
 def setup_event_queue(port: int) -> None:
+    global tornado_port
+    tornado_port = port
+
     if not settings.TEST_SUITE:
         load_event_queues(port)
-        atexit.register(dump_event_queues, port)
+        atexit.register(persist_event_queues, port)
         # Make sure we dump event queues even if we exit via signal
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
-        add_reload_hook(lambda: dump_event_queues(port))
+        add_reload_hook(lambda: persist_event_queues(port))
 
     try:
         os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
@@ -614,6 +1351,14 @@ def setup_event_queue(port: int) -> None:
     )
     pc.start()
 
+    if event_queue_journal is not None:
+        # Periodically checkpoint the event queues, so that the
+        # journal we need to replay on restart stays small.
+        checkpoint_pc = tornado.ioloop.PeriodicCallback(
+            lambda: start_event_queue_checkpoint(port), EVENT_QUEUE_CHECKPOINT_FREQ_MSECS, ioloop
+        )
+        checkpoint_pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 
@@ -635,14 +1380,33 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 assert new_queue_data is not None
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
+                if client.realm_id in pending_migrations:
+                    # Registered while the realm's other queues are
+                    # being handed off; this one follows them.
+                    migration = pending_migrations[client.realm_id]
+                    queues = export_event_queues({client.realm_id})
+                    mark_migrated_queues(queues, migration.port)
+                    migration.backlog.append(("queues", queues))
+                elif client.realm_id in migrated_realm_ports:
+                    # Registered via a Django process that hasn't yet
+                    # picked up the realm's new Tornado port.
+                    migrate_event_queues({client.realm_id}, migrated_realm_ports[client.realm_id])
             else:
                 raise JsonableError(_("Missing 'queue_id' argument"))
         else:
             if last_event_id is None:
                 raise JsonableError(_("Missing 'last_event_id' argument"))
+            if queue_id in migrated_queues:
+                raise EventQueueMigratedError(queue_id)
             client = get_client_descriptor(queue_id)
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
+            if client.event_queue.resync_required():
+                # The queue's events were discarded for exceeding the
+                # configured limits; clients handle this error by
+                # registering a new queue and refetching their state.
+                client.cleanup()
+                raise BadEventQueueIdError(queue_id)
             if (
                 client.event_queue.newest_pruned_id is not None
                 and last_event_id < client.event_queue.newest_pruned_id
@@ -859,10 +1623,14 @@ def get_client_info_for_message_event(
         return (sender_queue_id is not None) and client.event_queue.id == sender_queue_id
 
     # If we're on a public stream, look for clients (typically belonging to
-    # bots) that are registered to get events for ALL streams.
+    # bots) that are registered to get events for ALL streams, as well
+    # as clients with a narrow that this message might match.
     if "stream_name" in event_template and not event_template.get("invite_only"):
         realm_id = event_template["realm_id"]
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        for client in itertools.chain(
+            get_client_descriptors_for_realm_all_streams(realm_id),
+            get_narrowed_client_descriptors_for_stream_message(realm_id, event_template),
+        ):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -915,13 +1683,21 @@ def process_message_event(
     message_type: str = wide_dict["type"]
     sending_client: str = wide_dict["client"]
 
+    # The message payload is computed once per variant, and shared by
+    # every event queue receiving the message; it must not be mutated
+    # after this point.
     @cachify
-    def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
-        return MessageDict.finalize_payload(
+    def get_client_payload(
+        apply_markdown: bool, client_gravatar: bool, invite_only_stream: bool
+    ) -> Dict[str, Any]:
+        payload = MessageDict.finalize_payload(
             wide_dict,
             apply_markdown=apply_markdown,
             client_gravatar=client_gravatar,
         )
+        if invite_only_stream:
+            payload["invite_only_stream"] = True
+        return payload
 
     # Extra user-specific data to include
     extra_user_data: Dict[int, Any] = {}
@@ -986,12 +1762,13 @@ def process_message_event(
             # message data unnecessarily
             continue
 
-        message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
-
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
+        invite_only_stream = "mirror" in client.client_type_name and bool(
+            event_template.get("invite_only")
+        )
+        message_dict = get_client_payload(
+            client.apply_markdown, client.client_gravatar, invite_only_stream
+        )
 
         user_event: Dict[str, Any] = dict(type="message", message=message_dict, flags=flags)
         if extra_data is not None:
@@ -1050,6 +1827,16 @@ def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
                 client.add_event(event)
 
 
+def process_message_send_failed_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
+    # Only the client that sent the message knows its local_id.
+    client_event = dict(event)
+    queue_id = client_event.pop("queue_id")
+    for user_profile_id in users:
+        for client in get_client_descriptors_for_user(user_profile_id):
+            if client.event_queue.id == queue_id and client.accepts_event(client_event):
+                client.add_event(client_event)
+
+
 def process_deletion_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
@@ -1255,6 +2042,17 @@ def process_notification(notice: Mapping[str, Any]) -> None:
     users: Union[List[int], List[Mapping[str, Any]]] = notice["users"]
     start_time = time.time()
 
+    # Notices queued before this realm's event queues were handed off
+    # to another Tornado process, or sent by a Django process that
+    # hasn't yet picked up the change, need to be delivered there.
+    realm_id = notice.get("realm_id")
+    if realm_id in pending_migrations:
+        pending_migrations[realm_id].backlog.append(("notice", notice))
+        return
+    if realm_id in migrated_realm_ports:
+        forward_notification(migrated_realm_ports[realm_id], notice)
+        return
+
     if event["type"] == "message":
         if len(users) > 0 and isinstance(users[0], dict) and "stream_push_notify" in users[0]:
             # TODO/compatibility: Remove this whole block once one can no
@@ -1280,6 +2078,8 @@ def process_notification(notice: Mapping[str, Any]) -> None:
         process_deletion_event(event, user_ids)
     elif event["type"] == "presence":
         process_presence_event(event, cast(List[int], users))
+    elif event["type"] == "message_send_failed":
+        process_message_send_failed_event(event, cast(List[int], users))
     else:
         process_event(event, cast(List[int], users))
     logging.debug(
@@ -1290,6 +2090,65 @@ def process_notification(notice: Mapping[str, Any]) -> None:
     )
 
 
+def coalesce_notice(previous: Dict[str, Any], notice: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Returns a single notice equivalent to processing previous and
+    then notice, or None if they can't be combined."""
+    if previous.get("realm_id") != notice.get("realm_id") or previous["users"] != notice["users"]:
+        return None
+    previous_event = previous["event"]
+    event = notice["event"]
+    if previous_event["type"] != event["type"]:
+        return None
+
+    if event["type"] == "update_message_flags":
+        if (
+            previous_event["all"]
+            or event["all"]
+            or previous_event["operation"] != event["operation"]
+            or previous_event["flag"] != event["flag"]
+        ):
+            return None
+        seen = set(previous_event["messages"])
+        messages = previous_event["messages"] + [
+            message_id for message_id in event["messages"] if message_id not in seen
+        ]
+        return dict(notice, event=dict(event, messages=messages))
+
+    if event["type"] == "presence":
+        if previous_event.get("user_id") != event.get("user_id"):
+            return None
+        # Presence is keyed by client, so the newer data for each
+        # client replaces the older.
+        presence = dict(previous_event["presence"], **event["presence"])
+        return dict(notice, event=dict(event, presence=presence))
+
+    if event["type"] == "typing":
+        # Clients repeat typing notifications while the user types;
+        # delivering the same one twice in a row is redundant.
+        if previous_event == event:
+            return previous
+        return None
+
+    return None
+
+
+def coalesce_notices(notices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Combines runs of consecutive notices for the same users which
+    can be delivered as a single event: message flag updates,
+    presence updates for the same user, and repeated typing
+    notifications.  Bursts of these (e.g. marking many messages as
+    read) otherwise each cost a pass over the recipients' queues."""
+    result: List[Dict[str, Any]] = []
+    for notice in notices:
+        if result:
+            coalesced = coalesce_notice(result[-1], notice)
+            if coalesced is not None:
+                result[-1] = coalesced
+                continue
+        result.append(notice)
+    return result
+
+
 def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str, Any]]], None]:
     def failure_processor(notice: Dict[str, Any]) -> None:
         logging.error(
@@ -1299,6 +2158,13 @@ def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str
         )
 
     def wrapped_process_notification(notices: List[Dict[str, Any]]) -> None:
+        if settings.TORNADO_COALESCE_NOTICES:
+            received = len(notices)
+            notices = coalesce_notices(notices)
+            statsd.incr("tornado.notices.received", received)
+            statsd.incr("tornado.notices.processed", len(notices))
+            if len(notices) < received:
+                logging.debug("Tornado: Coalesced %d notices into %d", received, len(notices))
         for notice in notices:
             try:
                 process_notification(notice)
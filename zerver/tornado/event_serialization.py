@@ -0,0 +1,83 @@
+# Serialization of the responses to GET /events.
+#
+# When a message is sent to a busy stream, hundreds of long-polling
+# clients are finished at once, each with a response containing the
+# same message.  The message payloads are shared (and never mutated)
+# between all the event queues that receive them (see
+# process_message_event), so we serialize each payload once and
+# splice the resulting bytes into every response that contains it.
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Tuple
+
+import orjson
+from django.http import HttpResponse
+
+SERIALIZED_PAYLOAD_CACHE_SIZE = 1000
+
+# Maps id(payload) to the payload and its serialization; holding a
+# reference to the payload ensures its id isn't reused while cached.
+serialized_payloads: "OrderedDict[int, Tuple[Dict[str, Any], bytes]]" = OrderedDict()
+
+# See the comment in json_response about OPT_PASSTHROUGH_DATETIME.
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def serialize_message_payload(payload: Dict[str, Any]) -> bytes:
+    key = id(payload)
+    cached = serialized_payloads.get(key)
+    if cached is not None:
+        serialized_payloads.move_to_end(key)
+        return cached[1]
+
+    serialized = orjson.dumps(payload, option=ORJSON_OPTIONS)
+    serialized_payloads[key] = (payload, serialized)
+    if len(serialized_payloads) > SERIALIZED_PAYLOAD_CACHE_SIZE:
+        serialized_payloads.popitem(last=False)
+    return serialized
+
+
+def serialize_event(event: Mapping[str, Any]) -> bytes:
+    if event["type"] != "message":
+        return orjson.dumps(event, option=ORJSON_OPTIONS)
+
+    overlay = orjson.dumps(
+        {key: value for key, value in event.items() if key != "message"}, option=ORJSON_OPTIONS
+    )
+    # The overlay always contains at least the "type" key, so we can
+    # just splice the message in after its opening brace.
+    return b'{"message":' + serialize_message_payload(event["message"]) + b"," + overlay[1:]
+
+
+def event_size(event: Mapping[str, Any]) -> int:
+    """The length of serialize_event(event), without building it; for
+    a message event, this only serializes the parts of the event
+    specific to its queue, since the payload's serialization is
+    cached."""
+    if event["type"] != "message":
+        return len(orjson.dumps(event, option=ORJSON_OPTIONS))
+
+    overlay = orjson.dumps(
+        {key: value for key, value in event.items() if key != "message"}, option=ORJSON_OPTIONS
+    )
+    return len(b'{"message":') + len(serialize_message_payload(event["message"])) + len(overlay)
+
+
+def json_events_response(
+    res_type: str = "success", msg: str = "", data: Mapping[str, Any] = {}, status: int = 200
+) -> HttpResponse:
+    """Equivalent to json_response, for a response containing an
+    `events` list of Tornado events."""
+    content = {"result": res_type, "msg": msg}
+    content.update(data)
+    events = content.pop("events")
+
+    rest = orjson.dumps(content, option=ORJSON_OPTIONS)
+    return HttpResponse(
+        content=b'{"events":['
+        + b",".join(serialize_event(event) for event in events)
+        + b"],"
+        + rest[1:]
+        + b"\n",
+        content_type="application/json",
+        status=status,
+    )
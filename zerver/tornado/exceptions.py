@@ -13,3 +13,17 @@ class BadEventQueueIdError(JsonableError):
     @staticmethod
     def msg_format() -> str:
         return _("Bad event queue id: {queue_id}")
+
+
+class EventQueueMigratedError(JsonableError):
+    # Deliberately not BAD_EVENT_QUEUE_ID, since the queue still
+    # exists; clients should just retry, by which time nginx will
+    # route the request to the Tornado process that now has it.
+    data_fields = ["queue_id"]
+
+    def __init__(self, queue_id: str) -> None:
+        self.queue_id: str = queue_id
+
+    @staticmethod
+    def msg_format() -> str:
+        return _("Event queue {queue_id} is moving to another server; try again shortly")
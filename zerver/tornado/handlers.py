@@ -14,6 +14,7 @@ from tornado.wsgi import WSGIContainer
 
 from zerver.lib.response import json_response
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
+from zerver.tornado.event_serialization import json_events_response
 
 current_handler_id = 0
 handlers: Dict[int, "AsyncDjangoHandler"] = {}
@@ -253,9 +254,16 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # request/middleware system to run unmodified while avoiding
         # running expensive things like Zulip's authentication code a
         # second time.
-        request_notes.saved_response = json_response(
-            res_type=result_dict["result"], data=result_dict, status=self.get_status()
-        )
+        if "events" in result_dict:
+            # Event payloads are shared between the many clients that
+            # may be finished at once; see event_serialization.py.
+            request_notes.saved_response = json_events_response(
+                res_type=result_dict["result"], data=result_dict, status=self.get_status()
+            )
+        else:
+            request_notes.saved_response = json_response(
+                res_type=result_dict["result"], data=result_dict, status=self.get_status()
+            )
 
         try:
             response = self.get_response(request)
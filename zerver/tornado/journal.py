@@ -0,0 +1,159 @@
+# Append-only journal of changes to Tornado's event queues.
+#
+# When settings.TORNADO_EVENT_QUEUE_JOURNAL is enabled, every change
+# to an event queue (creation, pushed events, pruning, garbage
+# collection, etc.) is appended to a journal file as it happens.  At
+# startup, we restore the event queues by loading the most recent
+# checkpoint and replaying the journal on top of it; this bounds
+# restart time by the size of the journal, rather than requiring a
+# full serialization of every queue at shutdown, and means that a
+# Tornado process that crashes or is SIGKILLed doesn't lose its
+# queues.  See zerver/tornado/event_queue.py for the checkpointing
+# and replay logic.
+import logging
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+import tornado.ioloop
+
+# (sequence number, operation, queue ID, operation-specific data)
+JournalRecord = Tuple[int, str, str, Any]
+
+# How many message payloads we remember having journaled; see
+# EventQueueJournal.record_message_payload.
+JOURNALED_PAYLOAD_CACHE_SIZE = 1000
+
+
+class EventQueueJournal:
+    def __init__(
+        self, filename: str, next_seq: int, ioloop: Optional[tornado.ioloop.IOLoop] = None
+    ) -> None:
+        self.filename = filename
+        # Sequence numbers increase monotonically across the lifetime
+        # of the journal (including across restarts), which lets the
+        # replay logic determine whether a record is already reflected
+        # in the checkpointed state of a queue.
+        self.next_seq = next_seq
+        # Without an IOLoop, the caller is responsible for calling flush().
+        self.ioloop = ioloop
+        self.pending: List[bytes] = []
+        # Maps id(payload) to the payload and the sequence number of
+        # the record containing it; as with serialized_payloads in
+        # event_serialization.py, holding a reference to the payload
+        # ensures its id isn't reused while cached.
+        self.payload_seqs: "OrderedDict[int, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        truncate_partial_record(filename)
+        self.file = open(filename, "ab")
+
+    def record(self, op: str, queue_id: str, data: Any = None) -> int:
+        seq = self.next_seq
+        self.next_seq += 1
+        self.pending.append(
+            orjson.dumps([seq, op, queue_id, data], option=orjson.OPT_APPEND_NEWLINE)
+        )
+        if len(self.pending) == 1 and self.ioloop is not None:
+            # Batch all the records generated in this iteration of the
+            # IOLoop into a single write.  Records only need to reach
+            # the kernel (not the disk) to survive a crash of the
+            # Tornado process, so we don't fsync.
+            self.ioloop.add_callback(self.flush)
+        return seq
+
+    def record_message_payload(self, payload: Dict[str, Any]) -> int:
+        """Journals a message payload shared by the message events of
+        many queues (see process_message_event) once, rather than once
+        per queue, returning the sequence number of its record for the
+        queues' records to refer to."""
+        key = id(payload)
+        cached = self.payload_seqs.get(key)
+        if cached is not None:
+            self.payload_seqs.move_to_end(key)
+            return cached[1]
+
+        seq = self.record("payload", "", payload)
+        self.payload_seqs[key] = (payload, seq)
+        if len(self.payload_seqs) > JOURNALED_PAYLOAD_CACHE_SIZE:
+            self.payload_seqs.popitem(last=False)
+        return seq
+
+    def last_seq(self) -> int:
+        return self.next_seq - 1
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        self.file.write(b"".join(self.pending))
+        self.file.flush()
+        self.pending = []
+
+    def rotate(self, old_filename: str) -> None:
+        """Moves the records written so far to old_filename, and starts
+        a fresh journal file; used when starting a checkpoint."""
+        self.flush()
+        self.file.close()
+        # The old records are discarded once the checkpoint completes,
+        # so records in the new journal can't refer to payloads in them.
+        self.payload_seqs.clear()
+        if os.path.exists(old_filename):
+            # A previous checkpoint never completed; keep its records
+            # around by prepending them to the ones we're rotating out.
+            with open(old_filename, "ab") as old_file, open(self.filename, "rb") as f:
+                old_file.write(f.read())
+            os.remove(self.filename)
+        else:
+            os.rename(self.filename, old_filename)
+        self.file = open(self.filename, "ab")
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+def read_journal(filename: str) -> Iterator[JournalRecord]:
+    try:
+        f = open(filename, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                seq, op, queue_id, data = orjson.loads(line)
+            except (orjson.JSONDecodeError, ValueError):
+                # If the process was killed in the middle of a write,
+                # the final record may be truncated; everything before
+                # it is still valid.
+                logging.warning("Ignoring truncated record at the end of %s", filename)
+                return
+            yield (seq, op, queue_id, data)
+
+
+def truncate_partial_record(filename: str, block_size: int = 64 * 1024) -> None:
+    """Drops a partially written final record (from a process killed
+    mid-write), so that new records are not appended to it."""
+    try:
+        f = open(filename, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            f.truncate(position)
+
+
+def remove_if_exists(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
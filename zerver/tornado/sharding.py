@@ -1,25 +1,104 @@
+import bisect
 import json
 import os
+import zlib
+from functools import lru_cache
+from typing import Dict, List, Mapping, Sequence, Tuple, Union
 
 from django.conf import settings
 
-from zerver.models import Realm
+from zerver.models import Realm, UserProfile
 
-shard_map = {}
+# Maps realm hosts to their Tornado port, or to a list of ports for
+# realms that are sharded by user.
+shard_map: Dict[str, Union[int, List[int]]] = {}
 if os.path.exists("/etc/zulip/sharding.json"):
     with open("/etc/zulip/sharding.json") as f:
         shard_map = json.loads(f.read())
 
+# Each Tornado port gets this many points on the hash ring; this
+# matches the weight-1 default in nginx.
+HASH_RING_POINTS_PER_PORT = 160
 
-def get_tornado_port(realm: Realm) -> int:
-    return shard_map.get(realm.host, settings.TORNADO_PORTS[0])
 
+@lru_cache(None)
+def get_hash_ring(ports: Tuple[int, ...]) -> Tuple[List[int], List[int]]:
+    """Returns the sorted points of the consistent hash ring for these
+    Tornado ports, and the port owning each point.
 
-def get_tornado_uri(realm: Realm) -> str:
-    port = get_tornado_port(realm)
+    This reproduces the ring that nginx builds for an upstream using
+    `hash $host consistent` (see tornado-upstreams.conf.template.erb),
+    so that nginx and Django agree on which Tornado process serves
+    each realm, without either needing a list of all realms."""
+    points: List[Tuple[int, int]] = []
+    for port in ports:
+        base_hash = zlib.crc32(f"127.0.0.1\0{port}".encode())
+        prev_hash = 0
+        for i in range(HASH_RING_POINTS_PER_PORT):
+            point = zlib.crc32(prev_hash.to_bytes(4, "little"), base_hash)
+            points.append((point, port))
+            prev_hash = point
+    # nginx sorts the points stably, and then drops all but the first
+    # of any points with the same hash.
+    points.sort(key=lambda point: point[0])
+    hashes: List[int] = []
+    owners: List[int] = []
+    for point, port in points:
+        if hashes and hashes[-1] == point:
+            continue
+        hashes.append(point)
+        owners.append(port)
+    return hashes, owners
+
+
+def get_hashed_tornado_port(key: str, ports: Sequence[int]) -> int:
+    hashes, owners = get_hash_ring(tuple(ports))
+    index = bisect.bisect_left(hashes, zlib.crc32(key.encode()))
+    return owners[index % len(owners)]
+
+
+def get_tornado_ports_for_host(
+    host: str, realm_shard_map: Mapping[str, Union[int, List[int]]], ports: Sequence[int]
+) -> List[int]:
+    """Returns the ports of the Tornado processes serving a realm.  A
+    realm served by several of them is sharded by user ID; see
+    get_tornado_port_for_user."""
+    if host in realm_shard_map:
+        # Realms listed explicitly in the [tornado_sharding] section
+        # of /etc/zulip/zulip.conf override the hash ring.
+        shard = realm_shard_map[host]
+        if isinstance(shard, list):
+            return shard
+        return [shard]
+    if len(ports) == 1:
+        return [ports[0]]
+    return [get_hashed_tornado_port(host, ports)]
+
+
+def get_tornado_port_for_user(user_profile_id: int, realm_ports: Sequence[int]) -> int:
+    if len(realm_ports) == 1:
+        return realm_ports[0]
+    # Consistent hashing, so that adding a port to a realm's shards
+    # only moves the users that the new port takes over.
+    return get_hashed_tornado_port(str(user_profile_id), realm_ports)
+
+
+def get_tornado_ports(realm: Realm) -> List[int]:
+    return get_tornado_ports_for_host(realm.host, shard_map, settings.TORNADO_PORTS)
+
+
+def get_user_tornado_port(user_profile: UserProfile) -> int:
+    return get_tornado_port_for_user(user_profile.id, get_tornado_ports(user_profile.realm))
+
+
+def get_tornado_uri_for_port(port: int) -> str:
     return f"http://127.0.0.1:{port}"
 
 
+def get_user_tornado_uri(user_profile: UserProfile) -> str:
+    return get_tornado_uri_for_port(get_user_tornado_port(user_profile))
+
+
 def notify_tornado_queue_name(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return "notify_tornado"
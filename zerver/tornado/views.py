@@ -17,7 +17,14 @@ from zerver.lib.validator import (
     to_non_negative_int,
 )
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
-from zerver.tornado.event_queue import fetch_events, get_client_descriptor, process_notification
+from zerver.tornado.event_queue import (
+    fetch_events,
+    get_client_descriptor,
+    import_event_queues,
+    process_notification,
+    rebalance_event_queues,
+)
+from zerver.tornado.event_serialization import json_events_response
 from zerver.tornado.exceptions import BadEventQueueIdError
 from zerver.tornado.handlers import AsyncDjangoHandler
 
@@ -28,6 +35,27 @@ def notify(request: HttpRequest) -> HttpResponse:
     return json_success()
 
 
+@internal_notify_view(True)
+def rebalance_event_queues_internal(request: HttpRequest) -> HttpResponse:
+    realm_ports = orjson.loads(request.POST["data"])["realm_ports"]
+    migrated, removed = rebalance_event_queues(
+        {int(realm_id): ports for (realm_id, ports) in realm_ports.items()}
+    )
+    return json_success(
+        dict(
+            migrated={str(port): count for (port, count) in migrated.items()},
+            removed=removed,
+        )
+    )
+
+
+@internal_notify_view(True)
+def import_event_queues_internal(request: HttpRequest) -> HttpResponse:
+    data = orjson.loads(request.POST["data"])
+    imported = import_event_queues(data["realm_ids"], data["queues"])
+    return json_success(dict(imported=imported))
+
+
 @has_request_variables
 def cleanup_event_queue(
     request: HttpRequest, user_profile: UserProfile, queue_id: str = REQ()
@@ -165,4 +193,4 @@ def get_events_backend(
         return response
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    return json_events_response(data=result["response"])
@@ -1,9 +1,14 @@
+import hashlib
 import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
 from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import orjson
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core import signing
 from django.core.exceptions import ValidationError
 from django.db import connection
 from django.http import HttpRequest, HttpResponse
@@ -19,6 +24,7 @@ from sqlalchemy.sql import (
     Select,
     alias,
     and_,
+    bindparam,
     column,
     join,
     literal,
@@ -29,16 +35,18 @@ from sqlalchemy.sql import (
     table,
     union_all,
 )
+from sqlalchemy.sql.compiler import Compiled
 from sqlalchemy.types import Boolean, Integer, Text
 
 from zerver.context_processors import get_valid_realm_from_request
 from zerver.decorator import REQ, has_request_variables
 from zerver.lib.actions import recipient_for_user_profiles
 from zerver.lib.addressee import get_user_profiles, get_user_profiles_by_ids
+from zerver.lib.deferred_user_messages import materialize_deferred_user_messages
 from zerver.lib.exceptions import ErrorCode, JsonableError, MissingAuthenticationError
 from zerver.lib.message import get_first_visible_message_id, messages_for_ids
 from zerver.lib.narrow import is_web_public_compatible, is_web_public_narrow
-from zerver.lib.request import get_request_notes
+from zerver.lib.request import RequestVariableConversionError, get_request_notes
 from zerver.lib.response import json_success
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.streams import (
@@ -61,15 +69,19 @@ from zerver.lib.utils import statsd
 from zerver.lib.validator import (
     check_bool,
     check_dict,
+    check_dict_only,
     check_int,
+    check_int_range,
     check_list,
     check_required_string,
     check_string,
     check_string_or_int,
     check_string_or_int_list,
+    check_union,
     to_non_negative_int,
 )
 from zerver.models import (
+    Message,
     Realm,
     Recipient,
     Stream,
@@ -84,6 +96,21 @@ from zerver.models import (
 LARGER_THAN_MAX_MESSAGE_ID = 10000000000000000
 MAX_MESSAGES_PER_FETCH = 5000
 
+MESSAGE_FETCH_CURSOR_SALT = "message_fetch_cursor"
+# Cursors are only honored for a limited time, since the messages
+# they point at may since have been deleted or moved.
+MESSAGE_FETCH_CURSOR_MAX_AGE = timedelta(minutes=10)
+
+NARROW_QUERY_CACHE_SIZE = 1000
+# Maps the keys from get_narrow_query_cache_key to the compiled
+# get_messages query, and whether it's a search.
+narrow_query_cache: "OrderedDict[Tuple[object, ...], Tuple[Compiled, bool]]" = OrderedDict()
+
+# The narrow operators whose conditions depend only on the operand
+# (and, for streams, which stream it names).  The others depend on
+# other state, like the user's muted topics or the public streams.
+CACHEABLE_NARROW_OPERATORS = {"has", "id", "is", "near", "pm-with", "search", "sender", "topic"}
+
 
 class BadNarrowOperator(JsonableError):
     code = ErrorCode.BAD_NARROW
@@ -609,8 +636,10 @@ def get_search_fields(
 
 
 def narrow_parameter(json: str) -> OptionalNarrowListT:
+    return parse_narrow(orjson.loads(json))
+
 
-    data = orjson.loads(json)
+def parse_narrow(data: object) -> OptionalNarrowListT:
     if not isinstance(data, list):
         raise ValueError("argument is not a list")
     if len(data) == 0:
@@ -940,6 +969,138 @@ def parse_anchor_value(anchor_val: Optional[str], use_first_unread_anchor: bool)
         raise JsonableError(_("Invalid anchor"))
 
 
+def get_narrow_hash(narrow: OptionalNarrowListT) -> str:
+    return hashlib.sha256(orjson.dumps(narrow, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
+
+def make_message_fetch_cursor(
+    realm: Realm,
+    user_profile: Optional[UserProfile],
+    narrow: OptionalNarrowListT,
+    include_history: bool,
+    oldest_id: int,
+    newest_id: int,
+) -> str:
+    """Returns an opaque, signed cursor for the messages a client has
+    fetched from get_messages_backend with this narrow, which are
+    those from oldest_id to newest_id.  Passing it back with the same
+    narrow fetches the messages just before and after those, without
+    recomputing the anchor."""
+    return signing.dumps(
+        [
+            realm.id,
+            user_profile.id if user_profile is not None else None,
+            get_narrow_hash(narrow),
+            include_history,
+            oldest_id,
+            newest_id,
+        ],
+        salt=MESSAGE_FETCH_CURSOR_SALT,
+        compress=True,
+    )
+
+
+def parse_message_fetch_cursor(
+    cursor: str,
+    realm: Realm,
+    user_profile: Optional[UserProfile],
+    narrow: OptionalNarrowListT,
+) -> Tuple[bool, int, int]:
+    """Returns the include_history value and the bounds of the page
+    for a cursor from make_message_fetch_cursor, checking that it
+    was issued for this user and narrow."""
+    try:
+        (
+            realm_id,
+            user_profile_id,
+            narrow_hash,
+            include_history,
+            oldest_id,
+            newest_id,
+        ) = signing.loads(
+            cursor, salt=MESSAGE_FETCH_CURSOR_SALT, max_age=MESSAGE_FETCH_CURSOR_MAX_AGE
+        )
+    except (signing.BadSignature, TypeError, ValueError):
+        raise JsonableError(_("Invalid cursor"))
+
+    if (
+        realm_id != realm.id
+        or user_profile_id != (user_profile.id if user_profile is not None else None)
+        or narrow_hash != get_narrow_hash(narrow)
+    ):
+        raise JsonableError(_("Invalid cursor"))
+    return include_history, oldest_id, newest_id
+
+
+def get_narrow_query_cache_key(
+    user_profile: Optional[UserProfile],
+    realm: Realm,
+    narrow: OptionalNarrowListT,
+    is_web_public_query: bool,
+    include_history: bool,
+    range_params: Dict[str, int],
+) -> Optional[Tuple[object, ...]]:
+    """Returns a key identifying the compiled get_messages query for
+    this narrow, whose parameters are then just range_params, or None
+    if the query can't be cached.
+
+    Stream operands are resolved to the stream's recipient ID, and
+    sender and pm-with operands to user IDs, so that a key never
+    outlives the stream or user it names (e.g. if the stream is
+    renamed, and a new one created with its old name, or a user
+    changes their email address); other operands only ever restrict
+    the query, so we use them as they are.
+    """
+    if realm.is_zephyr_mirror_realm:
+        return None
+
+    terms: List[Tuple[str, object, bool]] = []
+    for term in narrow or []:
+        operator = term["operator"]
+        operand = term["operand"]
+        if operator == "stream":
+            try:
+                stream = get_stream_by_narrow_operand_access_unchecked(operand, realm)
+            except Stream.DoesNotExist:
+                return None
+            if is_web_public_query and not stream.is_web_public:
+                return None
+            operand = stream.recipient_id
+        elif operator == "sender":
+            try:
+                if isinstance(operand, str):
+                    sender = get_user_including_cross_realm(operand, realm)
+                else:
+                    sender = get_user_by_id_in_realm_including_cross_realm(operand, realm)
+            except UserProfile.DoesNotExist:
+                return None
+            operand = sender.id
+        elif operator == "pm-with":
+            try:
+                if isinstance(operand, str):
+                    user_profiles = get_user_profiles(emails=operand.split(","), realm=realm)
+                else:
+                    user_profiles = get_user_profiles_by_ids(user_ids=operand, realm=realm)
+            except JsonableError:
+                return None
+            operand = tuple(sorted(user.id for user in user_profiles))
+        elif operator not in CACHEABLE_NARROW_OPERATORS:
+            return None
+        elif isinstance(operand, list):
+            operand = tuple(operand)
+        terms.append((operator, operand, term.get("negated", False)))
+
+    return (
+        realm.id,
+        user_profile.id if user_profile is not None else None,
+        is_web_public_query,
+        include_history,
+        settings.USING_PGROONGA,
+        tuple(terms),
+        tuple(sorted(range_params)),
+    )
+
+
 @has_request_variables
 def get_messages_backend(
     request: HttpRequest,
@@ -953,14 +1114,11 @@ def get_messages_backend(
     ),
     client_gravatar: bool = REQ(json_validator=check_bool, default=False),
     apply_markdown: bool = REQ(json_validator=check_bool, default=True),
+    cursor: Optional[str] = REQ(default=None),
 ) -> HttpResponse:
-    anchor = parse_anchor_value(anchor_val, use_first_unread_anchor_val)
-    if num_before + num_after > MAX_MESSAGES_PER_FETCH:
-        raise JsonableError(
-            _("Too many messages requested (maximum {}).").format(
-                MAX_MESSAGES_PER_FETCH,
-            )
-        )
+    anchor = parse_fetch_anchor(
+        anchor_val, use_first_unread_anchor_val, cursor, num_before, num_after
+    )
 
     if not maybe_user_profile.is_authenticated:
         # If user is not authenticated, clients must include
@@ -987,6 +1145,7 @@ def get_messages_backend(
         assert user_profile is not None
         realm = user_profile.realm
         is_web_public_query = False
+        materialize_deferred_user_messages(user_profile)
 
     assert realm is not None
 
@@ -998,7 +1157,228 @@ def get_messages_backend(
         # clients cannot compute gravatars, so we force-set it to false.
         client_gravatar = False
 
-    include_history = ok_to_include_history(narrow, user_profile, is_web_public_query)
+    fetched = fetch_messages_in_narrow(
+        request=request,
+        realm=realm,
+        user_profile=user_profile,
+        is_web_public_query=is_web_public_query,
+        narrow=narrow,
+        anchor=anchor,
+        num_before=num_before,
+        num_after=num_after,
+        cursor=cursor,
+    )
+
+    message_list = messages_for_ids(
+        message_ids=fetched.message_ids,
+        user_message_flags=fetched.user_message_flags,
+        search_fields=fetched.search_fields,
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
+        allow_edit_history=realm.allow_edit_history,
+    )
+
+    statsd.incr("loaded_old_messages", len(message_list))
+
+    ret = dict(
+        messages=message_list,
+        result="success",
+        msg="",
+        found_anchor=fetched.query_info["found_anchor"],
+        found_oldest=fetched.query_info["found_oldest"],
+        found_newest=fetched.query_info["found_newest"],
+        history_limited=fetched.query_info["history_limited"],
+        anchor=fetched.anchor,
+        cursor=fetched.cursor,
+    )
+    return json_success(ret)
+
+
+# The maximum number of narrows that can be fetched with one request
+# to the batch fetch endpoint.
+MAX_NARROWS_PER_BATCH = 20
+
+
+@has_request_variables
+def get_messages_batch_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    narrows: List[Dict[str, Any]] = REQ(
+        json_validator=check_list(
+            check_dict_only(
+                [
+                    ("num_before", check_int_range(0, MAX_MESSAGES_PER_FETCH)),
+                    ("num_after", check_int_range(0, MAX_MESSAGES_PER_FETCH)),
+                ],
+                [
+                    ("narrow", check_list(check_union([check_dict(), check_list(check_string)]))),
+                    ("anchor", check_union([check_string, check_int])),
+                    ("cursor", check_string),
+                ],
+            )
+        )
+    ),
+    client_gravatar: bool = REQ(json_validator=check_bool, default=False),
+    apply_markdown: bool = REQ(json_validator=check_bool, default=True),
+) -> HttpResponse:
+    """Fetches messages in several narrows at once, as GET /messages
+    would for each; the messages are only turned into message
+    dictionaries once, even if they're in more than one narrow."""
+    if len(narrows) > MAX_NARROWS_PER_BATCH:
+        raise JsonableError(
+            _("Too many narrows; at most {max} can be fetched at once.").format(
+                max=MAX_NARROWS_PER_BATCH
+            )
+        )
+    if sum(spec["num_before"] + spec["num_after"] for spec in narrows) > MAX_MESSAGES_PER_FETCH:
+        raise JsonableError(
+            _("Too many messages requested (maximum {}).").format(
+                MAX_MESSAGES_PER_FETCH,
+            )
+        )
+
+    realm = user_profile.realm
+    if realm.email_address_visibility != Realm.EMAIL_ADDRESS_VISIBILITY_EVERYONE:
+        client_gravatar = False
+    materialize_deferred_user_messages(user_profile)
+
+    fetches: List[Union[NarrowFetch, JsonableError]] = []
+    for spec in narrows:
+        try:
+            try:
+                narrow = parse_narrow(spec.get("narrow", []))
+            except ValueError:
+                raise RequestVariableConversionError("narrow", spec["narrow"])
+            anchor_val = spec.get("anchor")
+            cursor = spec.get("cursor")
+            anchor = parse_fetch_anchor(
+                None if anchor_val is None else str(anchor_val),
+                False,
+                cursor,
+                spec["num_before"],
+                spec["num_after"],
+            )
+            fetches.append(
+                fetch_messages_in_narrow(
+                    request=request,
+                    realm=realm,
+                    user_profile=user_profile,
+                    is_web_public_query=False,
+                    narrow=narrow,
+                    anchor=anchor,
+                    num_before=spec["num_before"],
+                    num_after=spec["num_after"],
+                    cursor=cursor,
+                )
+            )
+        except JsonableError as error:
+            fetches.append(error)
+
+    # A message's flags are the same in every narrow it's in, so we
+    # can look up the union of the narrows' messages together, and
+    # only add each narrow's search highlights afterwards.
+    user_message_flags: Dict[int, List[str]] = {}
+    for fetched in fetches:
+        if isinstance(fetched, NarrowFetch):
+            user_message_flags.update(fetched.user_message_flags)
+    message_dicts = {
+        message["id"]: message
+        for message in messages_for_ids(
+            message_ids=sorted(user_message_flags),
+            user_message_flags=user_message_flags,
+            search_fields={},
+            apply_markdown=apply_markdown,
+            client_gravatar=client_gravatar,
+            allow_edit_history=realm.allow_edit_history,
+        )
+    }
+
+    results: List[Dict[str, Any]] = []
+    for fetched in fetches:
+        if isinstance(fetched, JsonableError):
+            results.append(dict(result="error", msg=fetched.msg, code=fetched.code.name))
+            continue
+        message_list = [
+            dict(message_dicts[message_id], **fetched.search_fields.get(message_id, {}))
+            for message_id in fetched.message_ids
+        ]
+        statsd.incr("loaded_old_messages", len(message_list))
+        results.append(
+            dict(
+                result="success",
+                messages=message_list,
+                found_anchor=fetched.query_info["found_anchor"],
+                found_oldest=fetched.query_info["found_oldest"],
+                found_newest=fetched.query_info["found_newest"],
+                history_limited=fetched.query_info["history_limited"],
+                anchor=fetched.anchor,
+                cursor=fetched.cursor,
+            )
+        )
+    return json_success({"narrows": results})
+
+
+@dataclass
+class NarrowFetch:
+    """The messages found by fetch_messages_in_narrow, before they're
+    turned into message dictionaries with messages_for_ids."""
+
+    anchor: int
+    cursor: str
+    message_ids: List[int]
+    user_message_flags: Dict[int, List[str]]
+    search_fields: Dict[int, Dict[str, str]]
+    query_info: Dict[str, Any]
+
+
+def parse_fetch_anchor(
+    anchor_val: Optional[str],
+    use_first_unread_anchor: bool,
+    cursor: Optional[str],
+    num_before: int,
+    num_after: int,
+) -> Optional[int]:
+    """Checks the parameters that say which messages in the narrow to
+    fetch, and returns the anchor (None for the first unread message,
+    or if the client passed a cursor)."""
+    anchor = None
+    if cursor is None:
+        anchor = parse_anchor_value(anchor_val, use_first_unread_anchor)
+    elif anchor_val is not None or use_first_unread_anchor:
+        raise JsonableError(_("Cannot specify both an anchor and a cursor."))
+    if num_before + num_after > MAX_MESSAGES_PER_FETCH:
+        raise JsonableError(
+            _("Too many messages requested (maximum {}).").format(
+                MAX_MESSAGES_PER_FETCH,
+            )
+        )
+    return anchor
+
+
+def fetch_messages_in_narrow(
+    request: HttpRequest,
+    realm: Realm,
+    user_profile: Optional[UserProfile],
+    is_web_public_query: bool,
+    narrow: OptionalNarrowListT,
+    anchor: Optional[int],
+    num_before: int,
+    num_after: int,
+    cursor: Optional[str],
+) -> NarrowFetch:
+    if cursor is not None:
+        # The cursor records the include_history value we computed
+        # when fetching the page it came from.  If it's False, it
+        # still is; but if it's True, the user may have since lost
+        # access to the stream (e.g. been unsubscribed from a
+        # private stream), so we check again.
+        include_history, cursor_oldest_id, cursor_newest_id = parse_message_fetch_cursor(
+            cursor, realm, user_profile, narrow
+        )
+        if include_history:
+            include_history = ok_to_include_history(narrow, user_profile, is_web_public_query)
+    else:
+        include_history = ok_to_include_history(narrow, user_profile, is_web_public_query)
     if include_history:
         # The initial query in this case doesn't use `zerver_usermessage`,
         # and isn't yet limited to messages the user is entitled to see!
@@ -1020,22 +1400,6 @@ def get_messages_backend(
         need_message = True
         need_user_message = True
 
-    query: FromClause
-    query, inner_msg_id_col = get_base_query_for_search(
-        user_profile=user_profile,
-        need_message=need_message,
-        need_user_message=need_user_message,
-    )
-
-    query, is_search = add_narrow_conditions(
-        user_profile=user_profile,
-        inner_msg_id_col=inner_msg_id_col,
-        query=query,
-        narrow=narrow,
-        realm=realm,
-        is_web_public_query=is_web_public_query,
-    )
-
     if narrow is not None:
         # Add some metadata to our logging data for narrows
         verbose_operators = []
@@ -1049,41 +1413,102 @@ def get_messages_backend(
         log_data["extra"] = "[{}]".format(",".join(verbose_operators))
 
     sa_conn = get_sqlalchemy_connection()
+    first_visible_message_id = get_first_visible_message_id(realm)
 
-    if anchor is None:
-        # `anchor=None` corresponds to the anchor="first_unread" parameter.
-        anchor = find_first_unread_anchor(
-            sa_conn,
-            user_profile,
-            narrow,
+    if cursor is not None:
+        # We fetch the messages adjacent to the range the client has
+        # already fetched; since none of those are returned again,
+        # post-processing treats the range's oldest message as an
+        # anchor that wasn't found.
+        anchor = cursor_oldest_id
+        anchored_to_left = False
+        anchored_to_right = False
+
+        range_params = get_cursor_range_params(
+            num_before=num_before,
+            num_after=num_after,
+            oldest_id=cursor_oldest_id,
+            newest_id=cursor_newest_id,
+            first_visible_message_id=first_visible_message_id,
         )
+    else:
+        if anchor is None:
+            # `anchor=None` corresponds to the anchor="first_unread" parameter.
+            anchor = find_first_unread_anchor(
+                sa_conn,
+                user_profile,
+                narrow,
+            )
 
-    anchored_to_left = anchor == 0
+        anchored_to_left = anchor == 0
+
+        # Set value that will be used to short circuit the after_query
+        # altogether and avoid needless conditions in the before_query.
+        anchored_to_right = anchor >= LARGER_THAN_MAX_MESSAGE_ID
+        if anchored_to_right:
+            num_after = 0
+
+        range_params = get_range_params(
+            num_before=num_before,
+            num_after=num_after,
+            anchor=anchor,
+            anchored_to_left=anchored_to_left,
+            anchored_to_right=anchored_to_right,
+            first_visible_message_id=first_visible_message_id,
+        )
 
-    # Set value that will be used to short circuit the after_query
-    # altogether and avoid needless conditions in the before_query.
-    anchored_to_right = anchor >= LARGER_THAN_MAX_MESSAGE_ID
-    if anchored_to_right:
-        num_after = 0
+    cache_key = None
+    if settings.NARROW_QUERY_CACHE:
+        cache_key = get_narrow_query_cache_key(
+            user_profile=user_profile,
+            realm=realm,
+            narrow=narrow,
+            is_web_public_query=is_web_public_query,
+            include_history=include_history,
+            range_params=range_params,
+        )
+    cached_query = narrow_query_cache.get(cache_key) if cache_key is not None else None
+    if cached_query is not None:
+        assert cache_key is not None
+        narrow_query_cache.move_to_end(cache_key)
+        compiled_query, is_search = cached_query
+        statsd.incr("narrow_query_cache.hit")
+    else:
+        query: FromClause
+        query, inner_msg_id_col = get_base_query_for_search(
+            user_profile=user_profile,
+            need_message=need_message,
+            need_user_message=need_user_message,
+        )
 
-    first_visible_message_id = get_first_visible_message_id(realm)
+        query, is_search = add_narrow_conditions(
+            user_profile=user_profile,
+            inner_msg_id_col=inner_msg_id_col,
+            query=query,
+            narrow=narrow,
+            realm=realm,
+            is_web_public_query=is_web_public_query,
+        )
 
-    query = limit_query_to_range(
-        query=query,
-        num_before=num_before,
-        num_after=num_after,
-        anchor=anchor,
-        anchored_to_left=anchored_to_left,
-        anchored_to_right=anchored_to_right,
-        id_col=inner_msg_id_col,
-        first_visible_message_id=first_visible_message_id,
-    )
+        query = limit_query_to_range(
+            query=query,
+            range_params=range_params,
+            id_col=inner_msg_id_col,
+        )
+
+        main_query = alias(query)
+        query = select(main_query.c, None, main_query).order_by(column("message_id", Integer).asc())
+        # This is a hack to tag the query we use for testing
+        query = query.prefix_with("/* get_messages */")
+        compiled_query = query.compile(dialect=sa_conn.dialect)
 
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id", Integer).asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_messages */")
-    rows = list(sa_conn.execute(query).fetchall())
+        if cache_key is not None:
+            statsd.incr("narrow_query_cache.miss")
+            narrow_query_cache[cache_key] = (compiled_query, is_search)
+            if len(narrow_query_cache) > NARROW_QUERY_CACHE_SIZE:
+                narrow_query_cache.popitem(last=False)
+
+    rows = list(sa_conn.execute(compiled_query, range_params).fetchall())
 
     query_info = post_process_limited_query(
         rows=rows,
@@ -1146,43 +1571,48 @@ def get_messages_backend(
                 # debugged the case that makes it happen.
                 raise Exception(str(err), message_id, narrow)
 
-    message_list = messages_for_ids(
+    # The cursor covers the whole contiguous range of message IDs the
+    # client has fetched with this narrow, including any earlier pages.
+    if cursor is not None:
+        oldest_id = min([cursor_oldest_id, *message_ids])
+        newest_id = max([cursor_newest_id, *message_ids])
+    elif not anchored_to_right:
+        oldest_id = min([anchor, *message_ids])
+        newest_id = max([anchor, *message_ids])
+    elif message_ids:
+        # Any newer messages would have been returned.
+        oldest_id = message_ids[0]
+        newest_id = message_ids[-1]
+    else:
+        # We didn't find anything up to the newest message.
+        oldest_id = LARGER_THAN_MAX_MESSAGE_ID
+        newest_id = Message.objects.order_by("-id").values_list("id", flat=True).first() or 0
+
+    return NarrowFetch(
+        anchor=anchor,
+        cursor=make_message_fetch_cursor(
+            realm, user_profile, narrow, include_history, oldest_id, newest_id
+        ),
         message_ids=message_ids,
         user_message_flags=user_message_flags,
         search_fields=search_fields,
-        apply_markdown=apply_markdown,
-        client_gravatar=client_gravatar,
-        allow_edit_history=realm.allow_edit_history,
+        query_info=query_info,
     )
 
-    statsd.incr("loaded_old_messages", len(message_list))
-
-    ret = dict(
-        messages=message_list,
-        result="success",
-        msg="",
-        found_anchor=query_info["found_anchor"],
-        found_oldest=query_info["found_oldest"],
-        found_newest=query_info["found_newest"],
-        history_limited=query_info["history_limited"],
-        anchor=anchor,
-    )
-    return json_success(ret)
-
 
-def limit_query_to_range(
-    query: Select,
+def get_range_params(
     num_before: int,
     num_after: int,
     anchor: int,
     anchored_to_left: bool,
     anchored_to_right: bool,
-    id_col: "ColumnElement[int]",
     first_visible_message_id: int,
-) -> FromClause:
+) -> Dict[str, int]:
     """
-    This code is actually generic enough that we could move it to a
-    library, but our only caller for now is message search.
+    Computes the bounds and limits with which limit_query_to_range
+    restricts a query to the requested messages around the anchor.
+    Which keys are present determines the shape of the query; the
+    values are its parameters.
     """
     need_before_query = (not anchored_to_left) and (num_before > 0)
     need_after_query = (not anchored_to_right) and (num_after > 0)
@@ -1215,40 +1645,97 @@ def limit_query_to_range(
         after_anchor = max(anchor, first_visible_message_id)
         after_limit = num_after + 1
 
+    range_params: Dict[str, int] = {}
+    if need_before_query:
+        if not anchored_to_right:
+            range_params["before_anchor"] = before_anchor
+        range_params["before_limit"] = before_limit
+    if need_after_query:
+        if not anchored_to_left:
+            range_params["after_anchor"] = after_anchor
+        range_params["after_limit"] = after_limit
+
+    if not range_params:
+        # If we don't have either a before_query or after_query, it's because
+        # some combination of num_before/num_after/anchor are zero or
+        # use_first_unread_anchor logic found no unread messages.
+        #
+        # The most likely reason is somebody is doing an id search, so searching
+        # for something like `message_id = 42` is exactly what we want.  In other
+        # cases, which could possibly be buggy API clients, at least we will
+        # return at most one row here.
+        range_params["anchor"] = anchor
+    return range_params
+
+
+def get_cursor_range_params(
+    num_before: int,
+    num_after: int,
+    oldest_id: int,
+    newest_id: int,
+    first_visible_message_id: int,
+) -> Dict[str, int]:
+    """
+    Like get_range_params, but for fetching the messages just before
+    and after the range the client already has, from oldest_id to
+    newest_id, rather than around an anchor.
+    """
+    range_params: Dict[str, int] = {}
+    if num_before > 0 or num_after == 0:
+        range_params["before_anchor"] = oldest_id - 1
+        range_params["before_limit"] = num_before
+    if num_after > 0:
+        range_params["after_anchor"] = max(newest_id + 1, first_visible_message_id)
+        range_params["after_limit"] = num_after
+    return range_params
+
+
+def limit_query_to_range(
+    query: Select,
+    range_params: Dict[str, int],
+    id_col: "ColumnElement[int]",
+) -> FromClause:
+    """
+    This code is actually generic enough that we could move it to a
+    library, but our only caller for now is message search.
+
+    The bounds and limits are bound parameters named after the keys
+    of range_params, so that the compiled query can be reused with
+    other values (see get_narrow_query_cache_key).
+    """
+    need_before_query = "before_limit" in range_params
+    need_after_query = "after_limit" in range_params
+
     if need_before_query:
         before_query = query
 
-        if not anchored_to_right:
-            before_query = before_query.where(id_col <= before_anchor)
+        if "before_anchor" in range_params:
+            before_query = before_query.where(
+                id_col <= bindparam("before_anchor", range_params["before_anchor"])
+            )
 
         before_query = before_query.order_by(id_col.desc())
-        before_query = before_query.limit(before_limit)
+        before_query = before_query.limit(bindparam("before_limit", range_params["before_limit"]))
 
     if need_after_query:
         after_query = query
 
-        if not anchored_to_left:
-            after_query = after_query.where(id_col >= after_anchor)
+        if "after_anchor" in range_params:
+            after_query = after_query.where(
+                id_col >= bindparam("after_anchor", range_params["after_anchor"])
+            )
 
         after_query = after_query.order_by(id_col.asc())
-        after_query = after_query.limit(after_limit)
+        after_query = after_query.limit(bindparam("after_limit", range_params["after_limit"]))
 
-    if need_both_sides:
+    if need_before_query and need_after_query:
         return union_all(before_query.self_group(), after_query.self_group())
     elif need_before_query:
         return before_query
     elif need_after_query:
         return after_query
     else:
-        # If we don't have either a before_query or after_query, it's because
-        # some combination of num_before/num_after/anchor are zero or
-        # use_first_unread_anchor logic found no unread messages.
-        #
-        # The most likely reason is somebody is doing an id search, so searching
-        # for something like `message_id = 42` is exactly what we want.  In other
-        # cases, which could possibly be buggy API clients, at least we will
-        # return at most one row here.
-        return query.where(id_col == anchor)
+        return query.where(id_col == bindparam("anchor", range_params["anchor"]))
 
 
 def post_process_limited_query(
@@ -1,17 +1,25 @@
-from typing import Iterable, Optional, Sequence, Union, cast
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union, cast
 
 import pytz
 from dateutil.parser import parse as dateparser
+from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
 
-from zerver.decorator import REQ, has_request_variables
+from zerver.decorator import (
+    REQ,
+    client_is_exempt_from_rate_limiting,
+    has_request_variables,
+    rate_limit_user,
+)
 from zerver.lib.actions import (
+    check_enqueue_message,
     check_schedule_message,
     check_send_message,
+    check_send_messages,
     compute_irc_user_fullname,
     compute_jabber_user_fullname,
     create_mirror_user_if_needed,
@@ -24,6 +32,14 @@ from zerver.lib.request import get_request_notes
 from zerver.lib.response import json_success
 from zerver.lib.timestamp import convert_to_UTC
 from zerver.lib.topic import REQ_topic
+from zerver.lib.validator import (
+    check_dict_only,
+    check_int,
+    check_list,
+    check_string,
+    check_string_in,
+    check_union,
+)
 from zerver.lib.zcommand import process_zcommands
 from zerver.lib.zephyr import compute_mit_user_fullname
 from zerver.models import (
@@ -297,6 +313,25 @@ def send_message_backend(
             realm=realm,
         )
 
+    # Mirrored messages are always sent synchronously; their senders
+    # are mirror users, who only ever send that way.
+    if settings.PIPELINED_MESSAGE_SEND and sender == user_profile:
+        check_enqueue_message(
+            sender,
+            client,
+            message_type_name,
+            message_to,
+            topic_name,
+            message_content,
+            forged_timestamp=request.POST.get("time") if forged else None,
+            local_id=local_id,
+            sender_queue_id=queue_id,
+            widget_content=widget_content,
+        )
+        # The client will learn the message's ID from the message
+        # event for local_id, once the message has been sent.
+        return json_success()
+
     ret = check_send_message(
         sender,
         client,
@@ -315,6 +350,69 @@ def send_message_backend(
     return json_success({"id": ret})
 
 
+# The maximum number of messages that can be sent with one request to
+# the batch send endpoint.
+MAX_MESSAGES_PER_BATCH = 100
+
+
+@has_request_variables
+def send_messages_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    messages: List[Dict[str, Any]] = REQ(
+        json_validator=check_list(
+            check_dict_only(
+                [
+                    ("type", check_string_in(["private", "stream"])),
+                    (
+                        "to",
+                        check_union(
+                            [
+                                check_int,
+                                check_string,
+                                check_list(check_int),
+                                check_list(check_string),
+                            ]
+                        ),
+                    ),
+                    ("content", check_string),
+                ],
+                [
+                    ("topic", check_string),
+                    ("local_id", check_string),
+                ],
+            )
+        )
+    ),
+    queue_id: Optional[str] = REQ(default=None),
+) -> HttpResponse:
+    if len(messages) > MAX_MESSAGES_PER_BATCH:
+        raise JsonableError(
+            _("Too many messages; at most {max} can be sent at once.").format(
+                max=MAX_MESSAGES_PER_BATCH
+            )
+        )
+
+    if settings.RATE_LIMITING and not client_is_exempt_from_rate_limiting(request):
+        # The request itself was charged once by rest_dispatch; charge
+        # the rest of the messages as though each were sent separately.
+        for message in messages[1:]:
+            rate_limit_user(request, user_profile, domain="api_by_user")
+
+    client = get_request_notes(request).client
+    assert client is not None
+    results: List[Dict[str, Any]] = []
+    for result in check_send_messages(user_profile, client, messages, sender_queue_id=queue_id):
+        if isinstance(result, JsonableError):
+            results.append(dict(result="error", msg=result.msg, code=result.code.name))
+        elif result is None:
+            # The message was queued; see send_message_backend.
+            results.append(dict(result="success"))
+        else:
+            results.append(dict(result="success", id=result))
+    return json_success({"messages": results})
+
+
 @has_request_variables
 def zcommand_backend(
     request: HttpRequest, user_profile: UserProfile, command: str = REQ("command")
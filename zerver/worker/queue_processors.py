@@ -47,26 +47,31 @@ from zulip_bots.lib import extract_query_without_mention
 
 from zerver.context_processors import common_context
 from zerver.lib.actions import (
+    check_queued_message,
     do_mark_stream_messages_as_read,
     do_send_confirmation_email,
+    do_send_messages,
     do_update_embedded_data,
     do_update_user_activity,
     do_update_user_activity_interval,
     do_update_user_presence,
     internal_send_private_message,
+    notify_pipelined_send_failed,
     notify_realm_export,
+    pipelined_message_send_queue_name,
     render_incoming_message,
 )
 from zerver.lib.bot_lib import EmbeddedBotHandler, EmbeddedBotQuitException, get_bot_handler
 from zerver.lib.context_managers import lockfile
 from zerver.lib.db import reset_queries
+from zerver.lib.deferred_user_messages import backfill_deferred_user_messages
 from zerver.lib.digest import bulk_handle_digest_email
 from zerver.lib.email_mirror import decode_stream_email_address, is_missed_message_address
 from zerver.lib.email_mirror import process_message as mirror_email
 from zerver.lib.email_mirror import rate_limit_mirror_by_realm
 from zerver.lib.email_notifications import handle_missedmessage_emails
 from zerver.lib.error_notify import do_report_error
-from zerver.lib.exceptions import RateLimited
+from zerver.lib.exceptions import JsonableError, RateLimited
 from zerver.lib.export import export_realm_wrapper
 from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler
 from zerver.lib.push_notifications import (
@@ -76,8 +81,9 @@ from zerver.lib.push_notifications import (
     initialize_push_notifications,
 )
 from zerver.lib.pysa import mark_sanitized
-from zerver.lib.queue import SimpleQueueClient, retry_event
+from zerver.lib.queue import SimpleQueueClient, queue_json_publish, retry_event
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
+from zerver.lib.rerender_messages import rerender_messages_batch
 from zerver.lib.send_email import (
     EmailNotDeliveredException,
     FromAddress,
@@ -87,6 +93,7 @@ from zerver.lib.send_email import (
     send_future_email,
 )
 from zerver.lib.timestamp import timestamp_to_datetime
+from zerver.lib.unread_summary import remove_unread_messages
 from zerver.lib.url_preview import preview as url_preview
 from zerver.models import (
     Message,
@@ -405,7 +412,7 @@ class QueueProcessingWorker(ABC):
 
 
 class LoopQueueProcessingWorker(QueueProcessingWorker):
-    sleep_delay = 1
+    sleep_delay: float = 1
     batch_size = 100
 
     def start(self) -> None:  # nocoverage
@@ -780,6 +787,88 @@ class MirrorWorker(QueueProcessingWorker):
         mirror_email(msg, rcpt_to=rcpt_to)
 
 
+@assign_queue("deferred_user_messages")
+class DeferredUserMessagesWorker(QueueProcessingWorker):
+    """Creates the UserMessage rows deferred when sending a message with
+    lazy fan-out; see zerver/lib/deferred_user_messages.py."""
+
+    def consume(self, event: Mapping[str, Any]) -> None:
+        backfill_deferred_user_messages(event["message_id"])
+
+
+class PipelinedMessageSendWorker(LoopQueueProcessingWorker):
+    """Renders and sends the messages queued by check_enqueue_message,
+    when settings.PIPELINED_MESSAGE_SEND is enabled.  Sending a batch
+    of messages with a single do_send_messages call amortizes its
+    database writes.  The queue is sharded by sender, with a single
+    consumer per shard, so that each sender's messages are sent in
+    the order they were queued; see the subclasses registered below."""
+
+    # Queued messages wait at most this many seconds for a batch to
+    # fill up, so keep it short.
+    sleep_delay = 0.1
+    batch_size = 50
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        send_requests = [check_queued_message(event) for event in events]
+        try:
+            do_send_messages(send_requests)
+        except Exception:
+            # The batch is sent in a single transaction, so if its
+            # messages don't exist, none were sent.  If they do, it
+            # was something after that which failed.
+            message_ids = [
+                send_request.message.id for send_request in send_requests if send_request
+            ]
+            if Message.objects.filter(id__in=message_ids).exists():
+                raise
+            logging.exception(
+                "Failed to send a batch of %d queued messages; sending them one at a time",
+                len(message_ids),
+            )
+            # We check the messages again, since do_send_messages
+            # has modified the ones it was passed.
+            for event, send_request in zip(events, send_requests):
+                if send_request is not None:
+                    self.send_queued_message(event)
+
+    def send_queued_message(self, event: Dict[str, Any]) -> None:
+        send_request = check_queued_message(event)
+        if send_request is None:
+            return
+        try:
+            do_send_messages([send_request])
+        except Exception:
+            if Message.objects.filter(id=send_request.message.id).exists():
+                logging.exception("Failed after sending queued message %d", send_request.message.id)
+                return
+            logging.exception("Failed to send queued message from user %d", event["sender_id"])
+            notify_pipelined_send_failed(event, JsonableError(_("Internal server error")))
+
+
+for shard in range(settings.PIPELINED_MESSAGE_SEND_SHARDS):
+    assign_queue(pipelined_message_send_queue_name(shard))(
+        type(f"PipelinedMessageSendShard{shard}Worker", (PipelinedMessageSendWorker,), {})
+    )
+
+
+@assign_queue("rerender_messages")
+class RerenderMessagesWorker(QueueProcessingWorker):
+    """Re-renders a realm's existing messages after its linkifiers or
+    custom emoji change, one batch per event; see
+    zerver/lib/rerender_messages.py."""
+
+    def consume(self, event: Mapping[str, Any]) -> None:
+        start_time = time.time()
+        next_event = rerender_messages_batch(dict(event))
+        if next_event is not None:
+            # Spend at least as long idle as we spent working, so that
+            # re-rendering a large realm leaves the database to live
+            # traffic at least half the time.
+            time.sleep(time.time() - start_time)
+            queue_json_publish("rerender_messages", next_event)
+
+
 @assign_queue("embed_links")
 class FetchLinksEmbedData(QueueProcessingWorker):
     # This is a slow queue with network requests, so a disk write is negligible.
@@ -918,6 +1007,7 @@ class DeferredWorker(QueueProcessingWorker):
                 UserMessage.objects.filter(message__in=messages).extra(
                     where=[UserMessage.where_unread()]
                 ).update(flags=F("flags").bitor(UserMessage.flags.read))
+                remove_unread_messages([message.id for message in messages])
                 offset += len(messages)
                 if len(messages) < batch_size:
                     break
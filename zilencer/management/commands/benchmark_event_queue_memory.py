@@ -0,0 +1,68 @@
+import time
+import tracemalloc
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.event_queue import ClientDescriptor, allocate_client_descriptor
+
+
+class Command(BaseCommand):
+    help = """Measures the memory used by each event queue, as allocated
+by Tornado when a client registers, with a mix of client types similar
+to a production server.  Runs against in-memory event queues in this
+process; it doesn't touch the database or Tornado.  Run it at
+different commits to compare representations."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--queues", help="Number of event queues to allocate", default=100000, type=int
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_queues = options["queues"]
+        # A realm ID that no real event queues will use.
+        realm_id = -1
+
+        def queue_data(i: int) -> Any:
+            # Build fresh strings and lists, as parsing a request would.
+            if i % 4 == 0:
+                return dict(
+                    client_type_name="".join(["Zulip", "Mobile"]),
+                    event_types=[
+                        "".join(["message"]),
+                        "".join(["update_message_flags"]),
+                        "".join(["realm_emoji"]),
+                    ],
+                    narrow=[],
+                )
+            if i % 50 == 1:
+                return dict(
+                    client_type_name="".join(["website"]),
+                    event_types=None,
+                    narrow=[["stream", f"stream {i % 100}"]],
+                )
+            return dict(client_type_name="".join(["website"]), event_types=None, narrow=[])
+
+        tracemalloc.start()
+        start_size = tracemalloc.get_traced_memory()[0]
+        queues: List[ClientDescriptor] = []
+        for i in range(num_queues):
+            queues.append(
+                allocate_client_descriptor(
+                    dict(
+                        user_profile_id=i,
+                        realm_id=realm_id,
+                        apply_markdown=True,
+                        client_gravatar=True,
+                        all_public_streams=False,
+                        queue_timeout=600,
+                        last_connection_time=time.time(),
+                        **queue_data(i),
+                    )
+                )
+            )
+        size = tracemalloc.get_traced_memory()[0] - start_size
+        tracemalloc.stop()
+
+        print(f"{num_queues} event queues: {size / num_queues:.0f} bytes/queue")
@@ -0,0 +1,108 @@
+import time
+from typing import Any, Callable, List, Tuple
+
+import markdown
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.markdown import LinkifierMatcher, LinkifierPattern, Markdown, MessageRenderingResult
+from zerver.lib.types import LinkifierDict
+
+
+class PerLinkifierMarkdown(Markdown):
+    """A Markdown engine that applies each linkifier with its own
+    inline pattern, for comparison."""
+
+    def register_linkifiers(self, inlinePatterns: markdown.util.Registry) -> markdown.util.Registry:
+        for linkifier in self.linkifiers:
+            pattern = linkifier["pattern"]
+            inlinePatterns.register(
+                LinkifierPattern(pattern, linkifier["url_format"], self),
+                f"linkifiers/{pattern}",
+                45,
+            )
+        return inlinePatterns
+
+
+def make_linkifiers(count: int) -> List[LinkifierDict]:
+    return [
+        LinkifierDict(
+            pattern=f"PROJ{i}-(?P<id>[0-9]+)",
+            url_format=f"https://tracker.example.com/proj{i}/%(id)s",
+            id=i,
+        )
+        for i in range(count)
+    ]
+
+
+def render(engine: Markdown, content: str) -> str:
+    engine.zulip_message = None
+    engine.zulip_realm = None
+    engine.zulip_db_data = None
+    engine.zulip_rendering_result = MessageRenderingResult(
+        rendered_content="",
+        mentions_wildcard=False,
+        mentions_user_ids=set(),
+        mentions_user_group_ids=set(),
+        alert_words=set(),
+        links_for_preview=set(),
+        user_ids_with_alert_words=set(),
+        potential_attachment_path_ids=[],
+    )
+    engine.image_preview_enabled = False
+    engine.url_embed_preview_enabled = False
+    engine.zulip_rendering_cacheable = True
+    engine.zulip_alert_word_content = None
+    return engine.convert(content)
+
+
+class Command(BaseCommand):
+    help = """Measures the cost of applying linkifiers, for realms with
+various numbers of linkifiers: the throughput of rendering messages
+with a Markdown engine that applies the linkifiers one at a time and
+with one that uses a combined LinkifierMatcher, and of linkifying
+topics."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--counts",
+            help="Comma-separated numbers of linkifiers to measure",
+            default="1,10,100,300",
+        )
+        parser.add_argument("--amount", help="Number of messages to render", default=1000, type=int)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        for count in [int(count) for count in options["counts"].split(",")]:
+            linkifiers = make_linkifiers(count)
+            content = (
+                f"Fixed in PROJ0-1234, but **PROJ{count - 1}-5678** is still open; "
+                "see the discussion at https://example.com/discussion for details.\n\n"
+                "* A list item\n* Another list item, mentioning PROJX-1"
+            )
+
+            for name, engine_class in [
+                ("per-linkifier", PerLinkifierMarkdown),
+                ("combined", Markdown),
+            ]:
+                engine = engine_class(linkifiers=linkifiers, linkifiers_key=0, email_gateway=False)
+                render(engine, content)
+                start = time.time()
+                for _ in range(options["amount"]):
+                    render(engine, content)
+                elapsed = time.time() - start
+                print(f"{count} linkifiers, {name}: {options['amount'] / elapsed:.0f} messages/s")
+
+            # Most topics don't mention anything to linkify.
+            topic = "weekly sync"
+            matcher = LinkifierMatcher(linkifiers)
+            topic_filters: List[Tuple[str, Callable[[str], bool]]] = [
+                ("per-linkifier", lambda topic: True),
+                ("combined", matcher.might_match),
+            ]
+            for name, might_match in topic_filters:
+                start = time.time()
+                for _ in range(options["amount"]):
+                    if might_match(topic):
+                        for pattern in matcher.patterns:
+                            list(pattern.finditer(topic))
+                elapsed = time.time() - start
+                print(f"{count} linkifiers, {name}: {options['amount'] / elapsed:.0f} topics/s")
@@ -0,0 +1,53 @@
+import time
+from typing import Any
+
+from django.core.management.base import CommandError, CommandParser
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.markdown.pool import MarkdownRenderingPool
+from zerver.models import Message
+
+
+class Command(ZulipBaseCommand):
+    help = """Measures the throughput of rendering the Markdown content of
+a realm's most recent messages, first serially and then using a
+MarkdownRenderingPool with the given number of processes.  The rendered
+content is discarded; nothing is written to the database."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        self.add_realm_args(parser, required=True)
+        parser.add_argument(
+            "--amount", help="Number of messages to render", default=10000, type=int
+        )
+        parser.add_argument(
+            "--processes", help="Number of processes in the pool", default=4, type=int
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        if options["processes"] < 1:
+            raise CommandError("You must have at least one process.")
+
+        messages = Message.objects.filter(sender__realm=realm).order_by("-id")[: options["amount"]]
+        requests = [
+            (content, is_bot, translate_emoticons)
+            for content, is_bot, translate_emoticons in messages.values_list(
+                "content", "sender__is_bot", "sender__translate_emoticons"
+            )
+        ]
+        if not requests:
+            raise CommandError("There are no messages to render.")
+
+        for processes in [1, options["processes"]]:
+            with MarkdownRenderingPool(realm, processes) as pool:
+                # Render one message first, so that both measurements
+                # start with warm Markdown engines.
+                pool.render(requests[:1])
+                start = time.time()
+                pool.render(requests)
+                elapsed = time.time() - start
+            print(
+                f"{processes} process(es): {len(requests)} messages in {elapsed:.2f}s "
+                f"({len(requests) / elapsed:.0f} messages/s)"
+            )
@@ -0,0 +1,95 @@
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import orjson
+from django.core.management.base import CommandParser
+from django.test import RequestFactory, override_settings
+
+from zerver.lib.actions import do_send_messages, internal_prep_stream_message
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import SendMessageRequest
+from zerver.lib.request import get_request_notes
+from zerver.models import UserProfile, get_stream
+from zerver.views.message_fetch import get_messages_backend, narrow_query_cache
+
+
+def fetch_messages(user_profile: UserProfile, params: Dict[str, Union[str, int]]) -> Dict[str, Any]:
+    request = RequestFactory().get("/json/messages", params)
+    request.user = user_profile
+    get_request_notes(request).log_data = {}
+    response = get_messages_backend(request, user_profile)
+    return orjson.loads(response.content)
+
+
+class Command(ZulipBaseCommand):
+    help = """Times scrolling back through a busy stream narrow, a page
+at a time, by passing the oldest message fetched so far as the anchor
+of each request, compared with passing the cursor returned by the
+previous request; each both with and without NARROW_QUERY_CACHE."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("email", metavar="<email>", help="Email address of the user")
+        parser.add_argument("--stream", help="Stream to narrow to", default="Verona")
+        parser.add_argument(
+            "--messages", help="Number of messages to scroll through", default=10000, type=int
+        )
+        parser.add_argument("--page-size", help="Messages per request", default=100, type=int)
+        parser.add_argument(
+            "--populate",
+            help="Number of messages to send to the stream first",
+            default=0,
+            type=int,
+        )
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        user_profile = self.get_user(options["email"], realm)
+        stream = get_stream(options["stream"], user_profile.realm)
+        narrow = orjson.dumps([dict(operator="stream", operand=stream.name)]).decode()
+        page_size = options["page_size"]
+
+        for start in range(0, options["populate"], 100):
+            send_requests: List[Optional[SendMessageRequest]] = [
+                internal_prep_stream_message(
+                    user_profile, stream, f"benchmark {i // 1000}", f"Message {i}"
+                )
+                for i in range(start, min(start + 100, options["populate"]))
+            ]
+            do_send_messages(send_requests)
+
+        def scroll(use_cursor: bool) -> Tuple[int, int, float]:
+            result = fetch_messages(
+                user_profile,
+                dict(narrow=narrow, anchor="newest", num_before=page_size, num_after=0),
+            )
+            fetched = len(result["messages"])
+            pages = 1
+            start = time.perf_counter()
+            while fetched < options["messages"] and not result["found_oldest"]:
+                params: Dict[str, Union[str, int]] = dict(
+                    narrow=narrow, num_before=page_size, num_after=0
+                )
+                if use_cursor:
+                    params["cursor"] = result["cursor"]
+                else:
+                    # As clients do, re-fetch the anchor itself.
+                    params["anchor"] = result["messages"][0]["id"]
+                    params["num_before"] = page_size + 1
+                result = fetch_messages(user_profile, params)
+                if not use_cursor:
+                    result["messages"] = result["messages"][:-1]
+                fetched += len(result["messages"])
+                pages += 1
+            return fetched, pages, time.perf_counter() - start
+
+        for use_cache in [False, True]:
+            narrow_query_cache.clear()
+            with override_settings(NARROW_QUERY_CACHE=use_cache):
+                for name, use_cursor in [("anchor", False), ("cursor", True)]:
+                    fetched, pages, elapsed = scroll(use_cursor)
+                    print(
+                        f"{name}, query cache {'on' if use_cache else 'off'}: "
+                        f"{fetched} messages in {pages} pages, "
+                        f"{elapsed:.2f}s ({1000 * elapsed / max(pages - 1, 1):.1f} ms/page)"
+                    )
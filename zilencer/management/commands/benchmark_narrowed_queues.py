@@ -0,0 +1,106 @@
+import time
+from timeit import timeit
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.event_queue import (
+    ClientDescriptor,
+    allocate_client_descriptor,
+    get_client_info_for_message_event,
+)
+
+
+class Command(BaseCommand):
+    help = """Times finding the narrowed event queues interested in a stream
+message, as a function of the number of narrowed queues, compared
+with checking every queue's narrow.  Runs against in-memory event
+queues in this process; it doesn't touch the database or Tornado."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--counts",
+            help="Comma-separated numbers of narrowed queues to time",
+            default="100,1000,10000,100000",
+        )
+        parser.add_argument(
+            "--messages", help="Number of messages to time at each count", default=1000, type=int
+        )
+        parser.add_argument(
+            "--streams", help="Number of distinct streams narrowed to", default=100, type=int
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        counts = sorted(int(count) for count in options["counts"].split(","))
+        num_messages = options["messages"]
+        num_streams = options["streams"]
+        # A realm ID that no real event queues will use.
+        realm_id = -1
+
+        def narrow_for(i: int) -> List[List[str]]:
+            if i % 3 == 0:
+                return [["stream", f"stream {i % num_streams}"]]
+            if i % 3 == 1:
+                return [["stream", f"stream {i % num_streams}"], ["topic", f"topic {i % 10}"]]
+            return [["sender", f"user{i % 1000}@example.com"]]
+
+        message_events: List[Dict[str, Any]] = []
+        for i in range(num_messages):
+            stream_name = f"stream {i % num_streams}"
+            message_events.append(
+                dict(
+                    realm_id=realm_id,
+                    stream_name=stream_name,
+                    message_dict=dict(
+                        type="stream",
+                        display_recipient=stream_name,
+                        subject=f"topic {i % 10}",
+                        sender_email=f"user{i % 1000}@example.com",
+                    ),
+                )
+            )
+
+        narrowed_clients: List[ClientDescriptor] = []
+        for count in counts:
+            while len(narrowed_clients) < count:
+                narrowed_clients.append(
+                    allocate_client_descriptor(
+                        dict(
+                            user_profile_id=len(narrowed_clients),
+                            realm_id=realm_id,
+                            event_types=["message"],
+                            client_type_name="benchmark",
+                            apply_markdown=True,
+                            client_gravatar=True,
+                            all_public_streams=False,
+                            queue_timeout=0,
+                            last_connection_time=time.time(),
+                            narrow=narrow_for(len(narrowed_clients)),
+                        )
+                    )
+                )
+
+            def indexed() -> None:
+                for event_template in message_events:
+                    client_info = get_client_info_for_message_event(event_template, users=[])
+                    user_event = dict(
+                        type="message", message=event_template["message_dict"], flags=[]
+                    )
+                    for info in client_info.values():
+                        info["client"].accepts_event(user_event)
+
+            def linear() -> None:
+                for event_template in message_events:
+                    user_event = dict(
+                        type="message", message=event_template["message_dict"], flags=[]
+                    )
+                    for client in narrowed_clients:
+                        client.accepts_event(user_event)
+
+            indexed_time = timeit(indexed, number=1)
+            linear_time = timeit(linear, number=1)
+            print(
+                f"{count} narrowed queues: "
+                f"{1000000 * indexed_time / num_messages:.1f}us/message indexed, "
+                f"{1000000 * linear_time / num_messages:.1f}us/message checking every narrow"
+            )
@@ -0,0 +1,109 @@
+import threading
+import time
+from typing import Any, Callable, List
+
+from django.core.management.base import CommandParser
+from django.db import connection
+
+from zerver.lib.actions import do_send_messages, internal_prep_stream_message
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message, Stream, UserProfile, get_stream
+
+STREAM_TOPIC_TRIGGERS = [
+    "zerver_streamtopic_message_insert",
+    "zerver_streamtopic_message_update",
+    "zerver_streamtopic_message_delete",
+]
+
+
+def set_stream_topic_triggers(enabled: bool) -> None:
+    with connection.cursor() as cursor:
+        for trigger in STREAM_TOPIC_TRIGGERS:
+            cursor.execute(
+                f"ALTER TABLE zerver_message {'ENABLE' if enabled else 'DISABLE'} TRIGGER {trigger}"
+            )
+
+
+def send_messages_concurrently(
+    user_profile: UserProfile,
+    stream: Stream,
+    get_topic_name: Callable[[int], str],
+    threads: int,
+    messages: int,
+) -> float:
+    def send_messages(thread: int) -> None:
+        try:
+            for i in range(messages):
+                do_send_messages(
+                    [
+                        internal_prep_stream_message(
+                            user_profile, stream, get_topic_name(thread), f"Message {i}"
+                        )
+                    ]
+                )
+        finally:
+            connection.close()
+
+    workers: List[threading.Thread] = [
+        threading.Thread(target=send_messages, args=(thread,)) for thread in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+class Command(ZulipBaseCommand):
+    help = """Times sending messages from several threads at once, all to
+one topic and each to its own topic, each both with and without the
+triggers that maintain StreamTopic.  Sends to one topic contend for its
+StreamTopic row, so the difference between the two shows the cost of
+that contention.
+
+The triggers are disabled for the whole table while that runs, and
+the messages sent to the stream meanwhile are then deleted, so only run
+this on a development server."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("email", metavar="<email>", help="Email address of the sender")
+        parser.add_argument("--stream", help="Stream to send to", default="Verona")
+        parser.add_argument("--threads", help="Number of threads", default=8, type=int)
+        parser.add_argument(
+            "--messages", help="Number of messages each thread sends", default=100, type=int
+        )
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        user_profile = self.get_user(options["email"], realm)
+        stream = get_stream(options["stream"], user_profile.realm)
+        threads = options["threads"]
+        sent = threads * options["messages"]
+
+        for triggers in [True, False]:
+            last_message_id = Message.objects.order_by("-id").values_list("id", flat=True).first()
+            if not triggers:
+                set_stream_topic_triggers(False)
+            try:
+                for name, get_topic_name in [
+                    ("one topic", lambda thread: "benchmark"),
+                    ("a topic each", lambda thread: f"benchmark {thread}"),
+                ]:
+                    elapsed = send_messages_concurrently(
+                        user_profile, stream, get_topic_name, threads, options["messages"]
+                    )
+                    print(
+                        f"{name}, triggers {'on' if triggers else 'off'}: "
+                        f"{sent} messages from {threads} threads in {elapsed:.2f}s "
+                        f"({sent / elapsed:.0f} messages/s)"
+                    )
+            finally:
+                if not triggers:
+                    # StreamTopic doesn't include these messages, so
+                    # it's only right again once they're gone.
+                    Message.objects.filter(
+                        recipient=stream.recipient, id__gt=last_message_id or 0
+                    ).delete()
+                    set_stream_topic_triggers(True)
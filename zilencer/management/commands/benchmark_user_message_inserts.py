@@ -0,0 +1,91 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import CommandParser
+from django.utils.timezone import now as timezone_now
+
+import zerver.lib.actions
+from zerver.lib.actions import build_message_send_dict, do_send_messages
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message, Subscription, UserProfile, get_client, get_stream
+
+
+class Command(ZulipBaseCommand):
+    help = """Times sending a stream message with its UserMessage rows
+inserted via INSERT and via COPY (see bulk_insert_ums), as a function
+of the number of recipients.
+
+Subscribes the given numbers of new users to the stream first, and
+deletes them and the messages sent afterwards, so only run this on a
+development server."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("email", metavar="<email>", help="Email address of the sender")
+        parser.add_argument("--stream", help="Stream to send to", default="Verona")
+        parser.add_argument(
+            "--recipients",
+            help="Comma-separated numbers of recipients to time sending to",
+            default="100,1000,10000,50000",
+        )
+        parser.add_argument(
+            "--messages", help="Number of messages to send each way", default=5, type=int
+        )
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        sender = self.get_user(options["email"], realm)
+        stream = get_stream(options["stream"], sender.realm)
+        recipient = stream.recipient
+        assert recipient is not None
+        sending_client = get_client("benchmark")
+        recipient_counts = sorted(int(count) for count in options["recipients"].split(","))
+        last_message_id = Message.objects.order_by("-id").values_list("id", flat=True).first()
+
+        def send_messages(threshold: int) -> float:
+            zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD = threshold
+            elapsed = 0.0
+            for i in range(options["messages"]):
+                message = Message(
+                    sender=sender,
+                    recipient=recipient,
+                    content=f"Message {i}",
+                    date_sent=timezone_now(),
+                    sending_client=sending_client,
+                )
+                message.set_topic_name("benchmark")
+                send_request = build_message_send_dict(message=message)
+                start = time.perf_counter()
+                do_send_messages([send_request])
+                elapsed += time.perf_counter() - start
+            return elapsed / options["messages"]
+
+        original_threshold = zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD
+        users: List[UserProfile] = []
+        try:
+            for recipient_count in recipient_counts:
+                new_users = UserProfile.objects.bulk_create(
+                    UserProfile(
+                        realm=sender.realm,
+                        email=f"benchmark{i}@example.com",
+                        delivery_email=f"benchmark{i}@example.com",
+                    )
+                    for i in range(len(users), recipient_count)
+                )
+                Subscription.objects.bulk_create(
+                    Subscription(user_profile=user, is_user_active=True, recipient=recipient)
+                    for user in new_users
+                )
+                users += new_users
+
+                insert_time = send_messages(10 ** 9)
+                copy_time = send_messages(0)
+                print(
+                    f"{recipient_count} recipients: "
+                    f"INSERT {1000 * insert_time:.1f} ms/message, "
+                    f"COPY {1000 * copy_time:.1f} ms/message"
+                )
+        finally:
+            zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD = original_threshold
+            Message.objects.filter(recipient=recipient, id__gt=last_message_id or 0).delete()
+            UserProfile.objects.filter(id__in=[user.id for user in users]).delete()
@@ -231,6 +231,10 @@ if not TORNADO_PORTS:
     TORNADO_PORTS = get_tornado_ports(config_file)
 TORNADO_PROCESSES = len(TORNADO_PORTS)
 
+PIPELINED_MESSAGE_SEND_SHARDS = int(
+    get_config("application_server", "pipelined_message_send_shards", "1")
+)
+
 RUNNING_INSIDE_TORNADO = False
 AUTORELOAD = DEBUG
 
@@ -172,6 +172,33 @@ SENDFILE_BACKEND: Optional[str] = None
 
 TORNADO_PORTS: List[int] = []
 USING_TORNADO = True
+# Whether Tornado should journal changes to its event queues to disk
+# as they happen, rather than only saving them at shutdown.  This
+# makes restarts faster, and lets event queues survive a crash.
+TORNADO_EVENT_QUEUE_JOURNAL = False
+# Whether Tornado should combine consecutive notices that can be
+# delivered as a single event (e.g. message flag updates for the same
+# user) when processing a batch from the notify_tornado queue.
+TORNADO_COALESCE_NOTICES = False
+# Limits on the number of events, and their total size in bytes, that
+# an event queue can hold; a queue exceeding them has its events
+# discarded, and its client must register a new queue.
+TORNADO_EVENT_QUEUE_MAX_EVENTS: Optional[int] = None
+TORNADO_EVENT_QUEUE_MAX_BYTES: Optional[int] = None
+# Whether messages should be rendered and sent by the
+# pipelined_message_send queue worker, with the API request returning
+# once the message is queued.  The queue is sharded by sender, with
+# the number of shards set by pipelined_message_send_shards in the
+# [application_server] section of /etc/zulip/zulip.conf.
+PIPELINED_MESSAGE_SEND = False
+# Whether to cache the results of rendering message content, so that
+# messages with content identical to a recent message (common for
+# bots) skip the Markdown processor.
+RENDERED_MARKDOWN_CACHE = True
+# Whether to cache the compiled SQL queries for fetching messages in
+# a narrow, so that fetching more messages in the same narrow doesn't
+# build and compile the query again.
+NARROW_QUERY_CACHE = True
 
 # ToS/Privacy templates
 PRIVACY_POLICY: Optional[str] = None
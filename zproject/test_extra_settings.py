@@ -163,6 +163,11 @@ S3_AUTH_UPLOADS_BUCKET = "test-authed-bucket"
 S3_AVATAR_BUCKET = "test-avatar-bucket"
 
 INLINE_URL_EMBED_PREVIEW = False
+# Tests render the same content with different settings and mocks;
+# tests for the cache itself enable it explicitly.
+RENDERED_MARKDOWN_CACHE = False
+# Likewise, tests change the narrow query's inputs with mocks.
+NARROW_QUERY_CACHE = False
 
 HOME_NOT_LOGGED_IN = "/login/"
 LOGIN_URL = "/accounts/login/"
@@ -16,7 +16,14 @@ from django.views.generic import RedirectView, TemplateView
 from zerver.forms import LoggingSetPasswordForm
 from zerver.lib.integrations import WEBHOOK_INTEGRATIONS
 from zerver.lib.rest import rest_path
-from zerver.tornado.views import cleanup_event_queue, get_events, get_events_internal, notify
+from zerver.tornado.views import (
+    cleanup_event_queue,
+    get_events,
+    get_events_internal,
+    import_event_queues_internal,
+    notify,
+    rebalance_event_queues_internal,
+)
 from zerver.views.alert_words import add_alert_words, list_alert_words, remove_alert_words
 from zerver.views.archive import archive, get_web_public_topics_backend
 from zerver.views.attachments import list_by_user, remove
@@ -67,14 +74,23 @@ from zerver.views.message_edit import (
     json_fetch_raw_message,
     update_message_backend,
 )
-from zerver.views.message_fetch import get_messages_backend, messages_in_narrow_backend
+from zerver.views.message_fetch import (
+    get_messages_backend,
+    get_messages_batch_backend,
+    messages_in_narrow_backend,
+)
 from zerver.views.message_flags import (
     mark_all_as_read,
     mark_stream_as_read,
     mark_topic_as_read,
     update_message_flags,
 )
-from zerver.views.message_send import render_message_backend, send_message_backend, zcommand_backend
+from zerver.views.message_send import (
+    render_message_backend,
+    send_message_backend,
+    send_messages_backend,
+    zcommand_backend,
+)
 from zerver.views.muting import mute_user, unmute_user, update_muted_topic
 from zerver.views.portico import (
     app_download_link_redirect,
@@ -336,6 +352,11 @@ v1_api_and_json_patterns = [
         PATCH=update_message_backend,
         DELETE=delete_message_backend,
     ),
+    rest_path(
+        "messages/batch",
+        GET=get_messages_batch_backend,
+        POST=(send_messages_backend, {"allow_incoming_webhooks"}),
+    ),
     rest_path("messages/render", POST=render_message_backend),
     rest_path("messages/flags", POST=update_message_flags),
     rest_path("messages/<int:message_id>/history", GET=get_message_edit_history),
@@ -735,6 +756,8 @@ urls += [
     # asynchronous Tornado behavior.
     path("notify_tornado", notify),
     path("api/v1/events/internal", get_events_internal),
+    path("rebalance_tornado_event_queues", rebalance_event_queues_internal),
+    path("import_tornado_event_queues", import_event_queues_internal),
 ]
 
 # Python Social Auth